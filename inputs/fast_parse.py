@@ -0,0 +1,296 @@
+import calendar
+import math
+import re
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from inputs.parse import PATTERN_ITEM, PATTERN_VALUE_TST, MeterMessage, parse_power, parse_volume, parse_timestamp
+
+# Single pass telegram parser, producing the same `MeterMessage`s as `Parser` + `MeterMessage.from_raw`,
+# which is kept as the reference implementation (see `profile_parser.py` for the differential check).
+# Only the fields used by `MeterMessage` are decoded, all other lines are only checked for validity.
+
+KEY_TIMESTAMP = "0-0:1.0.0"
+KEY_PEAK_POWER = "1-0:1.6.0"
+KEY_GAS = "0-1:24.2.3"
+
+# the instant powers followed by the voltages, in `MeterMessage` field order
+# voltages are parsed like powers, matching `MeterMessage.from_raw`
+POWER_KEYS = [
+    "1-0:21.7.0", "1-0:41.7.0", "1-0:61.7.0",
+    "1-0:32.7.0", "1-0:52.7.0", "1-0:72.7.0",
+]
+
+# blank lines, at least one, separate telegrams
+PATTERN_BLANK_LINES = re.compile(r"\n\s*\n")
+# a single telegram line, stricter than `PATTERN_ITEM` (no surrounding whitespace, ASCII only, value in parentheses),
+# telegrams with lines that don't match this fall back to the exact line by line parser
+PATTERN_BLOCK_ITEM = re.compile(r"^(\d+-\d+:\d+\.\d+\.\d+)(\(.*\))$", re.MULTILINE | re.ASCII)
+
+# the full values in the format we expect, anything else goes through `_split_value`
+PATTERN_FULL_SINGLE = re.compile(r"\(([^()]*)\)")
+PATTERN_FULL_KWH = re.compile(r"\((\d+\.\d+)\*kW\)")
+
+# keys that we have seen before, and that are known to match `PATTERN_ITEM` as the part before the first '('
+_valid_keys = set()
+
+# values repeat a lot between telegrams, so decoded values are cached per full value string,
+# and timestamp conversions per minute
+VALUE_CACHE_SIZE = 4096
+_power_cache: Dict[str, float] = {}
+_peak_cache: Dict[str, tuple] = {}
+_gas_cache: Dict[str, tuple] = {}
+_minute_cache: Dict[str, Optional[int]] = {}
+
+# the 'S' and 'W' suffix mean summer and winter time
+TIMEZONE_OFFSETS = {"S": 2 * 3600, "W": 3600}
+
+
+def _parse_minute(minute_str: str) -> Optional[int]:
+    """
+    Convert `YYMMDDhhmm` to the UTC timestamp of the start of that minute, or None if invalid.
+    """
+    if not (minute_str.isascii() and minute_str.isdigit()):
+        return None
+
+    year = int(minute_str[0:2])
+    # same century rule as strptime %y
+    year += 2000 if year < 69 else 1900
+    try:
+        day = date(year, int(minute_str[2:4]), int(minute_str[4:6]))
+    except ValueError:
+        return None
+
+    hour, minute = int(minute_str[6:8]), int(minute_str[8:10])
+    if hour >= 24 or minute >= 60:
+        return None
+    return calendar.timegm(day.timetuple()) + hour * 3600 + minute * 60
+
+
+def fast_parse_timestamp(short_str: str) -> int:
+    """
+    Equivalent to `parse_timestamp`. Anything that is not a plain valid timestamp is passed on to `parse_timestamp`,
+    so odd inputs and the warnings stay identical.
+    """
+    if len(short_str) == 13:
+        offset = TIMEZONE_OFFSETS.get(short_str[12])
+        second_str = short_str[10:12]
+        if offset is not None and second_str.isascii() and second_str.isdigit() and second_str < "60":
+            minute_str = short_str[:10]
+            minute = _minute_cache.get(minute_str, -1)
+            if minute == -1:
+                minute = _parse_minute(minute_str)
+                _cache_put(_minute_cache, minute_str, minute)
+            if minute is not None:
+                return minute + int(second_str) - offset
+
+    return parse_timestamp(short_str)
+
+
+def _split_value(full_value: str) -> Tuple[str, int, str]:
+    """
+    Equivalent to `MessageValue.parse`, returns the value, timestamp and timestamp string.
+    """
+    if len(full_value) >= 2 and full_value[0] == "(" and full_value[-1] == ")":
+        inner = full_value[1:-1]
+        if "(" not in inner and ")" not in inner:
+            return inner, 0, "unknown"
+
+        m = PATTERN_VALUE_TST.match(full_value)
+        if m:
+            timestamp_str = m.group(1)
+            return m.group(2), fast_parse_timestamp(timestamp_str), timestamp_str
+
+    return full_value, 0, "unknown"
+
+
+def _cache_put(cache: dict, key, value):
+    if len(cache) >= VALUE_CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+
+
+def _prints_warning(timestamp: int, timestamp_str: str) -> bool:
+    # results that printed a timestamp warning are not cached, so the warning is repeated just like the reference
+    return timestamp == 0 and timestamp_str != "unknown"
+
+
+def _needs_split(full_value: str) -> bool:
+    # a value with a timestamp that is not known to parse without a warning
+    return ")(" in full_value and full_value not in _peak_cache and full_value not in _gas_cache
+
+
+def _lookup_split(full_value: str, split: Dict[str, tuple]) -> Tuple[str, int, str]:
+    # values that are not in `split` don't print a warning, so they can be split again
+    return split.get(full_value) or _split_value(full_value)
+
+
+def _decode_power(full_value: Optional[str], split: Dict[str, tuple]) -> float:
+    if full_value is None:
+        return math.nan
+
+    power = _power_cache.get(full_value)
+    if power is None:
+        m = PATTERN_FULL_KWH.fullmatch(full_value)
+        if m:
+            power = float(m.group(1)) * 1000
+        else:
+            power = parse_power(_lookup_split(full_value, split)[0])
+        _cache_put(_power_cache, full_value, power)
+
+    return power
+
+
+def _decode_with_timestamp(full_value: Optional[str], split: Dict[str, tuple], cache: dict, parse_value):
+    if full_value is None:
+        return math.nan, None, "unknown"
+
+    result = cache.get(full_value)
+    if result is None:
+        value, timestamp, timestamp_str = _lookup_split(full_value, split)
+        result = parse_value(value), timestamp, timestamp_str
+        if _prints_warning(timestamp, timestamp_str):
+            return result
+        _cache_put(cache, full_value, result)
+
+    return result
+
+
+def build_message(values: Dict[str, str], split: Optional[Dict[str, tuple]] = None) -> MeterMessage:
+    """
+    Build a message from a map of OBIS keys to full values, only decoding the keys we need.
+    `split` holds the values with a timestamp that were already split while reading the lines.
+    """
+    if split is None:
+        # `RawMessage` parses the timestamps of all values in line order, before `MeterMessage.from_raw` parses the
+        # telegram timestamp, so they are split first to print the same warnings in the same order
+        # (`_needs_split` inlined, this runs for every value)
+        split = {
+            v: _split_value(v) for v in values.values()
+            if ")(" in v and v not in _peak_cache and v not in _gas_cache
+        }
+
+    timestamp_value = values.get(KEY_TIMESTAMP)
+    if timestamp_value is not None:
+        m = PATTERN_FULL_SINGLE.fullmatch(timestamp_value)
+        timestamp_str = m.group(1) if m else _lookup_split(timestamp_value, split)[0]
+        timestamp = fast_parse_timestamp(timestamp_str)
+    else:
+        timestamp_str = "unknown"
+        timestamp = None
+
+    # the common case where all values are already cached is handled inline
+    get = values.get
+    powers = [_power_cache.get(full_value) for full_value in map(get, POWER_KEYS)]
+    if None in powers:
+        powers = [_decode_power(full_value, split) for full_value in map(get, POWER_KEYS)]
+
+    peak_value = get(KEY_PEAK_POWER)
+    peak = _peak_cache.get(peak_value) or _decode_with_timestamp(peak_value, split, _peak_cache, parse_power)
+    gas_value = get(KEY_GAS)
+    gas = _gas_cache.get(gas_value) or _decode_with_timestamp(gas_value, split, _gas_cache, parse_volume)
+
+    return MeterMessage(timestamp, timestamp_str, *powers, *peak, *gas)
+
+
+def parse_telegram_lines(lines: List[str]) -> Optional[MeterMessage]:
+    """
+    Parse the stripped lines of a single telegram, returns None if the telegram is not clean.
+    Prints the same warnings as `RawMessage`.
+    """
+    is_clean = True
+    values = {}
+    split = {}
+
+    for line in lines:
+        if line.startswith("!"):
+            break
+
+        key, sep, rest = line.partition("(")
+        if key in _valid_keys:
+            full_value = sep + rest
+        else:
+            m = PATTERN_ITEM.match(line)
+            if not m:
+                print(f"WARNING: failed to match '{line}'")
+                is_clean = False
+                continue
+
+            key, full_value = m.group(1), m.group(2)
+            if full_value.startswith("("):
+                _valid_keys.add(key)
+
+        if _needs_split(full_value):
+            split[full_value] = _split_value(full_value)
+
+        if key in values:
+            print(f"WARNING: overriding key '{key}'")
+            is_clean = False
+        values[key] = full_value
+
+    if not is_clean:
+        return None
+    return build_message(values, split)
+
+
+def parse_telegram(block: str) -> Optional[MeterMessage]:
+    """
+    Parse the text of a single telegram between two blank lines, returns None if the telegram is not clean.
+    All lines are matched with a single regex pass, unclean telegrams go through `parse_telegram_lines` to get the
+    exact same warnings as the reference parser.
+    """
+    # only the common case of an end line without leading whitespace is handled here,
+    # anything else fails the line count check below
+    end = block.find("\n!")
+    body = block[:end] if end != -1 else block
+
+    line_count = body.count("\n") + 1
+    items = PATTERN_BLOCK_ITEM.findall(body)
+    if len(items) == line_count:
+        values = dict(items)
+        if len(values) == line_count:
+            return build_message(values)
+
+    return parse_telegram_lines([line.strip() for line in block.split("\n")])
+
+
+def iter_telegrams(text: str) -> Iterator[MeterMessage]:
+    """
+    Parse all clean telegrams in a buffer, equivalent to pushing each line through `Parser`.
+    Just like `Parser`, the text before the first blank line and after the last blank line is skipped.
+    """
+    blocks = PATTERN_BLANK_LINES.split("\n" + text)
+    for block in blocks[1:-1]:
+        if block:
+            msg = parse_telegram(block)
+            if msg is not None:
+                yield msg
+
+
+class FastParser:
+    """
+    Drop-in replacement for `Parser` that directly returns clean `MeterMessage`s instead of `RawMessage`s.
+    """
+
+    def __init__(self):
+        self.wait_for_sync = True
+        self.lines = []
+
+    def reset(self):
+        self.wait_for_sync = True
+        self.lines = []
+
+    def push_line(self, line: str) -> Optional[MeterMessage]:
+        line = line.strip()
+
+        if len(line) == 0:
+            self.wait_for_sync = False
+            if len(self.lines) > 0:
+                lines = self.lines
+                self.lines = []
+                return parse_telegram_lines(lines)
+        else:
+            if not self.wait_for_sync:
+                self.lines.append(line)
+
+        return None
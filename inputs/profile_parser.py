@@ -1,43 +1,73 @@
+import argparse
+import math
 import time
 
-from parse import Parser
+from inputs.fast_parse import FastParser, iter_telegrams
+from inputs.parse import Parser, MeterMessage
 
 
-def main():
-    path = "log.txt"
+def read_reference(lines):
     parser = Parser()
+    for line in lines:
+        raw_msg = parser.push_line(line)
+        if raw_msg is not None and raw_msg.is_clean:
+            yield MeterMessage.from_raw(raw_msg)
+
 
-    count = 0
-    start = time.perf_counter()
-    prev = start
+def read_fast(lines):
+    parser = FastParser()
+    for line in lines:
+        msg = parser.push_line(line)
+        if msg is not None:
+            yield msg
 
-    with (open(path, "r") as f):
-        while True:
-            line = f.readline()
-            if len(line) == 0:
-                break
 
-            raw_msg = parser.push_line(line)
-            if raw_msg is not None and raw_msg.is_clean:
-                count += 1
+def read_fast_buffer(lines):
+    return iter_telegrams("".join(lines))
 
-                if count % 1000 == 0:
-                    now = time.perf_counter()
-                    print(f"Messages/s: {1000/(now-prev):.2f}")
-                    prev = now
 
-                # if count > 20e3:
-                #     break
+def same_message(a: MeterMessage, b: MeterMessage) -> bool:
+    for x, y in zip(a.__dict__.values(), b.__dict__.values()):
+        if isinstance(x, float) and isinstance(y, float) and math.isnan(x) and math.isnan(y):
+            continue
+        if x != y:
+            return False
+    return True
 
-        byte_count = f.tell()
-    delta = time.perf_counter() - start
 
-    print(f"Total messages: {count}")
+def main():
+    parser = argparse.ArgumentParser(prog="profile_parser")
+    parser.add_argument("path_log", nargs="?", default="log.txt")
+    args = parser.parse_args()
+
+    with open(args.path_log, "r") as f:
+        lines = f.readlines()
+    byte_count = sum(len(line) for line in lines)
     print(f"Total bytes: {byte_count}")
-    print(f"Bytes/message: {byte_count/count:.2f}")
-    print(f"Time: {delta:.2f}")
-    print(f"Messages/s: {count/delta:.2f}")
-    print(f"Bytes/s: {byte_count/delta:.2f}")
+
+    results = {}
+    engines = [("reference", read_reference), ("fast-lines", read_fast), ("fast-buffer", read_fast_buffer)]
+    for name, read in engines:
+        start = time.perf_counter()
+        messages = list(read(lines))
+        delta = time.perf_counter() - start
+        results[name] = (messages, delta)
+
+        count = len(messages)
+        print(f"{name}:")
+        print(f"  Total messages: {count}")
+        print(f"  Bytes/message: {byte_count / max(count, 1):.2f}")
+        print(f"  Time: {delta:.2f}")
+        print(f"  Messages/s: {count / delta:.2f}")
+        print(f"  Bytes/s: {byte_count / delta:.2f}")
+
+    reference, reference_time = results["reference"]
+    for name, (messages, delta) in results.items():
+        if name == "reference":
+            continue
+        mismatches = sum(not same_message(a, b) for a, b in zip(reference, messages))
+        mismatches += abs(len(reference) - len(messages))
+        print(f"{name}: speedup {reference_time / delta:.2f}x, {mismatches} mismatches")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import argparse
+import os
+import time
+from threading import Thread
+
+import serial
+
+from inputs.serial_frames import run_telegram_reader
+
+
+def replay_file(path: str, chunk_size: int):
+    f = open(path, "rb")
+
+    def read_chunk():
+        data = f.read(chunk_size)
+        return data if len(data) > 0 else None
+
+    return read_chunk
+
+
+def replay_pty(path: str, chunk_size: int):
+    """
+    Write the log into a pseudo terminal and read it back through pyserial, just like the real serial port.
+    """
+    master, slave = os.openpty()
+    port = serial.Serial(os.ttyname(slave), baudrate=115200, timeout=1)
+    done = False
+
+    def write():
+        nonlocal done
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if len(data) == 0:
+                    break
+                os.write(master, data)
+        done = True
+
+    Thread(target=write, daemon=True).start()
+
+    def read_chunk():
+        data = port.read(1)
+        if len(data) > 0 and port.in_waiting > 0:
+            data += port.read(port.in_waiting)
+        if len(data) == 0 and done:
+            return None
+        return data
+
+    return read_chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_serial")
+    parser.add_argument("path_log", nargs="?", default="log.txt")
+    parser.add_argument("--pty", action="store_true", help="replay through a pseudo terminal instead of directly")
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    if args.pty:
+        read_chunk = replay_pty(args.path_log, args.chunk_size)
+    else:
+        read_chunk = replay_file(args.path_log, args.chunk_size)
+
+    count = 0
+
+    def on_message(_):
+        nonlocal count
+        count += 1
+
+    start = time.perf_counter()
+    stats = run_telegram_reader(read_chunk, on_message)
+    delta = time.perf_counter() - start
+
+    print(f"Messages: {count}")
+    print(f"Frames/s: {stats.frames / delta:.2f}")
+    print(stats.take_summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from inputs.fast_parse import parse_telegram
+from inputs.parse import MeterMessage
+from server import metrics
+
+# maximum size of a single telegram, anything longer is considered garbage
+MAX_FRAME_SIZE = 16 * 1024
+STATS_PERIOD = 60
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data) -> int:
+    """
+    The CRC16 used by DSMR telegrams (CRC-16/ARC), computed over everything from '/' up to and including '!'.
+    """
+    crc = 0
+    for b in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+
+class FrameStats:
+    def __init__(self):
+        self.frames = 0
+        self.crc_failures = 0
+        self.resyncs = 0
+        self.invalid = 0
+
+        self.prev_time = time.perf_counter()
+        self.prev_frames = 0
+
+    def take_summary(self) -> str:
+        now = time.perf_counter()
+        rate = (self.frames - self.prev_frames) / max(now - self.prev_time, 1e-9)
+        self.prev_time = now
+        self.prev_frames = self.frames
+
+        return (
+            f"Serial stats: {rate:.2f} frames/s, {self.frames} frames, {self.crc_failures} CRC failures, "
+            f"{self.resyncs} resyncs, {self.invalid} invalid"
+        )
+
+
+class TelegramFramer:
+    """
+    Split a raw serial byte stream into complete `/ ... !CRC` telegrams, dropping the ones with a wrong CRC.
+    Telegrams without a CRC (older DSMR versions only send '!') are passed through unchecked.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.stats = FrameStats()
+
+    def reset(self):
+        if len(self.buffer.strip()) > 0:
+            self.stats.resyncs += 1
+        self.buffer.clear()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        Append `data` to the buffer and return the complete, valid frames in it.
+        """
+        buffer = self.buffer
+        buffer += data
+
+        frames = []
+        # always at the start of a line
+        pos = 0
+
+        while True:
+            # telegrams start with a '/' line and end with a '!' line
+            if buffer.startswith(b"/", pos):
+                start = pos
+            else:
+                start = buffer.find(b"\n/", pos)
+                start = start + 1 if start != -1 else -1
+
+            if start == -1:
+                # drop all complete lines, the last partial line might still become a header
+                line_start = buffer.rfind(b"\n", pos) + 1
+                if len(buffer) - line_start > MAX_FRAME_SIZE:
+                    line_start = len(buffer)
+                if line_start > pos:
+                    self._skip(buffer, pos, line_start)
+                    pos = line_start
+                break
+            self._skip(buffer, pos, start)
+
+            end = buffer.find(b"\n!", start)
+            end = end + 1 if end != -1 else -1
+
+            # a new header before the end means the previous telegram was cut off
+            restart = buffer.find(b"\n/", start, end if end != -1 else len(buffer))
+            if restart != -1:
+                self.stats.resyncs += 1
+                pos = restart + 1
+                continue
+
+            newline = buffer.find(b"\n", end) if end != -1 else -1
+            if newline == -1:
+                # incomplete telegram, wait for more data unless it's getting too large to be real
+                pos = start
+                if len(buffer) - start > MAX_FRAME_SIZE:
+                    self.stats.resyncs += 1
+                    pos = buffer.rfind(b"\n") + 1 or len(buffer)
+                break
+
+            frame = bytes(buffer[start:end + 1])
+            crc_str = bytes(buffer[end + 1:newline]).strip()
+            pos = newline + 1
+
+            if len(crc_str) > 0 and not (len(crc_str) == 4 and _parse_hex(crc_str) == crc16(frame)):
+                self.stats.crc_failures += 1
+                continue
+
+            self.stats.frames += 1
+            frames.append(frame)
+
+        del buffer[:pos]
+        return frames
+
+    def _skip(self, buffer: bytearray, start: int, end: int):
+        # whitespace between telegrams is expected, anything else means we lost sync
+        if len(buffer[start:end].strip()) > 0:
+            self.stats.resyncs += 1
+
+
+def _parse_hex(s: bytes) -> Optional[int]:
+    try:
+        return int(s, 16)
+    except ValueError:
+        return None
+
+
+def parse_frame(frame: bytes) -> Optional[MeterMessage]:
+    """
+    Parse a complete telegram frame, returns None if it is not a clean telegram.
+    """
+    try:
+        text = frame.decode()
+    except UnicodeDecodeError:
+        return None
+
+    # skip the header line, the telegram itself is the same block `Parser` would see
+    _, _, body = text.replace("\r\n", "\n").partition("\n")
+    return parse_telegram(body.lstrip())
+
+
+class TelegramReader:
+    """
+    Turns raw chunks of serial data into messages, logging the raw data and periodically printing the stats.
+    """
+
+    def __init__(self, log=None, stats_period: float = STATS_PERIOD):
+        self.framer = TelegramFramer()
+        self.log = log
+        self.stats_period = stats_period
+        self.prev_report = time.perf_counter()
+
+    @property
+    def stats(self) -> FrameStats:
+        return self.framer.stats
+
+    def push(self, data: bytes) -> List[MeterMessage]:
+        """
+        Process a chunk of data, an empty chunk means the read timed out.
+        """
+        if len(data) == 0:
+            print("Timeout")
+            self.framer.reset()
+            return []
+
+        if self.log is not None:
+            self.log.write(data)
+
+        messages = []
+        for frame in self.framer.feed(data):
+            with metrics.PARSE_SECONDS.time():
+                msg = parse_frame(frame)
+            if msg is None:
+                self.stats.invalid += 1
+            else:
+                messages.append(msg)
+
+        now = time.perf_counter()
+        if now - self.prev_report > self.stats_period:
+            self.prev_report = now
+            print(self.stats.take_summary())
+
+        return messages
+
+
+def run_telegram_reader(
+        read_chunk: Callable[[], Optional[bytes]],
+        on_message: Callable[[MeterMessage], None],
+        log=None,
+        stats_period: float = STATS_PERIOD,
+) -> FrameStats:
+    """
+    Read chunks from `read_chunk` until it returns None, and pass every valid telegram on to `on_message`.
+    An empty chunk means the read timed out. The raw data is written to the binary file `log` if given.
+    """
+    reader = TelegramReader(log, stats_period)
+
+    while True:
+        data = read_chunk()
+        if data is None:
+            break
+        for msg in reader.push(data):
+            on_message(msg)
+
+    return reader.stats
+
+
+def _set_ready(future: asyncio.Future):
+    # the reader callback can fire again before it is removed
+    if not future.done():
+        future.set_result(None)
+
+
+async def run_telegram_reader_async(
+        port,
+        on_message: Callable[[MeterMessage], Awaitable[None]],
+        log=None,
+        timeout: float = 10,
+        stats_period: float = STATS_PERIOD,
+):
+    """
+    Asyncio version of `run_telegram_reader`, reading from a non-blocking (`timeout=0`) pyserial port.
+    The port is only read once `on_message` returns, so a slow consumer applies backpressure to the serial port.
+    """
+    loop = asyncio.get_running_loop()
+    reader = TelegramReader(log, stats_period)
+    fd = port.fileno()
+
+    while True:
+        readable = loop.create_future()
+        loop.add_reader(fd, _set_ready, readable)
+        try:
+            await asyncio.wait_for(readable, timeout)
+            data = port.read(max(port.in_waiting, 1))
+        except asyncio.TimeoutError:
+            data = b""
+        finally:
+            loop.remove_reader(fd)
+
+        for msg in reader.push(data):
+            await on_message(msg)
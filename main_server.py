@@ -1,70 +1,144 @@
+import argparse
+import asyncio
+import signal
 import time
 from queue import Queue as QQueue
 from threading import Thread
+from typing import Optional
 
 import serial
 
 from inputs.adc import ArduinoADC, ADCMessage
-from inputs.parse import Parser, MeterMessage
-from server.main import server_main
+from inputs.serial_frames import run_telegram_reader, run_telegram_reader_async
+from server import metrics
+from server.main import server_main, async_server_main, multiprocess_server_main
+from server.retention import RetentionPolicy
 
+ADC_PERIOD = 2
 
-def run_serial_parser(message_queue: QQueue, log):
-    port = serial.Serial(
-        port='/dev/ttyS0',
+
+def open_serial_port(port_path: str, timeout: float) -> serial.Serial:
+    return serial.Serial(
+        port=port_path,
         baudrate=115200,
         parity=serial.PARITY_NONE,
         stopbits=serial.STOPBITS_ONE,
         bytesize=serial.EIGHTBITS,
-        timeout=10,
+        timeout=timeout,
     )
-    parser = Parser()
 
+
+def run_serial_parser(message_queue: QQueue, log, port_path: str = "/dev/ttyS0"):
+    port = open_serial_port(port_path, timeout=10)
+
+    # block for the first byte, then take everything that has arrived since
+    def read_chunk():
+        data = port.read(1)
+        if len(data) > 0 and port.in_waiting > 0:
+            data += port.read(port.in_waiting)
+        return data
+
+    run_telegram_reader(read_chunk, message_queue.put, log)
+
+
+def log_adc_message(log, msg: ADCMessage):
+    # same format as expected by `log2db --adc-log`
+    log.write(f"{msg.timestamp},{msg.voltage_int}\n")
+
+
+def run_adc(queue: QQueue, log):
+    adc = ArduinoADC()
     while True:
-        line = port.readline()
-        if len(line) == 0:
-            print("Timeout")
-            parser.reset()
-            continue
+        time_start = time.perf_counter()
+        msg = adc.readout_message()
+        queue.put(msg)
+        log_adc_message(log, msg)
 
-        try:
-            line_str = line.decode()
-        except UnicodeDecodeError:
-            print("Unicode decode error")
-            parser.reset()
-            continue
+        delta = ADC_PERIOD - (time.perf_counter() - time_start)
+        if delta > 0:
+            time.sleep(delta)
 
-        if log is not None:
-            log.write(line_str)
 
-        raw_msg = parser.push_line(line_str)
+async def run_adc_async(put, log):
+    # the readout itself is a blocking sequence of GPIO toggles, so it runs on the default executor
+    loop = asyncio.get_running_loop()
+    adc = ArduinoADC()
+    while True:
+        time_start = loop.time()
+        msg = await loop.run_in_executor(None, adc.readout_message)
+        await put(msg)
+        log_adc_message(log, msg)
 
-        if raw_msg is not None and raw_msg.is_clean:
-            msg = MeterMessage.from_raw(raw_msg)
-            message_queue.put(msg)
+        await asyncio.sleep(max(0.0, ADC_PERIOD - (loop.time() - time_start)))
 
 
-def main():
+def main_threads(retention: Optional[RetentionPolicy], processes: bool):
     def main_serial(queue):
-        with open("log.txt", "a") as log:
+        with open("log.txt", "ab") as log:
             run_serial_parser(queue, log)
 
     def main_adc(queue):
-        adc = ArduinoADC()
-        adc_period = 2
-        while True:
-            time_start = time.perf_counter()
-            msg = adc.readout_message()
-            queue.put(msg)
-
-            delta = adc_period - (time.perf_counter() - time_start)
-            if delta > 0:
-                time.sleep(delta)
+        with open("log_adc.txt", "a") as log:
+            run_adc(queue, log)
 
     message_queue = QQueue()
     Thread(target=main_serial, args=(message_queue,)).start()
     Thread(target=main_adc, args=(message_queue,)).start()
-    server_main("data.db", message_queue)
+    if processes:
+        multiprocess_server_main("data.db", message_queue, retention=retention)
+    else:
+        server_main("data.db", message_queue, retention=retention)
+
+
+async def main_async(retention: Optional[RetentionPolicy]):
+    async def serial_source(put):
+        with open("log.txt", "ab") as log:
+            await run_telegram_reader_async(open_serial_port("/dev/ttyS0", timeout=0), put, log)
+
+    async def adc_source(put):
+        with open("log_adc.txt", "a") as log:
+            await run_adc_async(put, log)
+
+    await async_server_main("data.db", [serial_source, adc_source], retention=retention)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="main_server")
+    parser.add_argument(
+        "--asyncio", action="store_true",
+        help="run ingestion, processing and the websocket server on a single event loop instead of threads"
+    )
+    parser.add_argument(
+        "--processes", action="store_true",
+        help="serve the websockets and the web pages from separate processes that follow the tracker through "
+             "shared memory, so they never delay reading the serial port"
+    )
+    parser.add_argument(
+        "--raw-days", type=int,
+        help="only keep this many days of raw samples, older data is only kept in the rollups"
+    )
+    parser.add_argument(
+        "--archive", action="store_true",
+        help="with --raw-days, move old raw samples to monthly partition files instead of deleting them"
+    )
+    parser.add_argument(
+        "--metrics", action="store_true",
+        help="record timings of the processing stages, served in the Prometheus text format on /metrics"
+    )
+    args = parser.parse_args()
+    if args.asyncio and args.processes:
+        parser.error("--processes only works with the threads runtime")
+    if args.metrics:
+        metrics.enable()
+    retention = RetentionPolicy(args.raw_days, args.archive) if args.raw_days is not None else None
+
+    # stop on SIGTERM just like on ctrl+C, so the tracker snapshot gets saved
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.asyncio:
+        asyncio.run(main_async(retention))
+    else:
+        main_threads(retention, args.processes)
 
 
 if __name__ == '__main__':
@@ -91,6 +91,7 @@ class Series {
     constructor() {
         this.window_size = 0
         this.bucket_size = 0
+        this.aggregation = "mean"
         this.unit_label = ""
         this.kind = ""
         this.hline_values = null
@@ -109,17 +110,35 @@ class Series {
 
         this.window_size = series_data["window_size"];
         this.bucket_size = series_data["bucket_size"];
+        this.aggregation = series_data["aggregation"] ?? "mean";
         this.unit_label = series_data["unit_label"];
         this.kind = series_data["kind"];
         this.hline_values = series_data["hline_values"];
 
+        // the points picked by lttb can be up to two buckets apart without a gap in between
+        const pad_step = this.aggregation === "lttb" ? 2 * this.bucket_size : this.bucket_size;
+
         // append data to state
         for (let i = 0; i < series_data["timestamps"].length; i++) {
             let ts_int = series_data["timestamps"][i];
 
+            // skip buckets we already have, the server can resend some after a reconnect
+            if (ts_int <= this.last_timestamp_int) {
+                continue;
+            }
+
+            // start over after a gap longer than the window instead of padding it, the old data would be dropped anyway
+            if (this.window_size !== null && this.last_timestamp_int !== 0 && ts_int - this.last_timestamp_int >= this.window_size) {
+                timestamps.length = 0;
+                for (let values of Object.values(all_values)) {
+                    values.length = 0;
+                }
+                this.last_timestamp_int = 0;
+            }
+
             // add padding values if necessary
             if (this.bucket_size !== null && this.last_timestamp_int !== 0) {
-                for (let j = this.last_timestamp_int + this.bucket_size; j < ts_int; j += this.bucket_size) {
+                for (let j = this.last_timestamp_int + pad_step; j < ts_int; j += pad_step) {
                     timestamps.push(new Date(j * 1000));
                     for (let values of Object.values(all_values)) {
                         values.push(NaN);
@@ -162,6 +181,42 @@ class Series {
         }
     }
 
+    // plain object that can be stored as json, NaN values become null
+    to_cache() {
+        return {
+            window_size: this.window_size,
+            bucket_size: this.bucket_size,
+            aggregation: this.aggregation,
+            unit_label: this.unit_label,
+            kind: this.kind,
+            hline_values: this.hline_values,
+            timestamps: this.timestamps.map(date => date.getTime()),
+            all_values: this.all_values,
+        }
+    }
+
+    static from_cache(cached) {
+        let series = new Series();
+        series.window_size = cached.window_size;
+        series.bucket_size = cached.bucket_size;
+        series.aggregation = cached.aggregation;
+        series.unit_label = cached.unit_label;
+        series.kind = cached.kind;
+        series.hline_values = cached.hline_values;
+
+        series.timestamps = cached.timestamps.map(ms => new Date(ms));
+        for (const [key, values] of Object.entries(cached.all_values)) {
+            series.all_values[key] = values.map(value => value ?? NaN);
+        }
+
+        // padding is only ever added before real values, so the last timestamp is a real one
+        if (series.timestamps.length > 0) {
+            series.last_timestamp_date = series.timestamps[series.timestamps.length - 1];
+            series.last_timestamp_int = series.last_timestamp_date.getTime() / 1000;
+        }
+        return series;
+    }
+
     plot_obj(plot_style, interactive = false) {
         // data
         let data = []
@@ -260,10 +315,44 @@ class Series {
 class MultiSeries {
     constructor() {
         this.all_series = {}
+        // the layout of the series on the server, only needed to resume after a reconnect
+        this.layout = null
     }
 
     clear() {
         this.all_series = {}
+        this.layout = null
+    }
+
+    // the query parameters that let the server send only what we're missing, see `parse_resume` in server/socket_server.py
+    resume_query() {
+        if (this.layout === null) {
+            return "";
+        }
+        let since = [];
+        for (const [key, series] of Object.entries(this.all_series)) {
+            if (series.last_timestamp_int !== 0) {
+                since.push(key + ":" + series.last_timestamp_int);
+            }
+        }
+        return "&layout=" + encodeURIComponent(this.layout) + "&since=" + encodeURIComponent(since.join(","));
+    }
+
+    to_cache() {
+        let all_series = {};
+        for (const [key, series] of Object.entries(this.all_series)) {
+            all_series[key] = series.to_cache();
+        }
+        return {layout: this.layout, all_series: all_series};
+    }
+
+    static from_cache(cached) {
+        let multi_series = new MultiSeries();
+        multi_series.layout = cached.layout;
+        for (const [key, series] of Object.entries(cached.all_series)) {
+            multi_series.all_series[key] = Series.from_cache(series);
+        }
+        return multi_series;
     }
 
     push_update(all_series_data) {
@@ -275,3 +364,71 @@ class MultiSeries {
         }
     }
 }
+
+const BINARY_MESSAGE_TYPES = ["initial", "update", "download", "resume"]
+
+function pad8(offset) {
+    return offset + ((8 - offset % 8) % 8)
+}
+
+// Decode a message in the binary wire format, see `MultiSeries.to_binary` in server/data.py for the layout.
+// Returns the same structure as the json messages, with typed arrays instead of lists.
+function decode_binary_message(buffer) {
+    const view = new DataView(buffer)
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4))
+    if (magic !== "DMB1") {
+        console.log("Invalid binary message magic", magic)
+        return undefined
+    }
+
+    const type = BINARY_MESSAGE_TYPES[view.getUint8(4)]
+    const series_count = view.getUint16(6, true)
+    const decoder = new TextDecoder()
+
+    let series = {}
+    let offset = 8
+
+    for (let s = 0; s < series_count; s++) {
+        const header_length = view.getUint32(offset, true)
+        const count = view.getUint32(offset + 4, true)
+        const column_count = view.getUint16(offset + 8, true)
+        const value_bytes = view.getUint8(offset + 10)
+        const step = view.getInt32(offset + 12, true)
+        const first_timestamp = Number(view.getBigInt64(offset + 16, true))
+        offset += 24
+
+        let series_data = JSON.parse(decoder.decode(new Uint8Array(buffer, offset, header_length)))
+        offset = pad8(offset + header_length)
+
+        const timestamps = new Float64Array(count)
+        if (step !== 0) {
+            for (let i = 0; i < count; i++) {
+                timestamps[i] = first_timestamp + i * step
+            }
+        } else {
+            const deltas = new Int32Array(buffer, offset, count)
+            let timestamp = first_timestamp
+            for (let i = 0; i < count; i++) {
+                timestamp += deltas[i]
+                timestamps[i] = timestamp
+            }
+            offset = pad8(offset + 4 * count)
+        }
+
+        let values = []
+        for (let c = 0; c < column_count; c++) {
+            if (value_bytes === 4) {
+                values.push(new Float32Array(buffer, offset, count))
+            } else {
+                values.push(new Float64Array(buffer, offset, count))
+            }
+            offset = pad8(offset + value_bytes * count)
+        }
+
+        series_data["timestamps"] = timestamps
+        series_data["values"] = values
+        series[series_data["key"]] = series_data
+    }
+
+    return {type: type, series: series}
+}
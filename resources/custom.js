@@ -1,3 +1,16 @@
+// keep in sync with `Aggregation` in server/kinds.py
+const POINTS_PER_BUCKET = {"mean": 1, "min-max": 2, "m4": 4, "lttb": 1}
+const NICE_BUCKET_SIZES = [5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 4 * 3600, 12 * 3600, 24 * 3600]
+const PREVIEW_POINTS_PER_PIXEL = 4
+
+// The smallest nice bucket size for which a preview of `delta_sec` has at most a few points per pixel.
+function preview_bucket_size(delta_sec, width, aggregation) {
+    const points_per_bucket = POINTS_PER_BUCKET[aggregation]
+    const target = delta_sec * points_per_bucket / (PREVIEW_POINTS_PER_PIXEL * Math.max(width, 100))
+    const nice = NICE_BUCKET_SIZES.find(size => size >= target)
+    return nice ?? Math.ceil(target / (24 * 3600)) * 24 * 3600
+}
+
 class State {
     constructor() {
         this.plot = document.getElementById("plot")
@@ -16,8 +29,12 @@ class State {
         this.input_resolution = document.getElementById("input_res")
         this.input_format = new RadioGroup("input_format", getCookie("download_format", "csv"))
         this.input_quantity = new RadioGroup("input_quantity", "power")
+        this.input_aggregation = new RadioGroup("input_aggregation", "mean")
         this.output_expected_samples = document.getElementById("output_expected_samples")
-        let input_elements = [this.input_start, this.input_end, this.input_resolution, this.input_format, this.input_quantity];
+        let input_elements = [
+            this.input_start, this.input_end, this.input_resolution, this.input_format, this.input_quantity,
+            this.input_aggregation,
+        ];
 
         this.previews_running = 0
         this.spinner = document.getElementById("spinner")
@@ -67,7 +84,7 @@ class State {
                 // approximate seconds between gas samples
                 samples = delta_sec / 300;
             } else {
-                samples = delta_sec / this.input_resolution.value;
+                samples = delta_sec / this.input_resolution.value * POINTS_PER_BUCKET[this.input_aggregation.value];
             }
 
             this.output_expected_samples.innerText = Math.ceil(samples).toString()
@@ -81,7 +98,7 @@ class State {
 
     preview() {
         console.log("Preview")
-        let url = this.download_url_for_inputs("json")
+        let url = this.download_url_for_inputs("bin")
         if (url === undefined) return
 
         this.previews_running++;
@@ -90,8 +107,9 @@ class State {
         // TODO proper error handling
         window
             .fetch(url)
-            .then((response) => response.json())
-            .then((data) => {
+            .then((response) => response.arrayBuffer())
+            .then((buffer) => {
+                let data = decode_binary_message(buffer).series["download"]
                 console.log("Preview data received")
 
                 this.previews_running--;
@@ -137,6 +155,15 @@ class State {
             param_dict.format = this.input_format.value
         }
 
+        const aggregation = this.input_aggregation.value
+        if (!is_gas && aggregation !== "mean") {
+            param_dict.aggregation = aggregation
+            // previews only need a few points per pixel, the download itself uses the chosen resolution
+            if (type === "bin") {
+                param_dict.bucket_size = preview_bucket_size(end - start, this.plot.clientWidth, aggregation)
+            }
+        }
+
         // noinspection JSCheckFunctionSignatures
         let params = new URLSearchParams(param_dict)
         return "../download/samples_custom." + type + "?" + params
@@ -1,6 +1,26 @@
+// the series to subscribe to, for example `index.html?series=minute,power:60:7200`, all default series if missing
+const SERIES_PARAM = new URLSearchParams(location.search).get("series")
+
+// the series are kept in localStorage across reloads, so reconnecting only needs the buckets we missed
+const CACHE_KEY = "series_cache_v1" + (SERIES_PARAM === null ? "" : "_" + SERIES_PARAM)
+const CACHE_SAVE_PERIOD = 60 * 1000
+
+function load_cache() {
+    try {
+        let cached = localStorage.getItem(CACHE_KEY);
+        if (cached !== null) {
+            return MultiSeries.from_cache(JSON.parse(cached));
+        }
+    } catch (e) {
+        console.log("Failed to load cached series", e);
+    }
+    return new MultiSeries();
+}
+
 class State {
     constructor() {
-        this.multi_series = new MultiSeries()
+        this.multi_series = load_cache()
+        this.prev_cache_save = Date.now()
 
         this.plot_style = new PlotStyle(
             document.getElementById("radio_split"),
@@ -12,6 +32,22 @@ class State {
         this.socket = null;
         this.timeout = null;
         this.reset_socket()
+
+        // show the cached series right away
+        update_plots(this.multi_series, this.plot_style)
+        document.addEventListener("visibilitychange", () => {
+            if (document.visibilityState === "hidden") this.save_cache()
+        });
+        window.addEventListener("pagehide", () => this.save_cache());
+    }
+
+    save_cache() {
+        this.prev_cache_save = Date.now();
+        try {
+            localStorage.setItem(CACHE_KEY, JSON.stringify(this.multi_series.to_cache()));
+        } catch (e) {
+            console.log("Failed to save cached series", e);
+        }
     }
 
     reset_socket() {
@@ -21,7 +57,12 @@ class State {
         }
 
         console.log("Creating new socket")
-        this.socket = new WebSocket("ws://" + location.hostname + ":8001");
+        let url = "ws://" + location.hostname + ":8001/?format=binary" + this.multi_series.resume_query();
+        if (SERIES_PARAM !== null) {
+            url += "&series=" + encodeURIComponent(SERIES_PARAM);
+        }
+        this.socket = new WebSocket(url);
+        this.socket.binaryType = "arraybuffer";
         this.socket.addEventListener("message", message => this.on_message(message));
 
         this.reset_timeout()
@@ -41,12 +82,22 @@ class State {
 
     on_message(message) {
         this.reset_timeout();
-        console.log("Received message '" + message.data + "'");
-        let should_update = on_message(this.multi_series, message.data)
+        let msg_json;
+        if (message.data instanceof ArrayBuffer) {
+            console.log("Received binary message of " + message.data.byteLength + " bytes");
+            msg_json = decode_binary_message(message.data);
+        } else {
+            console.log("Received message '" + message.data + "'");
+            msg_json = JSON.parse(message.data);
+        }
+        let should_update = on_message(this.multi_series, msg_json)
 
         if (should_update) {
             update_plots(this.multi_series, this.plot_style)
         }
+        if (Date.now() - this.prev_cache_save > CACHE_SAVE_PERIOD) {
+            this.save_cache()
+        }
     }
 
     on_plot_style_changed() {
@@ -60,15 +111,21 @@ window.addEventListener("DOMContentLoaded", () => {
     state = new State();
 });
 
-function on_message(multi_series, msg_str) {
-    let msg_json = JSON.parse(msg_str);
+function on_message(multi_series, msg_json) {
+    if (msg_json === undefined) return false;
     let msg_type = msg_json["type"];
 
-    if (msg_type === "initial" || msg_type === "update") {
+    if (msg_type === "initial" || msg_type === "update" || msg_type === "resume") {
         if (msg_type === "initial") {
             multi_series.clear();
+            // every series carries the layout, any of them will do
+            for (const series_data of Object.values(msg_json["series"])) {
+                multi_series.layout = series_data["layout"] ?? null;
+            }
         }
 
+        // a resume only contains the buckets we're missing, so it's applied just like an update
+
         // store the data
         multi_series.push_update(msg_json["series"]);
         return true;
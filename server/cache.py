@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional, Tuple
+
+from server.data import Database, Series, Buckets
+from server.kinds import SeriesKind
+
+
+@dataclass
+class CacheEntry:
+    # only the buckets before `closed_until`, which can no longer change
+    series: Series
+    closed_until: int
+
+    def size_bytes(self) -> int:
+        return len(self.series) * 8 * (1 + len(self.series.kind.value.columns))
+
+
+def closed_until(bucket_size: Optional[int], oldest: int, newest: int, latest: Optional[int]) -> int:
+    """
+    The end of the last bucket in `oldest..newest` that is closed, assuming `latest` is the newest sample.
+    The bucket containing `latest` itself is still open, newer samples might still be added to it.
+    """
+    if latest is None:
+        return oldest
+    if bucket_size is None:
+        end = latest
+    else:
+        end = latest // bucket_size * bucket_size
+    return max(oldest, min(newest, end))
+
+
+class SeriesCache:
+    """
+    LRU cache for bounded `fetch_series_items` requests, bounded by the total size of the cached items.
+
+    Only buckets that are entirely in the past are cached, the open tail of a request is fetched again each time.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        self.lock = Lock()
+        self.entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+
+    def fetch(
+            self, database: Database, kind: SeriesKind, bucket_size: Optional[int], oldest: int, newest: int
+    ) -> Tuple[Series, bool]:
+        """
+        Fetch the series for the given range, returns the series and whether the entire range was closed.
+        """
+        key = (kind, bucket_size, oldest, newest)
+        buckets = Buckets(None, bucket_size)
+        closed = closed_until(bucket_size, oldest, newest, database.last_timestamp(kind.value.table))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            elif entry.closed_until < closed:
+                self.partial_hits += 1
+                self.entries.move_to_end(key)
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+
+        if entry is None or entry.closed_until < closed:
+            if entry is None:
+                closed_series = Series.empty(kind, buckets)
+                closed_start = oldest
+            else:
+                closed_series = entry.series.clone()
+                closed_start = entry.closed_until
+
+            if closed_start < closed:
+                items = database.fetch_series_items(kind, bucket_size, closed_start, closed)
+                closed_series.extend_series(Series.from_cursor(kind, buckets, items))
+
+            entry = CacheEntry(closed_series, closed)
+            self._put(key, entry)
+
+        result = entry.series.clone()
+        if entry.closed_until < newest:
+            items = database.fetch_series_items(kind, bucket_size, entry.closed_until, newest)
+            result.extend_series(Series.from_cursor(kind, buckets, items))
+
+        return result, entry.closed_until >= newest
+
+    def _put(self, key: tuple, entry: CacheEntry):
+        with self.lock:
+            prev = self.entries.pop(key, None)
+            if prev is not None:
+                self.total_bytes -= prev.size_bytes()
+
+            if entry.size_bytes() > self.max_bytes:
+                return
+
+            self.entries[key] = entry
+            self.total_bytes += entry.size_bytes()
+
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size_bytes()
+
+    def stats_str(self) -> str:
+        return (
+            f"{self.hits} hits, {self.partial_hits} partial hits, {self.misses} misses, "
+            f"{len(self.entries)} entries using {self.total_bytes / 1024:.2f} kB"
+        )
@@ -1,100 +1,148 @@
+import asyncio
+import bisect
 import enum
+import os
 import sqlite3
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from threading import Lock
-from typing import List, Dict, Optional, Set, Union
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from janus import Queue as JQueue
+import numpy as np
+import simplejson
 
 from inputs.adc import ADCMessage
 from inputs.parse import MeterMessage
+from server.downsample import downsample, source_resolution, sub_buckets
+from server import metrics
+from server.kinds import Aggregation, SeriesKind, water_height, water_volume
+from server.retention import RETENTION_BUDGET, RETENTION_PERIOD, ChainedCursor, Retention, RetentionPolicy, next_month
+from server.rollup import ROLLUP_RESOLUTIONS, Rollups, rollup_averages, rollup_counts, rollup_extremes, rollup_table
 
 Message = Union[MeterMessage, ADCMessage]
 
-
-@dataclass
-class SeriesKindInfo:
-    name: str
-    table: str
-    columns: List[str]
-    unit_label: str
-    hline_values: List[float]
-
-
-WATER_HEIGHT_BASE = 1.733
-WATER_HEIGHT_MAX = 1.98
-WATER_AREA_BASE = 7500 / WATER_HEIGHT_BASE
-WATER_AREA_TOP = 360
-
-WATER_HEIGHT_EXPR = "(voltage_int / 1023.0 * 5.0 - 0.5) / 4.0 * 5.0"
-WATER_VOLUME_EXPR = f"min({WATER_HEIGHT_EXPR} * {WATER_AREA_BASE}, {WATER_HEIGHT_BASE * WATER_AREA_BASE} + ({WATER_HEIGHT_EXPR} - {WATER_HEIGHT_BASE}) * {WATER_AREA_TOP})"
-
-
-class SeriesKind(enum.Enum):
-    POWER = SeriesKindInfo(
-        name="power",
-        table="meter_samples",
-        columns=["instant_power_1", "instant_power_2", "instant_power_3"],
-        unit_label="power P (W)",
-        hline_values=[],
-    )
-    GAS = SeriesKindInfo(
-        name="gas",
-        table="gas_samples",
-        columns=["volume"],
-        unit_label="gas volume (m^3)",
-        hline_values=[],
-    )
-    WATER_HEIGHT = SeriesKindInfo(
-        name="water-height",
-        table="water_height_samples",
-        columns=[WATER_HEIGHT_EXPR],
-        unit_label="water height (m)",
-        hline_values=[WATER_HEIGHT_BASE, WATER_HEIGHT_MAX],
-    )
-    WATER_VOLUME = SeriesKindInfo(
-        name="water-volume",
-        table="water_height_samples",
-        columns=[WATER_VOLUME_EXPR],
-        unit_label="water volume (l)",
-        hline_values=[
-            WATER_HEIGHT_BASE * WATER_AREA_BASE,
-            WATER_HEIGHT_BASE * WATER_AREA_BASE + (WATER_HEIGHT_MAX - WATER_HEIGHT_BASE) * WATER_AREA_TOP
-        ],
-    )
-
-
-def build_where_clause(oldest: Optional[int], newest: Optional[int]) -> str:
+# number of pending updates after which a websocket client is resynced with a fresh snapshot
+MAX_PENDING_UPDATES = 64
+
+# maximum number of points in a custom websocket channel
+MAX_CHANNEL_POINTS = 10 * 1000
+
+# seconds between periodic tracker snapshots, bump the version when the snapshot layout changes
+SNAPSHOT_PERIOD = 10 * 60
+SNAPSHOT_VERSION = 1
+
+
+def message_tables(msg: Message) -> Set[str]:
+    """
+    The set of tables `Database.insert` writes to for `msg`.
+    """
+    if isinstance(msg, MeterMessage):
+        tables = set()
+        if msg.timestamp is not None:
+            tables.add("meter_samples")
+        if msg.peak_power_timestamp is not None:
+            tables.add("meter_peaks")
+        if msg.gas_timestamp is not None:
+            tables.add("gas_samples")
+        return tables
+    elif isinstance(msg, ADCMessage):
+        return {"water_height_samples"}
+    else:
+        raise ValueError(f"Unknown message type: {msg}")
+
+
+def message_samples(msg: Message) -> List[Tuple[SeriesKind, int, tuple]]:
+    """
+    The samples `msg` adds to each `SeriesKind` as `(kind, timestamp, values)`,
+    with the values a raw `Database.fetch_series_items` query would return for them.
+    """
+    if isinstance(msg, MeterMessage):
+        samples = []
+        if msg.timestamp is not None:
+            powers = (msg.instant_power_1, msg.instant_power_2, msg.instant_power_3)
+            samples.append((SeriesKind.POWER, msg.timestamp, powers))
+        if msg.gas_timestamp is not None:
+            samples.append((SeriesKind.GAS, msg.gas_timestamp, (msg.gas_volume,)))
+        return samples
+    elif isinstance(msg, ADCMessage):
+        return [
+            (SeriesKind.WATER_HEIGHT, msg.timestamp, (water_height(msg.voltage_int),)),
+            (SeriesKind.WATER_VOLUME, msg.timestamp, (water_volume(msg.voltage_int),)),
+        ]
+    else:
+        raise ValueError(f"Unknown message type: {msg}")
+
+
+def merge_buckets(
+        timestamps: np.ndarray, values: np.ndarray, counts: np.ndarray, bucket_size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merge sorted buckets with the given sample `counts` into buckets of `bucket_size`,
+    weighing the averages by their counts just like the rollups are merged.
+    Raw samples are buckets with a count of one, or zero if they're missing.
+    Returns the new timestamps, averages and counts.
+    """
+    merged_timestamps, first = np.unique(timestamps // bucket_size * bucket_size, return_index=True)
+    sums = np.add.reduceat(np.where(counts > 0, values * counts, 0.0), first, axis=1)
+    totals = np.add.reduceat(counts, first, axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return merged_timestamps, sums / totals, totals
+
+
+def build_where_clause(oldest: Optional[int], newest: Optional[int], column: str = "timestamp") -> Tuple[str, tuple]:
+    """
+    Build the `WHERE` clause for the range `oldest` (inclusive) to `newest` (exclusive) and its parameters.
+    The bounds are always passed as parameters, so the statement text only depends on which bounds are set and
+    the prepared statement can be reused by the `sqlite3` statement cache.
+    """
     if oldest is not None and newest is not None:
-        where_clause = f"WHERE {oldest} <= timestamp AND timestamp < {newest} "
+        return f"WHERE ? <= {column} AND {column} < ? ", (oldest, newest)
     elif oldest is not None:
-        where_clause = f"WHERE {oldest} <= timestamp "
+        return f"WHERE ? <= {column} ", (oldest,)
     elif newest is not None:
-        where_clause = f"WHERE timestamp < {newest} "
+        return f"WHERE {column} < ? ", (newest,)
     else:
-        where_clause = ""
-    return where_clause
+        return "", ()
+
+
+METER_SAMPLES_COLUMNS = [
+    "instant_power_1", "instant_power_2", "instant_power_3",
+    "voltage_1", "voltage_2", "voltage_3",
+]
+
+
+def meter_samples_schema(compact: bool, table: str = "meter_samples") -> str:
+    """
+    The `CREATE TABLE` statement for the meter samples, the compact version drops the redundant `timestamp_str`.
+    """
+    columns = ["timestamp INTEGER PRIMARY KEY"]
+    if not compact:
+        columns.append("timestamp_str TEXT")
+    columns += [f"{column} REAL" for column in METER_SAMPLES_COLUMNS]
+    return f"CREATE TABLE IF NOT EXISTS {table}({', '.join(columns)})"
 
 
 class Database:
-    def __init__(self, path):
+    def __init__(self, path, read_only: bool = False, compact: bool = False):
+        """
+        Open or create the database at `path`.
+        If `compact` a new database gets the compact `meter_samples` table, existing tables are never changed.
+        """
+        self.path = path
+        if read_only:
+            self._init_read_only(path)
+            return
+
         self.conn = sqlite3.connect(path)
 
         result = self.conn.execute("PRAGMA journal_mode=WAL;").fetchone()
         assert result == ("wal",), "Failed to switch to WAL mode"
 
-        self.conn.execute(
-            "CREATE TABLE IF NOT EXISTS meter_samples("
-            "    timestamp INTEGER PRIMARY KEY,"
-            "    timestamp_str TEXT,"
-            "    instant_power_1 REAL,"
-            "    instant_power_2 REAL,"
-            "    instant_power_3 REAL,"
-            "    voltage_1 REAL,"
-            "    voltage_2 REAL,"
-            "    voltage_3 REAL"
-            ")"
-        )
+        self.conn.execute(meter_samples_schema(compact))
         self.conn.execute(
             "CREATE TABLE IF NOT EXISTS meter_peaks("
             "    timestamp INTEGER PRIMARY KEY, "
@@ -115,78 +163,333 @@ class Database:
             "    voltage_int INTEGER"
             ")"
         )
+        self.rollups = Rollups(self.conn)
+        self.retention = Retention(self.conn, path, self.rollups)
         self.conn.commit()
+        self.compact = self._is_compact()
+
+    def _init_read_only(self, path):
+        # the connection is used by different threads, but never by multiple at the same time
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.conn.execute("PRAGMA query_only = ON")
+        self.conn.execute("PRAGMA cache_size = -16384")
+        self.conn.execute("PRAGMA mmap_size = 268435456")
+        self.rollups = Rollups(self.conn, read_only=True)
+        self.retention = Retention(self.conn, path, self.rollups, read_only=True)
+        self.compact = self._is_compact()
+
+    def _is_compact(self) -> bool:
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(meter_samples)")]
+        return "timestamp_str" not in columns
+
+    @staticmethod
+    def open_read_only(path) -> 'Database':
+        """
+        Open an existing database for reading only, without creating or migrating any tables.
+        """
+        return Database(path, read_only=True)
+
+    def migrate_compact(self):
+        """
+        Rewrite `meter_samples` to the compact schema in a single transaction, the file only shrinks after a `VACUUM`.
+        """
+        if self.compact:
+            return
+
+        columns = ", ".join(["timestamp"] + METER_SAMPLES_COLUMNS)
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute(meter_samples_schema(True, table="meter_samples_compact"))
+            self.conn.execute(f"INSERT INTO meter_samples_compact SELECT {columns} FROM meter_samples")
+            self.conn.execute("DROP TABLE meter_samples")
+            self.conn.execute("ALTER TABLE meter_samples_compact RENAME TO meter_samples")
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.compact = True
 
     def insert(self, msg: Message) -> Set[str]:
-        # print(f"Inserting {msg}")
+        return self.insert_many([msg])
+
+    def insert_rows(self, table: str, rows: List[tuple]):
+        """
+        Insert or replace `rows` and update the rollups without committing, `meter_samples` rows always include
+        `timestamp_str` and it is dropped here if the table is compact.
+        Rows from before the retention window are skipped, the rollup buckets there can't be recomputed anymore
+        since the raw samples they were built from have been removed.
+        """
+        raw_since = self.retention.raw_since(table)
+        if raw_since is not None:
+            kept = [row for row in rows if row[0] >= raw_since]
+            if len(kept) < len(rows):
+                print(f"WARNING: skipping {len(rows) - len(kept)} '{table}' samples from before {raw_since}")
+            rows = kept
+
+        if len(rows) == 0:
+            return
+        timestamps = [row[0] for row in rows]
+        if table == "meter_samples" and self.compact:
+            rows = [row[:1] + row[2:] for row in rows]
+
+        placeholders = ", ".join("?" for _ in rows[0])
+        self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES({placeholders})", rows)
+        self.rollups.update_many(table, timestamps)
+
+    def insert_many(self, msgs: List[Message]) -> Set[str]:
+        """
+        Insert all messages using a single transaction and commit.
+        Later messages replace earlier ones with the same timestamp, just like separate inserts would.
+        """
+        # print(f"Inserting {len(msgs)} messages")
+        table_rows: Dict[str, list] = {
+            "meter_samples": [],
+            "meter_peaks": [],
+            "gas_samples": [],
+            "water_height_samples": [],
+        }
+
+        for msg in msgs:
+            if isinstance(msg, MeterMessage):
+                if msg.timestamp is not None:
+                    table_rows["meter_samples"].append((
+                        msg.timestamp, msg.timestamp_str, msg.instant_power_1, msg.instant_power_2,
+                        msg.instant_power_3, msg.voltage_1, msg.voltage_2, msg.voltage_3
+                    ))
+                if msg.peak_power_timestamp is not None:
+                    table_rows["meter_peaks"].append(
+                        (msg.peak_power_timestamp, msg.peak_power_timestamp_str, msg.peak_power)
+                    )
+                if msg.gas_timestamp is not None:
+                    table_rows["gas_samples"].append((msg.gas_timestamp, msg.gas_timestamp_str, msg.gas_volume))
+            elif isinstance(msg, ADCMessage):
+                table_rows["water_height_samples"].append((msg.timestamp, msg.voltage_int))
+            else:
+                raise ValueError(f"Unknown message type: {msg}")
+
         updated_tables = set()
+        for table, rows in table_rows.items():
+            if len(rows) == 0:
+                continue
+            self.insert_rows(table, rows)
+            updated_tables.add(table)
 
-        if isinstance(msg, MeterMessage):
-            if msg.timestamp is not None:
-                self.conn.execute(
-                    "INSERT OR REPLACE INTO meter_samples VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-                    (msg.timestamp, msg.timestamp_str, msg.instant_power_1, msg.instant_power_2, msg.instant_power_3,
-                     msg.voltage_1, msg.voltage_2, msg.voltage_3),
-                )
-                updated_tables.add("meter_samples")
-            if msg.peak_power_timestamp is not None:
-                self.conn.execute(
-                    "INSERT OR REPLACE INTO meter_peaks VALUES(?, ?, ?)",
-                    (msg.peak_power_timestamp, msg.peak_power_timestamp_str, msg.peak_power)
-                )
-                updated_tables.add("meter_peaks")
-            if msg.gas_timestamp is not None:
-                self.conn.execute(
-                    "INSERT OR REPLACE INTO gas_samples VALUES(?, ?, ?)",
-                    (msg.gas_timestamp, msg.gas_timestamp_str, msg.gas_volume)
-                )
-                updated_tables.add("gas_samples")
-            self.conn.commit()
-        elif isinstance(msg, ADCMessage):
-            self.conn.execute(
-                "INSERT OR REPLACE INTO water_height_samples VALUES(?, ?)",
-                (msg.timestamp, msg.voltage_int),
+        self.conn.commit()
+        return updated_tables
+
+    def last_timestamp(self, table: str) -> Optional[int]:
+        return self.conn.execute(f"SELECT MAX(timestamp) FROM {table}").fetchone()[0]
+
+    def series_query(
+            self, kind: SeriesKind, bucket_size: Optional[int],
+            oldest: Optional[int], newest: Optional[int],
+            counts: bool = False, raw_since: Optional[int] = None, extremes: bool = False,
+    ) -> Tuple[str, tuple]:
+        """
+        Build the statement and parameters used by `fetch_series_items` for bucketed queries and raw queries that
+        don't need samples from before `raw_since`.
+        Bucketed queries group by the first output column, so a single sort is shared by the grouping and ordering.
+        """
+        assert not (counts and bucket_size is None), "Raw samples don't have counts"
+        assert not (extremes and bucket_size is None), "Raw samples don't have extremes"
+
+        if bucket_size is None:
+            assert raw_since is None or (oldest is not None and oldest >= raw_since), "Raw samples have been removed"
+            where_clause, params = build_where_clause(oldest, newest)
+            sql = (
+                f"SELECT timestamp, {', '.join(kind.value.columns)} "
+                f"FROM {kind.value.table} "
+                f"{where_clause}"
+                "ORDER BY timestamp"
             )
-            updated_tables.add("water_height_samples")
-            self.conn.commit()
-        else:
-            raise ValueError(f"Unknown message type: {msg}")
+            return sql, params
+
+        resolution = self.rollups.select_resolution(kind, bucket_size, oldest, newest)
+        if resolution is not None:
+            return self._rollup_query(kind, resolution, bucket_size, oldest, newest, counts, extremes)
+        if raw_since is not None and (oldest is None or oldest < raw_since):
+            return self._pruned_query(kind, bucket_size, oldest, newest, counts, raw_since, extremes)
+
+        where_clause, params = build_where_clause(oldest, newest)
+        averages = ",\n".join(f"AVG({item})" for item in kind.value.columns)
+        if counts:
+            averages += "".join(f",\nCOUNT({item})" for item in kind.value.columns)
+        if extremes:
+            averages += "".join(f",\nMIN({item})" for item in kind.value.columns)
+            averages += "".join(f",\nMAX({item})" for item in kind.value.columns)
+        sql = (
+            "SELECT timestamp / ? * ?, "
+            f"{averages} "
+            f"FROM {kind.value.table} "
+            f"{where_clause}"
+            "GROUP BY 1 ORDER BY 1"
+        )
+        return sql, (bucket_size, bucket_size) + params
+
+    def _rollup_query(
+            self, kind: SeriesKind, resolution: int, bucket_size: int,
+            oldest: Optional[int], newest: Optional[int], counts: bool, extremes: bool = False,
+    ) -> Tuple[str, tuple]:
+        where_clause, params = build_where_clause(oldest, newest, column="bucket")
+        # buckets of the rollup resolution itself are grouped by the primary key, which needs no sort
+        same_size = resolution == bucket_size
+        sql = (
+            f"SELECT {'bucket' if same_size else 'bucket / ? * ?'}, "
+            f"{rollup_averages(kind)} "
+            f"{rollup_counts(kind) if counts else ''} "
+            f"{rollup_extremes(kind) if extremes else ''} "
+            f"FROM {rollup_table(kind, resolution)} "
+            f"{where_clause}"
+            f"{'GROUP BY bucket ORDER BY bucket' if same_size else 'GROUP BY 1 ORDER BY 1'}"
+        )
+        return sql, params if same_size else (bucket_size, bucket_size) + params
 
-        return updated_tables
+    def _pruned_query(
+            self, kind: SeriesKind, bucket_size: int,
+            oldest: Optional[int], newest: Optional[int], counts: bool, raw_since: int, extremes: bool = False,
+    ) -> Tuple[str, tuple]:
+        """
+        Buckets that need samples from before `raw_since`, computed from the finest rollup that fits before it and
+        from the raw samples after it. Buckets that are not a multiple of any rollup resolution are approximated.
+        """
+        resolution = max((r for r in ROLLUP_RESOLUTIONS if bucket_size % r == 0), default=ROLLUP_RESOLUTIONS[0])
+        columns = range(len(kind.value.columns))
+
+        rollup_where, rollup_params = build_where_clause(oldest, raw_since, column="bucket")
+        raw_where, raw_params = build_where_clause(raw_since, newest)
+        rollup_items = ", ".join(
+            f"sum_{i} AS s{i}, count_{i} AS c{i}, min_{i} AS n{i}, max_{i} AS x{i}" for i in columns
+        )
+        raw_items = ", ".join(
+            f"{item} AS s{i}, {item} IS NOT NULL AS c{i}, {item} AS n{i}, {item} AS x{i}"
+            for i, item in enumerate(kind.value.columns)
+        )
+
+        averages = ", ".join(f"SUM(s{i}) / SUM(c{i})" for i in columns)
+        if counts:
+            averages += "".join(f", SUM(c{i})" for i in columns)
+        if extremes:
+            averages += "".join(f", MIN(n{i})" for i in columns) + "".join(f", MAX(x{i})" for i in columns)
+
+        sql = (
+            f"SELECT t / ? * ?, {averages} FROM ("
+            f"SELECT bucket AS t, {rollup_items} FROM {rollup_table(kind, resolution)} {rollup_where}"
+            "UNION ALL "
+            f"SELECT timestamp AS t, {raw_items} FROM {kind.value.table} {raw_where}"
+            ") GROUP BY 1 ORDER BY 1"
+        )
+        return sql, (bucket_size, bucket_size) + rollup_params + raw_params
 
     # TODO decide a proper API for this, this kinda sucks
     #   maybe just have separate functions for power and gas, which then call an internal function?
     # TODO currently the user still has to call process_values on the result
     def fetch_series_items(
             self, kind: SeriesKind, bucket_size: Optional[int],
-            oldest: Optional[int], newest: Optional[int]
+            oldest: Optional[int], newest: Optional[int],
+            counts: bool = False, extremes: bool = False,
     ):
         """
         Fetch the buckets between `oldest` (inclusive) and `newest` (exclusive)`.
+        Bucketed queries are answered from the coarsest rollup table that fits, if any.
+        If `counts`, bucketed rows also contain the number of samples of each column, after the averages.
+        If `extremes`, bucketed rows also contain the minimum and then the maximum of each column, after those.
+
+        Ranges from before the retention window are transparently answered from the rollups, raw samples from there
+        come from the monthly partition files if they were archived and are the finest rollup averages otherwise.
         """
-        where_clause = build_where_clause(oldest, newest)
+        with metrics.FETCH_SECONDS.time(kind.value.name, str(bucket_size)):
+            raw_since = self.retention.raw_since(kind.value.table)
+            if bucket_size is None and raw_since is not None and (oldest is None or oldest < raw_since):
+                return self._fetch_pruned_raw(kind, oldest, newest, raw_since)
+            return self.conn.execute(*self.series_query(kind, bucket_size, oldest, newest, counts, raw_since, extremes))
+
+    def _fetch_pruned_raw(self, kind: SeriesKind, oldest: Optional[int], newest: Optional[int], raw_since: int):
+        resolution = ROLLUP_RESOLUTIONS[0]
+        if oldest is None:
+            oldest = self.conn.execute(f"SELECT MIN(bucket) FROM {rollup_table(kind, resolution)}").fetchone()[0]
+            oldest = raw_since if oldest is None else oldest
+
+        def query(conn, sql_params):
+            return lambda: conn.execute(*sql_params)
+
+        queries = []
+        curr = oldest
+        end = raw_since if newest is None else min(newest, raw_since)
+        while curr < end:
+            part_end = min(next_month(curr), end)
+            partition = self.retention.partition(curr, kind.value.table)
+            if partition is not None:
+                queries.append(query(partition, self.series_query(kind, None, curr, part_end)))
+            else:
+                queries.append(query(self.conn, self._rollup_query(kind, resolution, resolution, curr, part_end, False)))
+            curr = part_end
 
-        if bucket_size is None:
-            return self.conn.execute(
-                "WITH const as (SELECT ? as oldest, ? as newest) "
-                f"SELECT timestamp, {', '.join(kind.value.columns)} "
-                f"FROM {kind.value.table}, const "
-                f"{where_clause}"
-                "ORDER BY timestamp ",
-                (oldest, newest)
-            )
+        if newest is None or newest > raw_since:
+            queries.append(query(self.conn, self.series_query(kind, None, max(oldest, raw_since), newest)))
+        return ChainedCursor(queries)
+
+    def fetch_aggregated(self, kind: SeriesKind, buckets: 'Buckets', oldest: int, newest: int) -> 'Series':
+        """
+        Fetch the buckets between `oldest` and `newest` for a non-mean `buckets.aggregation`.
+        They are computed from sub-buckets of the `source_resolution`, which come from the rollups where possible and
+        keep the exact minimum and maximum of their samples.
+        """
+        series = Series.empty(kind, buckets)
+        column_count = len(kind.value.columns)
+        resolution = source_resolution(buckets.bucket_size)
+
+        rows = self.fetch_series_items(kind, resolution, oldest, newest, extremes=resolution is not None).fetchall()
+        if len(rows) == 0:
+            return series
+
+        timestamps = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), -1).T
+        if resolution is None:
+            means = mins = maxs = values
         else:
-            averages = ",\n".join(f"AVG({item})" for item in kind.value.columns)
-            return self.conn.execute(
-                "WITH const as (SELECT ? as bucket_size, ? as oldest, ? as newest) "
-                "SELECT timestamp / bucket_size * bucket_size, "
-                f"{averages}"
-                f"FROM {kind.value.table}, const "
-                f"{where_clause}"
-                "GROUP BY timestamp / bucket_size "
-                "ORDER BY timestamp ",
-                (bucket_size, oldest, newest)
-            )
+            means, mins, maxs = np.split(values, [column_count, 2 * column_count])
+
+        series.extend_arrays(*downsample(timestamps, means, mins, maxs, buckets.bucket_size, buckets.aggregation))
+        return series
+
+    def query_plan(
+            self, kind: SeriesKind, bucket_size: Optional[int],
+            oldest: Optional[int], newest: Optional[int],
+            counts: bool = False, raw_since: Optional[int] = None,
+    ) -> List[str]:
+        """
+        The `EXPLAIN QUERY PLAN` details of the statement `fetch_series_items` would run.
+        """
+        sql, params = self.series_query(kind, bucket_size, oldest, newest, counts, raw_since)
+        return [row[3] for row in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+    def check_query_plans(self) -> List[str]:
+        """
+        Check that every bounded series query only does primary key range searches and at most one sort,
+        also for buckets that partially come from the rollups because the raw samples were removed.
+        Returns a description of each violation.
+        """
+        # a day aligned to all rollup resolutions, so the rollup tables are used if they are complete
+        day = ROLLUP_RESOLUTIONS[-1]
+        newest = ((self.last_timestamp("meter_samples") or 0) // day + 1) * day
+        oldest = newest - day
+        bucket_sizes = [None, 1, 7] + ROLLUP_RESOLUTIONS
+
+        problems = []
+        for kind in SeriesKind:
+            for bucket_size in bucket_sizes:
+                for counts in [False, True] if bucket_size is not None else [False]:
+                    for raw_since in [None, oldest + day // 2] if bucket_size is not None else [None]:
+                        plan = self.query_plan(kind, bucket_size, oldest, newest, counts, raw_since)
+                        search = any(step.startswith("SEARCH ") and "PRIMARY KEY (" in step for step in plan)
+                        scan = any(step.startswith("SCAN ") and "subquery" not in step for step in plan)
+                        sorts = sum(step.startswith("USE TEMP B-TREE") for step in plan)
+                        if not search or scan or sorts > 1:
+                            problems.append(
+                                f"{kind.value.name}, bucket size {bucket_size}, counts {counts}, "
+                                f"raw since {raw_since}: {plan}"
+                            )
+        return problems
 
     def close(self):
         self.conn.close()
@@ -196,6 +499,7 @@ class Database:
 class Buckets:
     window_size: Optional[int]
     bucket_size: Optional[int]
+    aggregation: Aggregation = Aggregation.MEAN
 
     def bucket_bounds(self, timestamp: int) -> (int, int):
         """
@@ -211,86 +515,400 @@ class Buckets:
         return oldest, newest
 
 
-@dataclass
+def parse_custom_channel(name: str) -> Tuple[str, SeriesKind, Buckets]:
+    """
+    Parse the name of a custom websocket channel `<kind>:<bucket_size>:<window_size>[:<aggregation>]`,
+    for example `power:60:7200` or `power:300:86400:m4`. Returns the canonical name, without the default `mean`
+    aggregation, and the series it tracks. Raises ValueError for invalid or too large channels.
+    """
+    parts = name.split(":")
+    if len(parts) not in (3, 4):
+        raise ValueError(f"Invalid channel '{name}'")
+
+    kinds = {kind.value.name: kind for kind in SeriesKind}
+    if parts[0] not in kinds:
+        raise ValueError(f"Unknown kind in channel '{name}'")
+    kind = kinds[parts[0]]
+    bucket_size, window_size = int(parts[1]), int(parts[2])
+    aggregation = Aggregation(parts[3]) if len(parts) == 4 else Aggregation.MEAN
+
+    # the points LTTB picks depend on the neighbouring buckets, so they can't be computed one bucket at a time
+    if aggregation == Aggregation.LTTB:
+        raise ValueError(f"Channel '{name}' can't use lttb")
+    if bucket_size < aggregation.points_per_bucket or window_size < bucket_size:
+        raise ValueError(f"Invalid buckets in channel '{name}'")
+    if window_size // bucket_size * aggregation.points_per_bucket > MAX_CHANNEL_POINTS:
+        raise ValueError(f"Channel '{name}' has more than {MAX_CHANNEL_POINTS} points")
+
+    canonical = f"{kind.value.name}:{bucket_size}:{window_size}"
+    if aggregation != Aggregation.MEAN:
+        canonical += f":{aggregation.value}"
+    return canonical, kind, Buckets(window_size, bucket_size, aggregation)
+
+
+BINARY_MESSAGE_TYPES = {"initial": 0, "update": 1, "download": 2, "resume": 3}
+
+
+def _pad8(data: bytes) -> bytes:
+    return data + bytes(-len(data) % 8)
+
+
 class Series:
-    kind: SeriesKind
-    buckets: Buckets
+    """
+    Columnar series of buckets, stored in preallocated NumPy buffers.
+
+    Items are only ever appended after the current end of the buffers and old items are dropped by moving the start,
+    the live part of the buffers is never written to again. When the buffers are full a new, larger buffer is allocated.
+    This means a `clone` can share the underlying buffers instead of copying them.
+    """
+
+    MIN_CAPACITY = 64
 
-    timestamps: List[int]
-    values: List[List[float]]
+    def __init__(self, kind: SeriesKind, buckets: Buckets, timestamps: np.ndarray, values: np.ndarray):
+        self.kind = kind
+        self.buckets = buckets
+
+        # timestamps has shape (capacity,), values has shape (columns, capacity)
+        self._timestamps = timestamps
+        self._values = values
+        self._start = 0
+        self._end = len(timestamps)
 
     @staticmethod
     def empty(kind: SeriesKind, buckets: Buckets):
         return Series(
             kind=kind,
             buckets=buckets,
-            timestamps=[],
-            values=[[] for _ in kind.value.columns],
+            timestamps=np.empty(0, dtype=np.int64),
+            values=np.empty((len(kind.value.columns), 0), dtype=np.float64),
         )
 
     @staticmethod
     def empty_like(other: 'Series'):
         return Series.empty(kind=other.kind, buckets=other.buckets)
 
-    def to_json(self):
+    @staticmethod
+    def from_cursor(kind: SeriesKind, buckets: Buckets, cursor: sqlite3.Cursor, batch_size: int = 16 * 1024):
+        """
+        Build a series from a cursor returned by `Database.fetch_series_items`.
+        """
+        series = Series.empty(kind, buckets)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if len(batch) == 0:
+                break
+            series.extend_items(batch)
+        return series
+
+    @staticmethod
+    def from_cursor_with_counts(kind: SeriesKind, buckets: Buckets, cursor: sqlite3.Cursor) -> Tuple['Series', 'Series']:
+        """
+        Build a series and the matching sample counts from a `Database.fetch_series_items` cursor with `counts`.
+        """
+        column_count = len(kind.value.columns)
+        rows = cursor.fetchall()
+
+        series = Series.empty(kind, buckets)
+        counts = Series.empty(kind, buckets)
+        series.extend_items(row[:1 + column_count] for row in rows)
+        counts.extend_items((row[0],) + row[1 + column_count:] for row in rows)
+        return series, counts
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        view = self._timestamps[self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def values(self) -> np.ndarray:
+        view = self._values[:, self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    def __len__(self):
+        return self._end - self._start
+
+    def to_json_header(self):
         return {
             "window_size": self.buckets.window_size,
             "bucket_size": self.buckets.bucket_size,
+            "aggregation": self.buckets.aggregation.value,
             "kind": self.kind.value.name,
             "unit_label": self.kind.value.unit_label,
             "hline_values": self.kind.value.hline_values,
+        }
 
-            "timestamps": self.timestamps,
-            "values": self.values,
+    def to_json(self, extra: Optional[dict] = None):
+        return {
+            **self.to_json_header(),
+            **(extra or {}),
+            "timestamps": self.timestamps.tolist(),
+            "values": self.values.tolist(),
         }
 
+    def to_binary(self, key: str, extra: Optional[dict] = None) -> bytes:
+        """
+        Encode this series in the binary wire format, see `MultiSeries.to_binary` for the layout.
+        """
+        header = simplejson.dumps({"key": key, **self.to_json_header(), **(extra or {})}).encode()
+        count = len(self)
+        value_bytes = self.kind.value.wire_value_bytes
+        first_timestamp = int(self.timestamps[0]) if count > 0 else 0
+
+        deltas = np.diff(self.timestamps, prepend=first_timestamp).astype("<i4")
+        values = self.values.astype("<f4" if value_bytes == 4 else "<f8")
+
+        # regularly spaced timestamps are sent as a single step instead of a delta array
+        step = int(deltas[1]) if count > 1 else 0
+        if step > 0 and np.all(deltas[1:] == step):
+            timestamp_bytes = b""
+        else:
+            step = 0
+            timestamp_bytes = deltas.tobytes()
+
+        parts = [
+            struct.pack("<IIHBxiq", len(header), count, len(values), value_bytes, step, first_timestamp),
+            _pad8(header),
+            _pad8(timestamp_bytes),
+        ]
+        parts += [_pad8(column.tobytes()) for column in values]
+        return b"".join(parts)
+
     def clone(self):
         return Series(
             kind=self.kind,
             buckets=self.buckets,
-            timestamps=list(self.timestamps),
-            values=[list(x) for x in self.values]
+            timestamps=self.timestamps,
+            values=self.values,
         )
 
+    def after(self, timestamp: int) -> 'Series':
+        """
+        The items newer than `timestamp`, sharing the buffers of this series.
+        """
+        series = self.clone()
+        series.drop_before(timestamp + 1)
+        return series
+
     def _drop_old(self):
-        if len(self.timestamps) == 0 or self.buckets.window_size is None:
+        if len(self) == 0 or self.buckets.window_size is None:
             return
-        newest = self.timestamps[-1]
+        newest = self._timestamps[self._end - 1]
+        if self.buckets.bucket_size is not None:
+            # buckets with multiple points are kept or dropped as a whole
+            newest = newest // self.buckets.bucket_size * self.buckets.bucket_size
         self.drop_before(newest - self.buckets.window_size)
 
     def drop_before(self, oldest):
-        kept_index = next((i for i, t in enumerate(self.timestamps) if t >= oldest), 0)
+        self._start += int(np.searchsorted(self.timestamps, oldest, side="left"))
 
-        del self.timestamps[:kept_index]
-        for arr in self.values:
-            del arr[:kept_index]
+    def _reserve(self, count: int):
+        if self._end + count <= len(self._timestamps):
+            return
 
-    def extend_items(self, items):
-        for line in items:
-            timestamp, *values = line
-            self.timestamps.append(timestamp)
-            for i, value in enumerate(values):
-                self.values[i].append(value)
+        # allocate new buffers instead of moving data in place, clones might still be using the old ones
+        live = len(self)
+        capacity = max(2 * (live + count), Series.MIN_CAPACITY)
+
+        timestamps = np.empty(capacity, dtype=np.int64)
+        values = np.empty((len(self._values), capacity), dtype=np.float64)
+        timestamps[:live] = self.timestamps
+        values[:, :live] = self.values
+
+        self._timestamps = timestamps
+        self._values = values
+        self._start = 0
+        self._end = live
+
+    def extend_arrays(self, timestamps: np.ndarray, values: np.ndarray):
+        count = len(timestamps)
+        if count == 0:
+            return
+
+        self._reserve(count)
+        self._timestamps[self._end:self._end + count] = timestamps
+        self._values[:, self._end:self._end + count] = values
+        self._end += count
 
         self._drop_old()
 
+    def extend_series(self, other: 'Series'):
+        self.extend_arrays(other.timestamps, other.values)
+
+    def extend_items(self, items):
+        items = list(items)
+        if len(items) == 0:
+            return
+
+        timestamps = np.fromiter((line[0] for line in items), dtype=np.int64, count=len(items))
+        values = np.array([line[1:] for line in items], dtype=np.float64).reshape(len(items), -1).T
+        self.extend_arrays(timestamps, values)
+
 
 @dataclass
 class MultiSeries:
     map: Dict[str, Series]
 
-    def to_json(self):
+    def to_json(self, extra: Optional[dict] = None):
         return {
-            name: series.to_json() for name, series in self.map.items()
+            name: series.to_json(extra) for name, series in self.map.items()
         }
 
+    def to_binary(self, ty: str, extra: Optional[dict] = None) -> bytes:
+        """
+        Encode all series in the binary wire format, all numbers are little-endian:
+
+        * magic `DMB1`, u8 message type (see `BINARY_MESSAGE_TYPES`), u8 padding, u16 series count
+        * for each series:
+            * u32 header length, u32 bucket count, u16 column count, u8 value size (4 or 8), u8 padding
+            * i32 timestamp step, i64 first timestamp
+            * UTF-8 JSON header, with the fields of `Series.to_json` except the data, and the series `key`
+            * if the step is zero, i32 timestamp deltas, each relative to the previous timestamp,
+                the first one relative to the first timestamp. Otherwise timestamp `i` is `first + i * step`.
+            * one float32 or float64 array per column
+
+        Every variable length section is padded to a multiple of 8 bytes, so the arrays can be viewed in place.
+        The fields in `extra` are added to every series header.
+        """
+        prefix = b"DMB1" + struct.pack("<BxH", BINARY_MESSAGE_TYPES[ty], len(self.map))
+        return prefix + b"".join(series.to_binary(name, extra) for name, series in self.map.items())
+
+    def extend(self, other: 'MultiSeries'):
+        for name, series in other.map.items():
+            if name in self.map:
+                self.map[name].extend_series(series)
+            else:
+                self.map[name] = series
+
     def clone(self):
         return MultiSeries({
             name: series.clone() for name, series in self.map.items()
         })
 
+    def layout(self) -> str:
+        """
+        Short fingerprint of the keys, kinds and buckets of the series, clients can only resume with the same layout.
+        """
+        layout = [
+            [name, series.kind.name, series.buckets.window_size, series.buckets.bucket_size,
+             series.buckets.aggregation.value]
+            for name, series in self.map.items()
+        ]
+        return f"{zlib.crc32(simplejson.dumps(layout).encode()):08x}"
+
+
+@dataclass
+class Resume:
+    """
+    What a reconnecting websocket client already has: the `layout` of its series and the newest timestamp per series.
+    """
+    layout: str
+    since: Dict[str, int]
+
+    def missing(self, history: MultiSeries) -> Optional[MultiSeries]:
+        """
+        The part of `history` the client doesn't have yet, series without new items are left out entirely.
+        None if the layout changed since, then the client needs a full snapshot instead.
+        The tracker always holds the full window the client keeps, so older buckets are never needed.
+        """
+        if self.layout != history.layout():
+            return None
+
+        result = MultiSeries({})
+        for name, series in history.map.items():
+            if name in self.since:
+                series = series.after(self.since[name])
+                if len(series) == 0:
+                    continue
+            result.map[name] = series
+        return result
+
+
+class OpenSamples:
+    """
+    The raw samples of a single `SeriesKind` that are not in a finished bucket of every tracked series yet,
+    in timestamp order. Like in the database, a sample replaces an earlier one with the same timestamp.
+    """
+
+    def __init__(self, kind: SeriesKind):
+        self.kind = kind
+        self.timestamps: List[int] = []
+        self.values: List[tuple] = []
+
+    def add(self, timestamp: int, values: tuple):
+        # samples almost always arrive in order, so this is an append
+        index = bisect.bisect_left(self.timestamps, timestamp)
+        if index < len(self.timestamps) and self.timestamps[index] == timestamp:
+            self.values[index] = values
+        else:
+            self.timestamps.insert(index, timestamp)
+            self.values.insert(index, values)
+
+    def add_items(self, items):
+        for item in items:
+            self.add(item[0], item[1:])
+
+    def drop_before(self, oldest: int):
+        index = bisect.bisect_left(self.timestamps, oldest)
+        del self.timestamps[:index]
+        del self.values[:index]
+
+    def aggregate(self, buckets: Buckets, oldest: int, newest: int) -> Tuple[Series, Optional[Series]]:
+        """
+        Compute the buckets between `oldest` and `newest` and their sample counts,
+        the same as `Database.fetch_series_items` or `Database.fetch_aggregated` would return them.
+        Only mean buckets have counts.
+        """
+        aggregated = buckets.aggregation != Aggregation.MEAN
+        series = Series.empty(self.kind, buckets)
+        counts = Series.empty(self.kind, buckets) if buckets.bucket_size is not None and not aggregated else None
+
+        lo = bisect.bisect_left(self.timestamps, oldest)
+        hi = bisect.bisect_left(self.timestamps, newest)
+        # a meter clock that jumped backwards asks for a reversed range, which is empty just like in the database
+        if lo >= hi:
+            return series, counts
+
+        timestamps = np.array(self.timestamps[lo:hi], dtype=np.int64)
+        values = np.array(self.values[lo:hi], dtype=np.float64).T
+
+        if buckets.bucket_size is None:
+            series.extend_arrays(timestamps, values)
+        elif aggregated:
+            resolution = source_resolution(buckets.bucket_size)
+            if resolution is None:
+                subs = (timestamps, values, values, values)
+            else:
+                subs = sub_buckets(timestamps, values, resolution)
+            series.extend_arrays(*downsample(*subs, buckets.bucket_size, buckets.aggregation))
+        else:
+            present = (~np.isnan(values)).astype(np.float64)
+            merged_timestamps, averages, totals = merge_buckets(timestamps, values, present, buckets.bucket_size)
+            series.extend_arrays(merged_timestamps, averages)
+            counts.extend_arrays(merged_timestamps, totals)
+
+        return series, counts
+
+
+@dataclass
+class SeriesFill:
+    """
+    A custom series filled from the database by `Tracker.fill_series`, up to the table timestamp `last_timestamp`.
+    `open_items` are the raw samples since the start of its open bucket.
+    """
+    last_timestamp: Optional[int]
+    series: Series
+    open_items: List[tuple]
+
 
 class Tracker:
+    """
+    Keeps the finished buckets of the series that are sent to the websocket clients.
+    The series are filled from the database the first time their table is updated,
+    after that new buckets are computed from the incoming messages without querying the database.
+    """
+
     def __init__(self):
         self.table_last_timestamp: Dict[str, int] = {}
 
@@ -304,90 +922,822 @@ class Tracker:
             "water": Series.empty(SeriesKind.WATER_VOLUME, Buckets(31 * 24 * 60 * 60, 15 * 60)),
         })
 
-    def update(self, database: Database, updated_tables: Set[str], curr_timestamp: int) -> MultiSeries:
+        # extra series that websocket clients subscribed to, they are not part of the snapshot or `TrackerView`
+        self.custom_series = MultiSeries({})
+
+        # the number of samples in each bucket, per column, for the bucketed mean series
+        # these are not sent to the clients, but allow `TrackerView` to merge buckets exactly
+        self.count_series = MultiSeries({
+            key: Series.empty_like(series)
+            for key, series in self.multi_series.map.items()
+            if series.buckets.bucket_size is not None and series.buckets.aggregation == Aggregation.MEAN
+        })
+
+        self.open_samples: Dict[SeriesKind, OpenSamples] = {
+            series.kind: OpenSamples(series.kind) for series in self.multi_series.map.values()
+        }
+        # the tables for which the open samples are complete, the others still need to be filled from the database
+        self.live_tables: Set[str] = set()
+
+    def _config(self) -> dict:
+        return {
+            key: [
+                series.kind.name, series.buckets.window_size, series.buckets.bucket_size,
+                series.buckets.aggregation.value,
+            ]
+            for key, series in self.multi_series.map.items()
+        }
+
+    def save_snapshot(self, path: str, database: Database):
+        """
+        Save the series and last timestamps to the `.npz` file `path`.
+        The file is replaced atomically, so a crash never leaves a broken snapshot behind.
+        """
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "series": self._config(),
+            "table_last_timestamp": self.table_last_timestamp,
+            "database_last_timestamp": {table: database.last_timestamp(table) for table in self.table_last_timestamp},
+        }
+        arrays = {"header": np.array(simplejson.dumps(header))}
+        for key, series in self.multi_series.map.items():
+            arrays[f"{key}.timestamps"] = series.timestamps
+            arrays[f"{key}.values"] = series.values
+        for key, series in self.count_series.map.items():
+            arrays[f"{key}.counts"] = series.values
+
+        path_tmp = path + ".tmp"
+        with open(path_tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(path_tmp, path)
+
+    def load_snapshot(self, path: str, database: Database) -> bool:
+        """
+        Restore the state saved by `save_snapshot`, afterwards only the buckets since the snapshot are fetched.
+        Returns whether the snapshot was loaded, invalid or outdated snapshots are ignored.
+        """
+        try:
+            with np.load(path) as snapshot:
+                header = simplejson.loads(str(snapshot["header"]))
+                arrays = {key: snapshot[key] for key in snapshot.files}
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring invalid tracker snapshot '{path}': {e}")
+            return False
+
+        if header["version"] != SNAPSHOT_VERSION or header["series"] != self._config():
+            print(f"Ignoring tracker snapshot '{path}' with different series")
+            return False
+
+        # a snapshot that is newer than the database must belong to a different one
+        for table, timestamp in header["database_last_timestamp"].items():
+            last_timestamp = database.last_timestamp(table)
+            if timestamp is not None and (last_timestamp is None or last_timestamp < timestamp):
+                print(f"Ignoring tracker snapshot '{path}', it does not match the database")
+                return False
+
+        for key, series in self.multi_series.map.items():
+            series.extend_arrays(arrays[f"{key}.timestamps"], arrays[f"{key}.values"])
+        for key, series in self.count_series.map.items():
+            series.extend_arrays(arrays[f"{key}.timestamps"], arrays[f"{key}.counts"])
+        self.table_last_timestamp = header["table_last_timestamp"]
+
+        print(f"Loaded tracker snapshot '{path}'")
+        return True
+
+    def _all_series(self) -> List[Tuple[str, Series]]:
+        return list(self.multi_series.map.items()) + list(self.custom_series.map.items())
+
+    def _open_oldest(self, kind: SeriesKind, timestamp: int) -> int:
+        # the start of the oldest bucket that is still open in any series of `kind`
+        return min(
+            series.buckets.bucket_bounds(timestamp)[1]
+            for _, series in self._all_series()
+            if series.kind == kind
+        )
+
+    @staticmethod
+    def _fetch(
+            database: Database, series: Series, oldest: int, newest: int, counts: bool
+    ) -> Tuple[Series, Optional[Series]]:
+        # the buckets of `series` between `oldest` and `newest` from the database, with their counts if `counts`
+        if series.buckets.aggregation != Aggregation.MEAN:
+            return database.fetch_aggregated(series.kind, series.buckets, oldest, newest), None
+
+        items = database.fetch_series_items(series.kind, series.buckets.bucket_size, oldest, newest, counts=counts)
+        if not counts:
+            return Series.from_cursor(series.kind, series.buckets, items), None
+        return Series.from_cursor_with_counts(series.kind, series.buckets, items)
+
+    @staticmethod
+    def fill_series(kind: SeriesKind, buckets: Buckets, database: Database, last_timestamp: Optional[int]) -> 'SeriesFill':
+        """
+        Fetch the finished buckets of a new series and the samples in its open bucket, as if the last sample of its
+        table had `last_timestamp`. This doesn't touch the tracker, so it can run without holding its lock.
+        """
+        series = Series.empty(kind, buckets)
+        if last_timestamp is None:
+            return SeriesFill(None, series, [])
+
+        oldest, newest = buckets.bucket_bounds(last_timestamp)
+        series.extend_series(Tracker._fetch(database, series, oldest, newest, counts=False)[0])
+        open_items = database.fetch_series_items(kind, None, newest, None).fetchall()
+        return SeriesFill(last_timestamp, series, open_items)
+
+    def add_series(
+            self, key: str, kind: SeriesKind, buckets: Buckets, database: Database, fill: Optional['SeriesFill'] = None
+    ) -> Series:
+        """
+        Start tracking the custom series `key`, filled right away from `database` if its table was seen already,
+        otherwise together with the other series on the first message. `database` can be a read-only connection.
+        If `fill` is given only what changed since `fill_series` returned it is fetched here.
+        """
+        table = kind.value.table
+        last_timestamp = self.table_last_timestamp.get(table)
+        if fill is None or fill.last_timestamp is None or last_timestamp is None:
+            fill = self.fill_series(kind, buckets, database, last_timestamp)
+        elif last_timestamp != fill.last_timestamp:
+            # catch up with the messages that were processed while filling
+            _, fill_newest = buckets.bucket_bounds(fill.last_timestamp)
+            oldest, newest = buckets.bucket_bounds(last_timestamp)
+            if newest > fill_newest:
+                fill.series.extend_series(
+                    self._fetch(database, fill.series, max(oldest, fill_newest), newest, counts=False)[0]
+                )
+            fill.open_items += database.fetch_series_items(kind, None, fill.last_timestamp + 1, None).fetchall()
+
+        self.custom_series.map[key] = fill.series
+        if kind not in self.open_samples:
+            self.open_samples[kind] = OpenSamples(kind)
+
+        # the open samples have to reach back to the start of the open bucket of the new series
+        if last_timestamp is not None and table in self.live_tables:
+            self.open_samples[kind].add_items(fill.open_items)
+        return fill.series
+
+    def remove_series(self, key: str):
+        series = self.custom_series.map.pop(key)
+        if all(other.kind != series.kind for _, other in self._all_series()):
+            del self.open_samples[series.kind]
+
+    def update(self, database: Database, msg: Message) -> MultiSeries:
+        """
+        Add `msg`, which has already been inserted into the database, and return the buckets it finished.
+        """
+        updated_tables = message_tables(msg)
+        curr_timestamp = msg.timestamp
         delta_multi_series = MultiSeries({})
 
-        for key in self.multi_series.map:
-            series = self.multi_series.map[key]
+        for kind, timestamp, values in message_samples(msg):
+            open_samples = self.open_samples.get(kind)
+            if open_samples is not None and kind.value.table in self.live_tables:
+                open_samples.add(timestamp, values)
+
+        for key, series in self._all_series():
             curr_oldest, curr_newest = series.buckets.bucket_bounds(curr_timestamp)
 
             if series.kind.value.table not in updated_tables:
                 continue
             prev_timestamp = self.table_last_timestamp.get(series.kind.value.table)
+            count_series = self.count_series.map.get(key)
+
+            if prev_timestamp is None or series.kind.value.table not in self.live_tables:
+                if prev_timestamp is None:
+                    # fetch the entire series
+                    print(f"Fetching entire series for '{key}'")
+                    fetch_oldest = curr_oldest
+                else:
+                    # only fetch the buckets since the snapshot
+                    _, prev_newest = series.buckets.bucket_bounds(prev_timestamp)
+                    print(f"Fetching series '{key}' since the snapshot")
+                    fetch_oldest = max(prev_newest, curr_oldest)
 
-            if prev_timestamp is None:
-                # fetch the entire series
-                print(f"Fetching entire series for '{key}'")
-                new_items = database.fetch_series_items(
-                    series.kind, series.buckets.bucket_size, curr_oldest, curr_newest
-                ).fetchall()
+                delta_series, delta_counts = self._fetch(
+                    database, series, fetch_oldest, curr_newest, counts=count_series is not None
+                )
             else:
-                # only fetch new buckets if any
+                # only compute new buckets if any
                 _, prev_newest = series.buckets.bucket_bounds(prev_timestamp)
                 if curr_newest == prev_newest:
                     continue
-                else:
-                    # print(f"{key} fetching {prev_newest}..{curr_newest}")
-                    # print(f"Fetching new buckets for '{key}'")
-                    new_items = database.fetch_series_items(
-                        series.kind, series.buckets.bucket_size, prev_newest, curr_newest
-                    ).fetchall()
+                delta_series, delta_counts = self.open_samples[series.kind].aggregate(
+                    series.buckets, prev_newest, curr_newest
+                )
+
+            if count_series is not None:
+                count_series.extend_series(delta_counts)
 
             # skip processing and sending message if there are no new items
-            if len(new_items) == 0:
+            if len(delta_series) == 0:
                 continue
 
             # put into cached series
-            series.extend_items(new_items)
-
-            # put into delta series
-            delta_series = Series.empty_like(series)
-            delta_series.extend_items(new_items)
+            series.extend_series(delta_series)
             delta_multi_series.map[key] = delta_series
 
+        for kind, open_samples in self.open_samples.items():
+            table = kind.value.table
+            if table not in updated_tables:
+                continue
+
+            if table not in self.live_tables:
+                # the samples in the open buckets, including the ones from before a restart and from `msg` itself
+                open_oldest = self._open_oldest(kind, curr_timestamp)
+                open_samples.add_items(database.fetch_series_items(kind, None, open_oldest, None))
+
+            open_samples.drop_before(self._open_oldest(kind, curr_timestamp))
+
         # update table last timestamps
         for table in updated_tables:
             self.table_last_timestamp[table] = curr_timestamp
+        self.live_tables |= updated_tables
 
         return delta_multi_series
 
     def get_history(self) -> MultiSeries:
-        return self.multi_series.clone()
+        return MultiSeries({
+            key: series.clone() for key, series in self._all_series()
+        })
+
+    def default_keys(self) -> List[str]:
+        """
+        The series clients get when they don't subscribe to anything specific.
+        """
+        return list(self.multi_series.map)
+
+    def get_view(self) -> 'TrackerView':
+        return TrackerView(self.multi_series.clone(), self.count_series.clone(), dict(self.table_last_timestamp))
+
+
+@dataclass
+class TrackerView:
+    """
+    Read-only snapshot of the `Tracker` state, it shares the append-only buffers of the tracker so it is cheap to take
+    and can be used from any thread afterwards.
+    """
+    multi_series: MultiSeries
+    count_series: MultiSeries
+    table_last_timestamp: Dict[str, int]
+
+    def covered_range(self, key: str) -> Optional[Tuple[int, int]]:
+        """
+        The range `oldest..newest` for which series `key` contains all finished buckets.
+        """
+        series = self.multi_series.map[key]
+        last_timestamp = self.table_last_timestamp.get(series.kind.value.table)
+        if last_timestamp is None:
+            return None
+
+        _, newest = series.buckets.bucket_bounds(last_timestamp)
+        return newest - series.buckets.window_size, newest
+
+    def fetch(
+            self, kind: SeriesKind, bucket_size: Optional[int],
+            oldest: Optional[int], newest: Optional[int]
+    ) -> Optional[Tuple[Series, int, int]]:
+        """
+        Compute the part of `Database.fetch_series_items` that can be derived from the tracked series,
+        possibly by merging their buckets into larger ones.
+        Returns the series and the range `start..end` it covers, or None if nothing is covered.
+        The range never splits a bucket, so the rest can be fetched from the database separately.
+        """
+        best = None
+
+        for key, series in self.multi_series.map.items():
+            tracked_size = series.buckets.bucket_size
+            if series.kind != kind or series.buckets.aggregation != Aggregation.MEAN:
+                continue
+            if tracked_size is not None and (bucket_size is None or bucket_size % tracked_size != 0):
+                continue
+
+            covered = self.covered_range(key)
+            if covered is None:
+                continue
+
+            step = bucket_size or 1
+            start = -(-covered[0] // step) * step
+            end = covered[1] // step * step
+            if oldest is not None:
+                start = max(start, -(-oldest // step) * step)
+            if newest is not None:
+                end = min(end, newest // step * step)
+            if start >= end:
+                continue
+
+            # prefer the series that covers the most, then the one with the fewest items
+            rank = (end - start, tracked_size or 0)
+            if best is None or rank > best[0]:
+                best = (rank, key, start, end)
+
+        if best is None:
+            return None
+
+        _, key, start, end = best
+        return self._merge_buckets(key, bucket_size, start, end), start, end
+
+    def _merge_buckets(self, key: str, bucket_size: Optional[int], start: int, end: int) -> Series:
+        series = self.multi_series.map[key]
+        result = Series.empty(series.kind, Buckets(None, bucket_size))
+
+        lo, hi = np.searchsorted(series.timestamps, [start, end])
+        timestamps = series.timestamps[lo:hi]
+        values = series.values[:, lo:hi]
+        if len(timestamps) == 0:
+            return result
+
+        if bucket_size == series.buckets.bucket_size:
+            result.extend_arrays(timestamps, values)
+            return result
+
+        if series.buckets.bucket_size is None:
+            counts = (~np.isnan(values)).astype(np.float64)
+        else:
+            counts = self.count_series.map[key].values[:, lo:hi]
+
+        merged_timestamps, averages, _ = merge_buckets(timestamps, values, counts, bucket_size)
+        result.extend_arrays(merged_timestamps, averages)
+        return result
+
+
+class WireFormat(enum.Enum):
+    JSON = "json"
+    BINARY = "binary"
+
+
+@dataclass(frozen=True)
+class Payload:
+    """
+    A message encoded once, to be sent as-is to all websocket clients using the same wire format.
+    """
+    type: str
+    keys: List[str]
+    data: Union[str, bytes]
+
+    @staticmethod
+    def encode(ty: str, multi_series: MultiSeries, wire_format: WireFormat, extra: Optional[dict] = None) -> 'Payload':
+        """
+        The fields in `extra` are added to every series.
+        """
+        with metrics.ENCODE_SECONDS.time(ty, wire_format.value):
+            if wire_format == WireFormat.JSON:
+                data = simplejson.dumps({"type": ty, "series": multi_series.to_json(extra)}, ignore_nan=True)
+            elif wire_format == WireFormat.BINARY:
+                data = multi_series.to_binary(ty, extra)
+            else:
+                raise ValueError(f"Unknown wire format: {wire_format}")
+        return Payload(ty, list(multi_series.map.keys()), data)
+
+
+class BroadcastStats:
+    """
+    Counters for encoded and sent websocket payloads, shared between the processor thread and the socket server.
+    These are also the counters exported as metrics, see `server.main.register_metrics`.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.encode_count = 0
+        self.encode_bytes = 0
+        self.send_count = 0
+        self.send_bytes = 0
+
+        self.prev_time = time.perf_counter()
+        self.prev_counts = (0, 0, 0, 0)
+
+    def on_encode(self, payload: Payload):
+        with self.lock:
+            self.encode_count += 1
+            self.encode_bytes += len(payload.data)
+
+    def on_send(self, payload: Payload):
+        with self.lock:
+            self.send_count += 1
+            self.send_bytes += len(payload.data)
+
+    def totals(self) -> Tuple[int, int, int, int]:
+        """
+        The number of encodes, encoded bytes, sends and sent bytes so far.
+        """
+        with self.lock:
+            return self.encode_count, self.encode_bytes, self.send_count, self.send_bytes
+
+    def take_rates(self) -> Tuple[float, float, float, float]:
+        """
+        Return the rates of encodes, encoded bytes, sends and sent bytes per second since the previous call.
+        """
+        with self.lock:
+            now = time.perf_counter()
+            counts = (self.encode_count, self.encode_bytes, self.send_count, self.send_bytes)
+            delta = max(now - self.prev_time, 1e-9)
+            rates = tuple((curr - prev) / delta for curr, prev in zip(counts, self.prev_counts))
+
+            self.prev_time = now
+            self.prev_counts = counts
+            return rates
+
+
+class ClientOutbox:
+    """
+    The bounded outbox of a single websocket client.
+    Updates that pile up while the client is still busy sending are merged into a single update,
+    and a client that falls more than `max_pending` updates behind is resynced with a snapshot instead.
+    `put` can be called from any thread, `get` must be awaited on the event loop that created the outbox.
+    """
+
+    def __init__(
+            self, name: str, wire_format: WireFormat, stats: BroadcastStats, max_pending: int,
+            channels: Optional[Tuple[str, ...]] = None,
+    ):
+        """
+        `channels` are the keys of the series this client subscribed to, None for all broadcast series.
+        """
+        self.name = name
+        self.wire_format = wire_format
+        self.channels = channels
+        # whether the store holds a reference to the custom channels in `channels` for this client
+        self.acquired_channels = False
+        self.stats = stats
+        self.max_pending = max_pending
+
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        self.lock = Lock()
+        self.pending: List[Tuple[MultiSeries, Payload]] = []
+        self.pending_since = 0.0
+        self.needs_resync = False
+
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.max_lag = 0.0
+
+    def put(self, update: MultiSeries, payload: Payload):
+        """
+        Queue an update, `payload` is `update` already encoded in the wire format of this client.
+        """
+        with self.lock:
+            if self.needs_resync:
+                self.dropped += 1
+                return
+
+            if len(self.pending) == 0:
+                self.pending_since = time.perf_counter()
+            self.pending.append((update, payload))
+
+            if len(self.pending) > self.max_pending:
+                self.dropped += len(self.pending)
+                self.resyncs += 1
+                self.pending.clear()
+                self.needs_resync = True
+
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def get(self) -> Optional[Payload]:
+        """
+        Wait for the next payload to send. None means the backlog was dropped and the client needs a new snapshot.
+        """
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+
+            with self.lock:
+                if self.needs_resync:
+                    return None
+                pending = self.pending
+                pending_since = self.pending_since
+                self.pending = []
+
+            if len(pending) > 0:
+                break
+
+        self.max_lag = max(self.max_lag, time.perf_counter() - pending_since)
+        self.sent += 1
+
+        # the common case, the payload is shared with all other clients
+        if len(pending) == 1:
+            return pending[0][1]
+
+        # the updates are shared with the other clients too, so merge into copies
+        merged = MultiSeries({})
+        for update, _ in pending:
+            merged.extend(update.clone())
+        self.merged += len(pending) - 1
+
+        payload = Payload.encode("update", merged, self.wire_format)
+        self.stats.on_encode(payload)
+        return payload
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.needs_resync = False
+
+    def backlog(self) -> Tuple[int, float]:
+        """
+        The number of pending updates and how long the oldest one has been waiting in seconds, read together.
+        """
+        with self.lock:
+            if len(self.pending) == 0:
+                return 0, 0.0
+            return len(self.pending), time.perf_counter() - self.pending_since
+
+    def lag(self) -> float:
+        """
+        How long the oldest pending update has been waiting, in seconds.
+        """
+        return self.backlog()[1]
+
+    def take_summary(self) -> str:
+        pending, lag = self.backlog()
+        max_lag = max(self.max_lag, lag)
+        self.max_lag = lag
+
+        return (
+            f"Client {self.name}: {pending} pending, lag {lag:.2f}s (max {max_lag:.2f}s), "
+            f"{self.sent} sent, {self.merged} merged, {self.dropped} dropped, {self.resyncs} resyncs"
+        )
+
+
+def select_channels(multi_series: MultiSeries, channels: Optional[Tuple[str, ...]]) -> MultiSeries:
+    """
+    The series of `multi_series` in `channels`, all of them if `channels` is None.
+    """
+    if channels is None:
+        return multi_series
+    return MultiSeries({key: multi_series.map[key] for key in channels if key in multi_series.map})
+
+
+def broadcast_update(outboxes: Iterable[ClientOutbox], update_series: MultiSeries, encode: Callable):
+    """
+    Put the part of `update_series` each outbox subscribed to in it, even if that is empty so the clients know the
+    server is alive. Every distinct combination of wire format and series is encoded only once, using
+    `encode(ty, multi_series, wire_format)`.
+    """
+    payloads: Dict[Tuple[WireFormat, Tuple[str, ...]], Payload] = {}
+    for outbox in outboxes:
+        update = select_channels(update_series, outbox.channels)
+        payload_key = (outbox.wire_format, tuple(update.map))
+        if payload_key not in payloads:
+            payloads[payload_key] = encode("update", update, outbox.wire_format)
+        outbox.put(update, payloads[payload_key])
 
 
 class DataStore:
-    def __init__(self, database: Database):
+    def __init__(
+            self, database: Database,
+            max_pending: int = MAX_PENDING_UPDATES,
+            snapshot_path: Optional[str] = None,
+            retention: Optional[RetentionPolicy] = None,
+    ):
+        """
+        If `snapshot_path` is given the tracker state is restored from there if possible,
+        and saved there periodically and by `save_snapshot`.
+        If `retention` is given old raw samples are removed a bit at a time by `run_maintenance`.
+        """
         self.database = database
         self.tracker = Tracker()
 
+        self.retention = retention
+        self.prev_retention = time.perf_counter() - RETENTION_PERIOD
+
+        self.snapshot_path = snapshot_path
+        self.prev_snapshot = time.perf_counter()
+        if snapshot_path is not None:
+            self.tracker.load_snapshot(snapshot_path, database)
+
         self.lock = Lock()
-        self.broadcast_queues: Set[JQueue] = set()
+        self.outboxes: Set[ClientOutbox] = set()
+        self.max_pending = max_pending
+
+        # the number of subscribers of each custom channel, the series is removed when that drops to zero
+        self.channel_refs: Dict[str, int] = {}
+        # custom series are filled from the socket server threads, which can't use the writer connection
+        self.read_database: Optional[Database] = None
+        # only one channel is filled at a time, the fills share `read_database`
+        self.channel_lock = Lock()
+        # fills channels for the websocket clients in the threaded runtime, off the event loop
+        self.channel_executor = ThreadPoolExecutor(1, thread_name_prefix="channels")
+
+        # the encoded history per wire format and channels, only valid until the next non-empty update
+        self.initial_payloads: Dict[Tuple[WireFormat, Optional[Tuple[str, ...]]], Payload] = {}
+        self.stats = BroadcastStats()
+
+    def _encode(
+            self, ty: str, multi_series: MultiSeries, wire_format: WireFormat, extra: Optional[dict] = None
+    ) -> Payload:
+        payload = Payload.encode(ty, multi_series, wire_format, extra)
+        self.stats.on_encode(payload)
+        return payload
 
     def process_message(self, msg: Message):
+        self.process_messages([msg])
+
+    def process_messages(self, msgs: List[Message]):
+        """
+        Insert a batch of messages with a single commit and broadcast a single combined update.
+        The update contains the same buckets as processing the messages one by one would produce.
+        """
         with self.lock:
-            # print(f"Processing message {msg}")
-
-            # add to database
-            updated_tables = self.database.insert(msg)
-
-            # update trackers
-            # careful, we've already added the new values to the database
-            # TODO we're sending two messages in a short timespan (eg. if power and water both update), fix this
-            update_series = self.tracker.update(
-                self.database,
-                updated_tables=updated_tables,
-                curr_timestamp=msg.timestamp
+            update_series = self.apply_messages(msgs)
+
+            if len(update_series.map) > 0:
+                self.initial_payloads.clear()
+
+            broadcast_update(self.outboxes, update_series, self._encode)
+
+    def apply_messages(self, msgs: List[Message]) -> MultiSeries:
+        """
+        Insert a batch of messages and update the trackers, without broadcasting anything.
+        Returns the combined update, the caller is responsible for locking.
+        """
+        # print(f"Processing {len(msgs)} messages")
+
+        # add to database
+        with metrics.INSERT_SECONDS.time():
+            self.database.insert_many(msgs)
+        metrics.INSERT_MESSAGES.inc(amount=len(msgs))
+
+        # update trackers
+        # careful, we've already added the new values to the database
+        update_series = MultiSeries({})
+        for msg in msgs:
+            with metrics.TRACKER_UPDATE_SECONDS.time():
+                update_series.extend(self.tracker.update(self.database, msg))
+
+        now = time.perf_counter()
+        if self.snapshot_path is not None and now - self.prev_snapshot > SNAPSHOT_PERIOD:
+            self.prev_snapshot = now
+            self.tracker.save_snapshot(self.snapshot_path, self.database)
+
+        return update_series
+
+    def run_maintenance(self):
+        """
+        Remove raw samples outside of the retention window for at most `RETENTION_BUDGET` seconds.
+        Called by the writer between batches, without holding the lock, so it never delays a batch for long.
+        """
+        now = time.perf_counter()
+        if self.retention is None or now - self.prev_retention < RETENTION_PERIOD:
+            return
+        self.prev_retention = now
+
+        progress = {}
+        for table, raw_since in self.database.retention.run(self.retention, RETENTION_BUDGET):
+            progress[table] = raw_since
+        for table, raw_since in progress.items():
+            print(f"Retention: raw '{table}' samples before {raw_since} removed")
+
+    def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        with self.lock:
+            self.tracker.save_snapshot(self.snapshot_path, self.database)
+        print(f"Saved tracker snapshot '{self.snapshot_path}'")
+
+    def _initial_payload(self, wire_format: WireFormat, channels: Optional[Tuple[str, ...]]) -> Payload:
+        payload_key = (wire_format, channels)
+        if payload_key not in self.initial_payloads:
+            history = select_channels(self.tracker.get_history(), channels)
+            self.initial_payloads[payload_key] = self._encode(
+                "initial", history, wire_format, {"layout": history.layout()}
             )
+        return self.initial_payloads[payload_key]
+
+    def channel_keys(self, names: Optional[List[str]]) -> Tuple[str, ...]:
+        """
+        The series keys for the channels a client asked for, None means the default series.
+        Channels are either the key of a default series or a custom channel, see `parse_custom_channel`.
+        Raises ValueError for invalid channels.
+        """
+        default_keys = self.tracker.default_keys()
+        if names is None:
+            return tuple(default_keys)
+
+        keys = []
+        for name in names:
+            key = name if name in default_keys else parse_custom_channel(name)[0]
+            if key not in keys:
+                keys.append(key)
+        return tuple(keys)
+
+    def _open_read_database(self):
+        if self.read_database is None:
+            self.read_database = Database.open_read_only(self.database.path)
+
+    def acquire_channels(self, keys: Iterable[str]) -> MultiSeries:
+        """
+        Take a reference to the custom channels in `keys`, the series of channels that had no subscribers yet are
+        created and filled from the database. Returns the current series of those custom channels.
+        The database is read without holding the lock, only what changed while filling is fetched while holding it.
+        """
+        keys = list(keys)
+        with self.channel_lock:
+            with self.lock:
+                last_timestamps = {}
+                for key in keys:
+                    if key not in self.tracker.multi_series.map and key not in self.channel_refs:
+                        _, kind, buckets = parse_custom_channel(key)
+                        last_timestamps[key] = self.tracker.table_last_timestamp.get(kind.value.table)
+
+            fills = {}
+            if len(last_timestamps) > 0:
+                self._open_read_database()
+                self.read_database.rollups.refresh()
+                for key, last_timestamp in last_timestamps.items():
+                    _, kind, buckets = parse_custom_channel(key)
+                    fills[key] = Tracker.fill_series(kind, buckets, self.read_database, last_timestamp)
+
+            with self.lock:
+                return self._acquire_channels(keys, fills)
+
+    def _acquire_channels(self, keys: Iterable[str], fills: Dict[str, SeriesFill]) -> MultiSeries:
+        # either all channels are acquired or none are
+        result = MultiSeries({})
+        try:
+            for key in keys:
+                if key in self.tracker.multi_series.map:
+                    continue
 
-            # broadcast update series to sockets
-            for queue in self.broadcast_queues:
-                queue.sync_q.put(update_series)
+                if key not in self.channel_refs:
+                    print(f"Creating channel '{key}'")
+                    self._open_read_database()
+                    _, kind, buckets = parse_custom_channel(key)
+                    self.tracker.add_series(key, kind, buckets, self.read_database, fills.get(key))
+                    self.channel_refs[key] = 0
+                    self.initial_payloads.clear()
+
+                self.channel_refs[key] += 1
+                result.map[key] = self.tracker.custom_series.map[key].clone()
+        except BaseException:
+            self._release_channels(result.map)
+            raise
+        return result
+
+    def release_channels(self, keys: Iterable[str]):
+        with self.lock:
+            self._release_channels(keys)
 
-    def add_broadcast_queue_get_data(self, queue: JQueue) -> MultiSeries:
+    def _release_channels(self, keys: Iterable[str]):
+        for key in keys:
+            if key not in self.channel_refs:
+                continue
+            self.channel_refs[key] -= 1
+            if self.channel_refs[key] == 0:
+                print(f"Removing channel '{key}'")
+                del self.channel_refs[key]
+                self.tracker.remove_series(key)
+                self.initial_payloads.clear()
+
+    def get_view(self) -> TrackerView:
+        """
+        Thread-safe, read-only view of the tracked series.
+        """
         with self.lock:
-            self.broadcast_queues.add(queue)
-            return self.tracker.get_history()
+            return self.tracker.get_view()
+
+    async def add_outbox_get_initial(self, outbox: ClientOutbox, resume: Optional[Resume] = None) -> Payload:
+        """
+        Start broadcasting to `outbox` and return the first payload to send: only the missing buckets if the client
+        can `resume`, otherwise a full snapshot. New custom channels are filled on `channel_executor`, so they don't
+        hold up the event loop.
+        """
+        def acquire():
+            self.acquire_channels(outbox.channels or ())
+            outbox.acquired_channels = True
+
+        await asyncio.get_running_loop().run_in_executor(self.channel_executor, acquire)
 
-    def remove_broadcast_queue(self, queue: JQueue):
         with self.lock:
-            self.broadcast_queues.remove(queue)
+            self.outboxes.add(outbox)
+
+            history = select_channels(self.tracker.get_history(), outbox.channels)
+            missing = resume.missing(history) if resume is not None else None
+            if missing is not None:
+                return self._encode("resume", missing, outbox.wire_format)
+            return self._initial_payload(outbox.wire_format, outbox.channels)
+
+    def resync_outbox(self, outbox: ClientOutbox) -> Payload:
+        """
+        Drop the backlog of `outbox` and return a fresh snapshot, consistent with the updates that follow it.
+        """
+        with self.lock:
+            outbox.clear()
+            return self._initial_payload(outbox.wire_format, outbox.channels)
+
+    async def remove_outbox(self, outbox: ClientOutbox):
+        """
+        Stop broadcasting to `outbox`, also if `add_outbox_get_initial` failed before it was added.
+        The channels are released on `channel_executor`, after an acquire that might still be running there.
+        """
+        with self.lock:
+            self.outboxes.discard(outbox)
+
+        def release():
+            with self.lock:
+                if outbox.acquired_channels:
+                    outbox.acquired_channels = False
+                    self._release_channels(outbox.channels or ())
+
+        await asyncio.get_running_loop().run_in_executor(self.channel_executor, release)
@@ -0,0 +1,121 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from server.kinds import Aggregation
+from server.rollup import ROLLUP_RESOLUTIONS
+
+# Buckets are built from at least this many sub-buckets, so the points within a bucket are more than its average.
+MIN_SUB_BUCKETS = 4
+
+
+def source_resolution(bucket_size: int) -> Optional[int]:
+    """
+    The resolution of the sub-buckets used to downsample to `bucket_size`: the coarsest rollup resolution that fits
+    `MIN_SUB_BUCKETS` times in a bucket, preferring ones that divide the bucket size. None means raw samples.
+    """
+    fitting = [r for r in ROLLUP_RESOLUTIONS if r * MIN_SUB_BUCKETS <= bucket_size]
+    dividing = [r for r in fitting if bucket_size % r == 0]
+    return max(dividing or fitting, default=None)
+
+
+def sub_buckets(
+        timestamps: np.ndarray, values: np.ndarray, resolution: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group sorted raw samples into buckets of `resolution`, the same buckets the rollups store.
+    Returns the timestamps, averages, minima and maxima, missing values are ignored.
+    """
+    merged_timestamps, first = np.unique(timestamps // resolution * resolution, return_index=True)
+    present = ~np.isnan(values)
+    sums = np.add.reduceat(np.where(present, values, 0.0), first, axis=1)
+    counts = np.add.reduceat(present, first, axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    with np.errstate(invalid="ignore"):
+        mins = np.fmin.reduceat(values, first, axis=1)
+        maxs = np.fmax.reduceat(values, first, axis=1)
+    return merged_timestamps, means, mins, maxs
+
+
+def lttb_indices(timestamps: np.ndarray, values: np.ndarray, first: np.ndarray) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets: in every bucket pick the point that forms the largest triangle with the point
+    picked in the previous bucket and the average of the next bucket. The bucket boundaries are given by the `first`
+    index of each one. The first and last point are always kept, series with multiple columns are ranked on the sum.
+    """
+    x = timestamps.astype(np.float64)
+    y = np.nansum(values, axis=0)
+    bounds = np.append(first, len(x))
+
+    picked = np.empty(len(first), dtype=np.int64)
+    picked[0] = 0
+    for i in range(1, len(first) - 1):
+        start, end, next_end = bounds[i], bounds[i + 1], bounds[i + 2]
+        prev_x, prev_y = x[picked[i - 1]], y[picked[i - 1]]
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+
+        areas = np.abs((prev_x - next_x) * (y[start:end] - prev_y) - (prev_x - x[start:end]) * (next_y - prev_y))
+        picked[i] = start + np.argmax(areas)
+    if len(first) > 1:
+        picked[-1] = len(x) - 1
+    return picked
+
+
+def extreme_indices(values: np.ndarray, first: np.ndarray, largest: bool) -> np.ndarray:
+    """
+    For every column, the index of the first smallest (or `largest`) value in each bucket, given by the `first` index
+    of each one. Missing values are only picked if the whole bucket is missing.
+    """
+    bucket_index = np.repeat(np.arange(len(first)), np.diff(np.append(first, values.shape[1])))
+    indices = np.empty((len(values), len(first)), dtype=np.int64)
+    for column, column_values in enumerate(values):
+        # stable and with nan last, so sorting within each bucket puts the earliest extreme at its start
+        order = np.lexsort((-column_values if largest else column_values, bucket_index))
+        indices[column] = order[first]
+    return indices
+
+
+def downsample(
+        timestamps: np.ndarray, means: np.ndarray, mins: np.ndarray, maxs: np.ndarray,
+        bucket_size: int, aggregation: Aggregation,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce sorted sub-buckets (or raw samples, with equal means, minima and maxima) to buckets of `bucket_size`
+    with `aggregation.points_per_bucket` points each.
+    Every point keeps the timestamp of the sub-bucket it was taken from, and the minimum and maximum are in the order
+    they occurred in. The columns share their timestamps, so those of the extremes are the earliest and latest of all
+    columns. The first and last point of M4 are the first and last sub-bucket, which are only exact for raw samples.
+    """
+    assert aggregation != Aggregation.MEAN, "Mean buckets are computed by the database queries"
+    if len(timestamps) == 0:
+        return timestamps, means
+
+    _, first = np.unique(timestamps // bucket_size * bucket_size, return_index=True)
+    if aggregation == Aggregation.LTTB:
+        picked = lttb_indices(timestamps, means, first)
+        return timestamps[picked], means[:, picked]
+
+    min_at = extreme_indices(mins, first, largest=False)
+    max_at = extreme_indices(maxs, first, largest=True)
+    bucket_mins = np.take_along_axis(mins, min_at, axis=1)
+    bucket_maxs = np.take_along_axis(maxs, max_at, axis=1)
+
+    min_first = min_at <= max_at
+    extremes = [np.where(min_first, bucket_mins, bucket_maxs), np.where(min_first, bucket_maxs, bucket_mins)]
+    extreme_timestamps = [
+        timestamps[np.minimum(min_at, max_at).min(axis=0)], timestamps[np.maximum(min_at, max_at).max(axis=0)]
+    ]
+
+    if aggregation == Aggregation.MIN_MAX:
+        points, point_timestamps = extremes, extreme_timestamps
+    elif aggregation == Aggregation.M4:
+        last = np.append(first[1:], len(timestamps)) - 1
+        points = [means[:, first], *extremes, means[:, last]]
+        point_timestamps = [timestamps[first], *extreme_timestamps, timestamps[last]]
+    else:
+        raise ValueError(f"Unknown aggregation {aggregation}")
+
+    point_values = np.stack(points, axis=2).reshape(len(means), -1)
+    return np.stack(point_timestamps, axis=1).reshape(-1), point_values
@@ -1,15 +1,41 @@
+import argparse
 import itertools
 import math
 import random
 import time
+from dataclasses import dataclass
 from queue import Queue as QQueue
 from threading import Thread
+from typing import Callable, Optional
 
 from inputs.adc import ADCMessage
 from inputs.parse import MeterMessage
+from inputs.serial_frames import TelegramReader, crc16
 from server.main import server_main
 
 
+def build_telegram(timestamp: int) -> bytes:
+    """
+    Build a telegram with a valid CRC, using the same fields as the real meter.
+    """
+    timestamp_str = time.strftime("%y%m%d%H%M%S", time.gmtime(timestamp + 3600)) + "W"
+    powers = [random.random() * 3 for _ in range(3)]
+    lines = [
+        "/FLU5\\253769484_A",
+        "",
+        "0-0:96.1.4(50217)",
+        f"0-0:1.0.0({timestamp_str})",
+        "1-0:1.8.1(000123.456*kWh)",
+        f"1-0:1.6.0({timestamp_str})(02.345*kW)",
+        *(f"1-0:{k}1.7.0({p:06.3f}*kW)" for k, p in zip([2, 4, 6], powers)),
+        *(f"1-0:{k}2.7.0(230.0*V)" for k in [3, 5, 7]),
+        f"0-1:24.2.3({timestamp_str})(01597.404*m3)",
+        "!",
+    ]
+    frame = "\r\n".join(lines).encode()
+    return frame + b"%04X\r\n" % crc16(frame)
+
+
 def run_dummy_parser(message_queue: QQueue):
     t = time.time()
     start = t
@@ -45,11 +71,98 @@ def run_dummy_adc(queue: QQueue):
         time.sleep(2)
 
 
+@dataclass
+class ReplayConfig:
+    # meter timestamp of the first telegram, one telegram per meter second after that
+    start: int
+    # number of meter seconds to replay, None to keep going forever
+    count: Optional[int] = None
+    # telegrams per wall clock second, None for as fast as possible
+    rate: Optional[float] = 1.0
+    # telegrams that arrive at once, the average rate stays the same
+    burst: int = 1
+    # chance per telegram that the meter goes silent for `gap_length` seconds
+    gap_probability: float = 0.0
+    gap_length: int = 60
+    # chance per telegram that the meter clock jumps `jump` seconds forwards or backwards
+    jump_probability: float = 0.0
+    jump: int = 3600
+    # meter seconds between ADC messages, 0 for none
+    adc_period: int = 2
+    seed: int = 0
+
+
+def run_replay(put: Callable, config: ReplayConfig, on_put: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Generate telegrams according to `config` and pass them through the same framing and parsing as the serial input,
+    then `put` the messages. `on_put` is called with the timestamp of every telegram right after its message was put.
+    Returns the number of messages that were put.
+    """
+    rng = random.Random(config.seed)
+    reader = TelegramReader(stats_period=math.inf)
+    timestamp = config.start
+    remaining = config.count
+    put_count = 0
+    wall_next = time.perf_counter()
+
+    while remaining is None or remaining > 0:
+        size = config.burst if remaining is None else min(config.burst, remaining)
+        if remaining is not None:
+            remaining -= size
+
+        chunk = []
+        for _ in range(size):
+            if rng.random() < config.gap_probability:
+                timestamp += config.gap_length
+            if rng.random() < config.jump_probability:
+                timestamp += rng.choice([-1, 1]) * config.jump
+            chunk.append(timestamp)
+            timestamp += 1
+
+        messages = reader.push(b"".join(build_telegram(t) for t in chunk))
+        if config.adc_period > 0:
+            messages += [
+                ADCMessage(timestamp=t, voltage_int=rng.randrange(1024))
+                for t in chunk if t % config.adc_period == 0
+            ]
+            messages.sort(key=lambda msg: msg.timestamp)
+
+        for msg in messages:
+            put(msg)
+            put_count += 1
+            if on_put is not None and isinstance(msg, MeterMessage):
+                on_put(msg.timestamp)
+
+        if config.rate is not None:
+            wall_next += size / config.rate
+            time.sleep(max(0.0, wall_next - time.perf_counter()))
+
+    return put_count
+
+
 def main():
+    parser = argparse.ArgumentParser(prog="dummy_server")
+    parser.add_argument("--database", default="dummy.db")
+    parser.add_argument(
+        "--rate", type=float,
+        help="replay synthetic telegrams at this many per second instead of real-time dummy messages"
+    )
+    parser.add_argument("--burst", type=int, default=1, help="with --rate, telegrams that arrive at once")
+    parser.add_argument("--gap-probability", type=float, default=0.0)
+    parser.add_argument("--jump-probability", type=float, default=0.0)
+    args = parser.parse_args()
+
     message_queue = QQueue()
-    Thread(target=run_dummy_parser, args=(message_queue,)).start()
-    Thread(target=run_dummy_adc, args=(message_queue,)).start()
-    server_main("dummy.db", message_queue)
+    if args.rate is None:
+        Thread(target=run_dummy_parser, args=(message_queue,)).start()
+        Thread(target=run_dummy_adc, args=(message_queue,)).start()
+    else:
+        config = ReplayConfig(
+            start=int(time.time()), rate=args.rate, burst=args.burst,
+            gap_probability=args.gap_probability, jump_probability=args.jump_probability,
+        )
+        Thread(target=run_replay, args=(message_queue.put, config)).start()
+    server_main(args.database, message_queue)
 
 
 if __name__ == '__main__':
@@ -1,23 +1,33 @@
+import math
 import mimetypes
+import zlib
 from dataclasses import dataclass
 from enum import auto, Enum
-from io import StringIO
 from threading import Thread
-from typing import Optional
+from typing import Optional, Sequence
 
 import flask
+import numpy as np
 import simplejson
 from flask import Flask, Response, current_app, request
 
-from server.data import Database, Series, Buckets, SeriesKind
+from server import metrics
+from server.cache import SeriesCache, closed_until
+from server.data import Series, Buckets, SeriesKind, MultiSeries, DataStore, Database
+from server.kinds import Aggregation
+from server.pool import DatabasePool, PoolTimeout
 
 app = Flask(__name__, static_url_path="", static_folder="../resources")
 
+# how long a download waits for a database connection, streaming downloads keep theirs until they are closed
+POOL_TIMEOUT = 10
+
 
 class DownloadType(Enum):
     CSV = auto()
     CSV_BE = auto()
     JSON = auto()
+    BINARY = auto()
 
 
 @dataclass
@@ -27,6 +37,12 @@ class DownloadParams:
     newest: Optional[int]
     type: DownloadType
     kind: SeriesKind
+    # csv only: number of decimals for the values, None to use the full precision
+    precision: Optional[int] = None
+    # csv only: compress the response if the client accepts it
+    gzip: bool = False
+    # how the samples in each bucket are reduced, everything except the mean needs a bucket size and a bounded range
+    aggregation: Aggregation = Aggregation.MEAN
 
 
 class ParseDownloadError(ValueError):
@@ -74,6 +90,12 @@ def parse_download_params(args, ext: str) -> DownloadParams:
         else:
             raise ValueError()
 
+        curr_arg = "aggregation"
+        aggregation = Aggregation(args.pop("aggregation", "mean"))
+        if aggregation != Aggregation.MEAN:
+            if bucket_size is None or bucket_size < aggregation.points_per_bucket:
+                raise ValueError()
+
         curr_arg = "type"
         if ext == "csv":
             csv_types = {
@@ -82,8 +104,22 @@ def parse_download_params(args, ext: str) -> DownloadParams:
             }
             csv_format = args.pop("format", "csv")
             ty = csv_types[csv_format]
+
+            curr_arg = "precision"
+            precision = args.pop("precision", None)
+            if precision is not None:
+                precision = int(precision)
+                if not (0 <= precision <= 17):
+                    raise ValueError()
+
+            curr_arg = "gzip"
+            gzip = {"true": True, "false": False}[args.pop("gzip", "false")]
         elif ext == "json":
             ty = DownloadType.JSON
+            precision, gzip = None, False
+        elif ext == "bin":
+            ty = DownloadType.BINARY
+            precision, gzip = None, False
         else:
             raise ValueError()
 
@@ -97,57 +133,212 @@ def parse_download_params(args, ext: str) -> DownloadParams:
     if len(args) > 0:
         raise ParseDownloadError(f"<p>Unused parameters {flask.escape(list(args.keys()))}</p>")
 
-    return DownloadParams(bucket_size, oldest, newest, ty, quantity)
+    params = DownloadParams(bucket_size, oldest, newest, ty, quantity, precision, gzip, aggregation)
+    if aggregation != Aggregation.MEAN and not fits_in_memory(params):
+        raise ParseDownloadError("<p>Aggregated downloads need a bounded range of at most 1e6 buckets</p>")
+    return params
+
+
+def csv_row_format(column_count: int, precision: Optional[int], sep: str) -> str:
+    # %r formats floats, ints and None exactly like str does
+    value_format = "%r" if precision is None else f"%.{precision}f"
+    return sep.join(["%d"] + [value_format] * column_count) + "\n"
+
+
+def format_csv_batch(batch, row_format: str, csv_be_mode: bool) -> str:
+    try:
+        text = "".join(map(row_format.__mod__, batch))
+    except TypeError:
+        # fixed precision formats don't accept None, so replace missing values with nan
+        text = "".join(row_format % tuple(math.nan if d is None else d for d in x) for x in batch)
+
+    if csv_be_mode:
+        text = text.replace(".", ",")
+    return text
+
+
+def series_rows(series: Series) -> list:
+    """
+    The rows of `series` like `Database.fetch_series_items` returns them, with None for missing values.
+    """
+    values = series.values.astype(object)
+    values[np.isnan(series.values)] = None
+    return list(zip(series.timestamps.tolist(), *values.tolist()))
 
 
 def generate_csv(params: DownloadParams, database, csv_be_mode: bool):
     sep = "\t" if csv_be_mode else ","
+    row_format = csv_row_format(len(params.kind.value.columns), params.precision, sep)
+    use_gzip = params.gzip and "gzip" in request.accept_encodings
 
-    def generate():
+    def generate_text():
         titles = ["timestamp"] + params.kind.value.columns
         yield sep.join(titles) + "\n"
 
-        # convert data to string in batches, using StringIO for string concatenation
-        data = database.fetch_series_items(params.kind, params.bucket_size, params.oldest, params.newest)
-        while True:
-            batch = data.fetchmany(10 * 1024)
-            if len(batch) == 0:
-                break
+        # format the data in batches, a whole batch at once
+        if params.aggregation == Aggregation.MEAN:
+            data = database.fetch_series_items(params.kind, params.bucket_size, params.oldest, params.newest)
+            batches = iter(lambda: data.fetchmany(10 * 1024), [])
+        else:
+            # aggregated series are bounded and computed in memory
+            rows = series_rows(fetch_download_series(params, database)[0])
+            batches = (rows[i:i + 10 * 1024] for i in range(0, len(rows), 10 * 1024))
+
+        for batch in batches:
+            yield format_csv_batch(batch, row_format, csv_be_mode)
+
+    def generate_gzip():
+        compressor = zlib.compressobj(wbits=31)
+        for text in generate_text():
+            chunk = compressor.compress(text.encode())
+            if len(chunk) > 0:
+                yield chunk
+        yield compressor.flush()
+
+    if use_gzip:
+        response = app.response_class(generate_gzip(), mimetype="text/csv")
+        response.headers["Content-Encoding"] = "gzip"
+        return response
+    else:
+        return app.response_class(generate_text(), mimetype="text/csv")
+
+
+def fits_in_memory(params: DownloadParams) -> bool:
+    """
+    Whether the requested range has at most 1e6 buckets, raw samples count as 1 s buckets.
+    """
+    if params.oldest is None or params.newest is None:
+        return False
+    return (params.newest - params.oldest) / (params.bucket_size or 1) <= 1e6
+
+
+def fetch_download_series(params: DownloadParams, database) -> (Series, Optional[str], bool):
+    """
+    Fetch the requested series through the cache,
+    returns the series, an optional error and whether the range is entirely in the past.
+    """
+    # don't allow infinitely large binary requests,
+    #   since we don't stream the output and could run out of memory
+    if not fits_in_memory(params):
+        return Series.empty(params.kind, Buckets(None, params.bucket_size)), "too many items requested", False
+
+    if params.aggregation != Aggregation.MEAN:
+        # not cached, these are bounded previews that are cheap to compute from the rollups
+        buckets = Buckets(None, params.bucket_size, params.aggregation)
+        series = database.fetch_aggregated(params.kind, buckets, params.oldest, params.newest)
+        last_timestamp = database.last_timestamp(params.kind.value.table)
+        closed = closed_until(params.bucket_size, params.oldest, params.newest, last_timestamp) >= params.newest
+        return series, None, closed
+
+    series, closed = fetch_series(database, params.kind, params.bucket_size, params.oldest, params.newest)
+    return series, None, closed
+
+
+def fetch_series(
+        database: Database, kind: SeriesKind, bucket_size: Optional[int], oldest: int, newest: int
+) -> (Series, bool):
+    """
+    Fetch a bounded series, the part covered by the live tracker series is taken from memory
+    and only the rest is fetched through the cache.
+    Returns the series and whether the range is entirely in the past.
+    """
+    cache: SeriesCache = current_app.config["series_cache"]
+    store: Optional[DataStore] = current_app.config["store"]
+
+    live = store.get_view().fetch(kind, bucket_size, oldest, newest) if store is not None else None
+    if live is None:
+        series, closed = cache.fetch(database, kind, bucket_size, oldest, newest)
+        print(f"Series cache: {cache.stats_str()}")
+        return series, closed
+
+    live_series, start, end = live
+    print(f"Live series: {len(live_series)} buckets between {start} and {end} from memory")
+
+    series = Series.empty(kind, Buckets(None, bucket_size))
+    if oldest < start:
+        series.extend_series(cache.fetch(database, kind, bucket_size, oldest, start)[0])
+    series.extend_series(live_series)
+    if end < newest:
+        tail, closed = cache.fetch(database, kind, bucket_size, end, newest)
+        series.extend_series(tail)
+    else:
+        closed = closed_until(bucket_size, oldest, newest, database.last_timestamp(kind.value.table)) >= newest
+
+    if oldest < start or end < newest:
+        print(f"Series cache: {cache.stats_str()}")
+    return series, closed
+
 
-            writer = StringIO()
-            for x in batch:
-                line = sep.join(str(d) for d in x) + "\n"
-                if csv_be_mode:
-                    line = line.replace(".", ",")
-                writer.write(line)
-            yield writer.getvalue()
+def make_cacheable(response: Response) -> Response:
+    """
+    Allow clients to cache a response for a range that is entirely in the past and can no longer change.
+    The ETag is a hash of the body, so the rows changing anyway (a late import, retention) is still noticed.
+    """
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 60 * 60
+    response.add_etag()
+    return response.make_conditional(request)
 
-        # TODO if the user cancels the request this code does not run, are we leaking stuff?
-        database.close()
 
-    return app.response_class(generate(), mimetype="text/csv")
+def generate_json_column(cursor, index: int):
+    """
+    Yield the comma-separated json values of column `index` of all rows in `cursor`, one batch at a time.
+    """
+    first = True
+    while True:
+        batch = cursor.fetchmany(10 * 1024)
+        if len(batch) == 0:
+            break
+
+        items = simplejson.dumps([x[index] for x in batch], ignore_nan=True)[1:-1]
+        yield items if first else ", " + items
+        first = False
 
 
 def generate_json(params: DownloadParams, database):
-    series = Series.empty(params.kind, Buckets(None, params.bucket_size))
+    """
+    Stream the series as json, with the same layout as `Series.to_json`.
+    The query is run once for the timestamps and once for every value column,
+    so the memory use does not depend on the size of the requested range.
+    Small requests are served from the cache instead.
+    """
+    if fits_in_memory(params):
+        series, error, closed = fetch_download_series(params, database)
+        response = app.response_class(simplejson.dumps(series.to_json(), ignore_nan=True), mimetype="application/json")
+        return make_cacheable(response) if closed else response
+
+    def fetch():
+        return database.fetch_series_items(params.kind, params.bucket_size, params.oldest, params.newest)
 
-    # don't allow infinitely large json requests,
-    #   since we don't stream the output and could run out of memory
-    # TODO properly handle missing bucket size here
-    if (params.oldest is None or params.newest is None or
-            (params.bucket_size is not None and (params.newest - params.oldest) / params.bucket_size > 1e6)):
-        error = "too many items requested"
-    else:
-        items = database.fetch_series_items(params.kind, params.bucket_size, params.oldest, params.newest)
-        series.extend_items(items)
-        error = None
+    def generate():
+        header = Series.empty(params.kind, Buckets(None, params.bucket_size)).to_json_header()
+        yield simplejson.dumps(header)[:-1] + ', "timestamps": ['
+
+        # run all passes in a single read transaction, so they all see the same rows
+        database.conn.execute("BEGIN")
+        try:
+            yield from generate_json_column(fetch(), 0)
+            yield '], "values": ['
+
+            for i in range(len(params.kind.value.columns)):
+                yield "[" if i == 0 else ", ["
+                yield from generate_json_column(fetch(), i + 1)
+                yield "]"
+
+            yield "]}"
+        finally:
+            database.conn.rollback()
+
+    return app.response_class(generate(), mimetype="application/json")
 
-    json_dict = series.to_json()
-    if error is not None:
-        json_dict["error"] = error
 
-    json_str = simplejson.dumps(json_dict)
-    return app.response_class(json_str, mimetype="application/json")
+def generate_binary(params: DownloadParams, database):
+    series, error, closed = fetch_download_series(params, database)
+
+    extra = {"error": error} if error is not None else None
+    data = MultiSeries({"download": series}).to_binary("download", extra)
+    response = app.response_class(data, mimetype="application/octet-stream")
+    return make_cacheable(response) if closed else response
 
 
 @app.route("/download/samples_<name>.<ext>")
@@ -164,19 +355,42 @@ def download_samples(name: str, ext: str):
         print(f"Error parsing download parameters: {e}")
         return e.html
 
-    # open new temporary db connection
-    # TODO reuse these? and are we leaking anything?
-    database = Database(current_app.config["database_path"])
+    # the connection is only returned to the pool once the response is closed,
+    #   which also happens if the client cancels a streaming download
+    pool: DatabasePool = current_app.config["database_pool"]
+    try:
+        database = pool.acquire(timeout=POOL_TIMEOUT)
+    except PoolTimeout as e:
+        print(f"Rejecting download: {e}")
+        response = app.response_class("<p>Too many downloads in progress, try again later</p>", status=503)
+        response.headers["Retry-After"] = str(POOL_TIMEOUT)
+        return response
 
-    if params.type == DownloadType.CSV:
-        return generate_csv(params, database, csv_be_mode=False)
-    elif params.type == DownloadType.CSV_BE:
-        return generate_csv(params, database, csv_be_mode=True)
-    elif params.type == DownloadType.JSON:
-        return generate_json(params, database)
-    else:
-        ty_str = f"'{params.type}'"
-        return f"<p>Unknown download type {flask.escape(ty_str)}</p>"
+    try:
+        if params.type == DownloadType.CSV:
+            response = generate_csv(params, database, csv_be_mode=False)
+        elif params.type == DownloadType.CSV_BE:
+            response = generate_csv(params, database, csv_be_mode=True)
+        elif params.type == DownloadType.JSON:
+            response = generate_json(params, database)
+        elif params.type == DownloadType.BINARY:
+            response = generate_binary(params, database)
+        else:
+            ty_str = f"'{params.type}'"
+            response = app.response_class(f"<p>Unknown download type {flask.escape(ty_str)}</p>")
+    except BaseException:
+        pool.release(database)
+        raise
+
+    response.call_on_close(lambda: pool.release(database))
+    return response
+
+
+@app.route("/metrics")
+def metrics_text():
+    if not metrics.REGISTRY.enabled:
+        return app.response_class("<p>Metrics are disabled, start the server with --metrics</p>", status=404)
+    return app.response_class(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/")
@@ -186,6 +400,10 @@ def root():
 
 @app.after_request
 def add_headers(response: Response):
+    # responses that were explicitly made cacheable keep their headers
+    if response.cache_control.max_age is not None:
+        return response
+
     response.cache_control.no_cache = True
     response.cache_control.no_store = True
     response.cache_control.must_revalidate = True
@@ -193,17 +411,24 @@ def add_headers(response: Response):
     return response
 
 
-def flask_main(database_path: str):
+def flask_main(database_path: str, store: Optional[DataStore] = None, ports: Sequence[int] = (8000, 80)):
+    """
+    Run the web server, `store` is used to answer downloads from the live tracker series when given.
+    It can also be a `SharedStore` following the tracker of another process.
+    """
     # fix for window registry being broken
     #  (and for python web apps checking the registry for this in the first place, why???)
     mimetypes.add_type("application/javascript", ".js")
     mimetypes.add_type("text/html", ".html")
 
     app.config["database_path"] = database_path
+    app.config["database_pool"] = DatabasePool(database_path)
+    app.config["series_cache"] = SeriesCache()
+    app.config["store"] = store
 
     threads = []
-    for port in [8000, 80]:
-        def target():
+    for port in ports:
+        def target(port=port):
             app.run(host="0.0.0.0", port=port, threaded=True)
 
         thread = Thread(target=target)
@@ -0,0 +1,92 @@
+import enum
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class SeriesKindInfo:
+    name: str
+    table: str
+    columns: List[str]
+    unit_label: str
+    hline_values: List[float]
+    # size of the values in the binary wire format, float32 is precise enough for everything except gas volumes
+    wire_value_bytes: int = 4
+
+
+WATER_HEIGHT_BASE = 1.733
+WATER_HEIGHT_MAX = 1.98
+WATER_AREA_BASE = 7500 / WATER_HEIGHT_BASE
+WATER_AREA_TOP = 360
+
+WATER_HEIGHT_EXPR = "(voltage_int / 1023.0 * 5.0 - 0.5) / 4.0 * 5.0"
+WATER_VOLUME_EXPR = f"min({WATER_HEIGHT_EXPR} * {WATER_AREA_BASE}, {WATER_HEIGHT_BASE * WATER_AREA_BASE} + ({WATER_HEIGHT_EXPR} - {WATER_HEIGHT_BASE}) * {WATER_AREA_TOP})"
+
+
+def water_height(voltage_int: int) -> float:
+    """
+    Python version of `WATER_HEIGHT_EXPR`, evaluated in the same order so the results are identical.
+    """
+    return (voltage_int / 1023.0 * 5.0 - 0.5) / 4.0 * 5.0
+
+
+def water_volume(voltage_int: int) -> float:
+    """
+    Python version of `WATER_VOLUME_EXPR`.
+    """
+    height = water_height(voltage_int)
+    return min(height * WATER_AREA_BASE, WATER_HEIGHT_BASE * WATER_AREA_BASE + (height - WATER_HEIGHT_BASE) * WATER_AREA_TOP)
+
+
+class SeriesKind(enum.Enum):
+    POWER = SeriesKindInfo(
+        name="power",
+        table="meter_samples",
+        columns=["instant_power_1", "instant_power_2", "instant_power_3"],
+        unit_label="power P (W)",
+        hline_values=[],
+    )
+    GAS = SeriesKindInfo(
+        name="gas",
+        table="gas_samples",
+        columns=["volume"],
+        unit_label="gas volume (m^3)",
+        hline_values=[],
+        wire_value_bytes=8,
+    )
+    WATER_HEIGHT = SeriesKindInfo(
+        name="water-height",
+        table="water_height_samples",
+        columns=[WATER_HEIGHT_EXPR],
+        unit_label="water height (m)",
+        hline_values=[WATER_HEIGHT_BASE, WATER_HEIGHT_MAX],
+    )
+    WATER_VOLUME = SeriesKindInfo(
+        name="water-volume",
+        table="water_height_samples",
+        columns=[WATER_VOLUME_EXPR],
+        unit_label="water volume (l)",
+        hline_values=[
+            WATER_HEIGHT_BASE * WATER_AREA_BASE,
+            WATER_HEIGHT_BASE * WATER_AREA_BASE + (WATER_HEIGHT_MAX - WATER_HEIGHT_BASE) * WATER_AREA_TOP
+        ],
+    )
+
+
+class Aggregation(enum.Enum):
+    """
+    How the samples in a bucket are reduced to plotted points.
+    Everything except `MEAN` keeps short peaks visible, even if a bucket spans many samples.
+    """
+    # the average, one point per bucket
+    MEAN = "mean"
+    # the minimum and maximum, two points per bucket
+    MIN_MAX = "min-max"
+    # the first, minimum, maximum and last value, four points per bucket
+    M4 = "m4"
+    # largest-triangle-three-buckets, the one most significant point per bucket
+    LTTB = "lttb"
+
+    @property
+    def points_per_bucket(self) -> int:
+        return {Aggregation.MIN_MAX: 2, Aggregation.M4: 4}.get(self, 1)
@@ -1,32 +1,263 @@
 import argparse
-import itertools
 import os
 import sqlite3
 import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from multiprocessing import Pool
+from typing import List, Tuple
 
-from inputs.parse import Parser, MeterMessage
+from inputs.fast_parse import FastParser, iter_telegrams
+from server.data import Database
 
 
 def iter_messages(path: str):
-    parser = Parser()
+    parser = FastParser()
 
     with open(path, "r") as f:
         while True:
             line = f.readline()
             if not line:
                 break
-            raw_msg = parser.push_line(line)
-            if raw_msg is not None and raw_msg.is_clean:
+            msg = parser.push_line(line)
+            if msg is not None:
                 offset = f.tell()
-                msg = MeterMessage.from_raw(raw_msg)
                 yield offset, msg
 
 
+@dataclass
+class ChunkResult:
+    # the byte offset where the next chunk starts, or where the last telegram that could not be parsed yet starts
+    end: int
+    message_count: int = 0
+    meter_rows: List[tuple] = field(default_factory=list)
+    peak_rows: List[tuple] = field(default_factory=list)
+    gas_rows: List[tuple] = field(default_factory=list)
+
+
+def find_chunks(path: str, start: int, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Split the log into `(start, end)` byte ranges of roughly `chunk_size` bytes.
+    Every range except the first starts at a telegram header line.
+    """
+    file_size = os.path.getsize(path)
+    bounds = [start]
+
+    with open(path, "rb") as f:
+        while bounds[-1] + chunk_size < file_size:
+            f.seek(bounds[-1] + chunk_size)
+            # skip the partial line we landed in
+            f.readline()
+
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    offset = file_size
+                    break
+                if line.startswith(b"/"):
+                    break
+
+            if offset >= file_size:
+                break
+            bounds.append(offset)
+
+    bounds.append(file_size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_chunk_lines(data: bytes):
+    """
+    Fallback for chunks that are not valid UTF-8, skipping the telegrams that contain invalid lines.
+    """
+    parser = FastParser()
+    for line in BytesIO(data):
+        try:
+            line_str = line.decode()
+        except UnicodeDecodeError:
+            parser.reset()
+            continue
+
+        msg = parser.push_line(line_str)
+        if msg is not None:
+            yield msg
+
+
+def unparsed_offset(data: bytes, start: int) -> int:
+    """
+    The offset of the header of the last telegram in `data`, which starts at byte `start` of the log.
+    That telegram is not parsed yet, since no blank line follows its data.
+    """
+    offset = start
+    prev_offset = start
+    result = start
+    for line in BytesIO(data):
+        if len(line.strip()) == 0:
+            result = prev_offset
+        prev_offset = offset
+        offset += len(line)
+    return result
+
+
+def parse_chunk(chunk: Tuple[str, int, int]) -> ChunkResult:
+    """
+    Parse all telegrams that start in the byte range `start..end` of the log.
+    The last telegram is only complete after the blank line following the next header, so we read a bit past `end`.
+    If the log ends before that, the result ends at the last telegram instead, so a later import starts from there.
+    """
+    path, start, end = chunk
+    result = ChunkResult(end)
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+        complete = False
+        for line in f:
+            data += line
+            if len(line.strip()) == 0:
+                complete = True
+                break
+
+    if not complete:
+        result.end = unparsed_offset(data, start)
+
+    try:
+        # the log contains the raw serial lines, which end in "\r\n"
+        messages = iter_telegrams(data.decode().replace("\r\n", "\n"))
+    except UnicodeDecodeError:
+        messages = iter_chunk_lines(data)
+
+    for msg in messages:
+        result.message_count += 1
+
+        if msg.timestamp is not None:
+            result.meter_rows.append((
+                msg.timestamp, msg.timestamp_str, msg.instant_power_1, msg.instant_power_2,
+                msg.instant_power_3, msg.voltage_1, msg.voltage_2, msg.voltage_3
+            ))
+        if msg.peak_power_timestamp is not None:
+            result.peak_rows.append((msg.peak_power_timestamp, msg.peak_power_timestamp_str, msg.peak_power))
+        if msg.gas_timestamp is not None:
+            result.gas_rows.append((msg.gas_timestamp, msg.gas_timestamp_str, msg.gas_volume))
+
+    return result
+
+
+def get_progress(connection: sqlite3.Connection, path: str) -> int:
+    row = connection.execute("SELECT offset FROM import_progress WHERE path = ?", (path,)).fetchone()
+    return row[0] if row is not None else 0
+
+
+def set_progress(connection: sqlite3.Connection, path: str, offset: int):
+    connection.execute("INSERT OR REPLACE INTO import_progress VALUES(?, ?)", (path, offset))
+
+
+def insert_sorted(database: Database, table: str, rows: List[tuple]):
+    # stable sort, so later rows with the same timestamp still replace earlier ones
+    rows = sorted(rows, key=lambda row: row[0])
+    # the rollups are updated in the same transaction, so they stay complete even if the import is interrupted
+    database.insert_rows(table, rows)
+
+
+def import_meter_log(database: Database, path_log: str, jobs: int, chunk_size: int):
+    connection = database.conn
+    progress_key = os.path.abspath(path_log)
+    start_offset = get_progress(connection, progress_key)
+    file_size = os.path.getsize(path_log)
+    if start_offset > 0:
+        print(f"Resuming meter log import at byte {start_offset}")
+
+    chunks = [(path_log, start, end) for start, end in find_chunks(path_log, start_offset, chunk_size)]
+    print(f"Parsing {len(chunks)} chunks using {jobs} processes")
+
+    count = 0
+    start = time.perf_counter()
+    prev = start
+
+    def process(result: ChunkResult):
+        nonlocal count, prev
+
+        insert_sorted(database, "meter_samples", result.meter_rows)
+        insert_sorted(database, "meter_peaks", result.peak_rows)
+        insert_sorted(database, "gas_samples", result.gas_rows)
+
+        # store the progress in the same transaction, so a restart continues exactly after this chunk
+        set_progress(connection, progress_key, result.end)
+        connection.commit()
+
+        count += result.message_count
+        now = time.perf_counter()
+
+        throughput = result.message_count / (now - prev)
+        progress = (result.end - start_offset) / max(file_size - start_offset, 1)
+        time_left = (1 - progress) / max(progress, 1e-9) * (now - start)
+        prev = now
+
+        print(f"Inserted {count} values, {throughput:.2f} values/s, progress {progress :.2}, left {time_left:.2f}s")
+
+    if jobs == 1:
+        for chunk in chunks:
+            process(parse_chunk(chunk))
+    else:
+        # imap keeps the chunk order, so the progress offset only ever moves forward
+        with Pool(jobs) as pool:
+            for result in pool.imap(parse_chunk, chunks):
+                process(result)
+
+
+def import_adc_log(database: Database, path_log: str, batch_size: int = 64 * 1024):
+    """
+    Import a log of `timestamp,voltage_int` lines as written by `main_server`.
+    """
+    connection = database.conn
+    progress_key = os.path.abspath(path_log)
+    offset = get_progress(connection, progress_key)
+    if offset > 0:
+        print(f"Resuming ADC log import at byte {offset}")
+
+    count = 0
+    with open(path_log, "rb") as f:
+        f.seek(offset)
+
+        while True:
+            lines = f.readlines(batch_size)
+            if len(lines) == 0:
+                break
+
+            # only consume complete lines, the last one might still be being written
+            if not lines[-1].endswith(b"\n"):
+                lines.pop()
+                if len(lines) == 0:
+                    break
+
+            rows = []
+            for line in lines:
+                offset += len(line)
+                try:
+                    timestamp, voltage_int = line.decode().strip().split(",")
+                    rows.append((int(timestamp), int(voltage_int)))
+                except ValueError:
+                    print(f"WARNING: failed to parse ADC line {line}")
+
+            insert_sorted(database, "water_height_samples", rows)
+            set_progress(connection, progress_key, offset)
+            connection.commit()
+
+            count += len(rows)
+            print(f"Inserted {count} ADC values")
+
+
 def main():
     parser = argparse.ArgumentParser(prog="log2db")
     parser.add_argument("path_log")
     parser.add_argument("path_db")
     parser.add_argument("--update", action="store_true")
+    parser.add_argument("--adc-log", help="also import a log of ADC samples")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of parser processes")
+    parser.add_argument("--chunk-size", type=int, default=16 * 1024 * 1024, help="approximate chunk size in bytes")
+    parser.add_argument(
+        "--compact", action="store_true", help="create new databases without the redundant meter 'timestamp_str' column"
+    )
     args = parser.parse_args()
 
     path_log: str = args.path_log
@@ -41,92 +272,23 @@ def main():
         else:
             assert False, f"Database path '{path_db}' already exists and --update was not passed"
 
-    connection = sqlite3.connect(path_db)
-
     print("Creating tables")
+    database = Database(path_db, compact=args.compact)
+    connection = database.conn
     connection.execute(
-        "CREATE TABLE IF NOT EXISTS meter_samples("
-        "    timestamp INTEGER PRIMARY KEY,"
-        "    timestamp_str TEXT,"
-        "    instant_power_1 REAL,"
-        "    instant_power_2 REAL,"
-        "    instant_power_3 REAL,"
-        "    voltage_1 REAL,"
-        "    voltage_2 REAL,"
-        "    voltage_3 REAL"
-        ")"
-    )
-    connection.execute(
-        "CREATE TABLE IF NOT EXISTS meter_peaks("
-        "    timestamp INTEGER PRIMARY KEY, "
-        "    timestamp_str TEXT,"
-        "    instant_power_total REAL"
-        ")"
-    )
-    connection.execute(
-        "CREATE TABLE IF NOT EXISTS gas_samples("
-        "    timestamp INTEGER PRIMARY KEY,"
-        "    timestamp_str TEXT,"
-        "    volume REAL"
+        "CREATE TABLE IF NOT EXISTS import_progress("
+        "    path TEXT PRIMARY KEY,"
+        "    offset INTEGER"
         ")"
     )
     connection.commit()
 
     print("Inserting items")
-    chunk_size = 1024
-    file_size = os.path.getsize(path_log)
-    messages = iter_messages(path_log)
-
-    count = 0
-    start = time.perf_counter()
-    prev = start
-
-    while True:
-        chunk_info = list(itertools.islice(messages, chunk_size))
-        if len(chunk_info) == 0:
-            break
-
-        chunk = [msg for _, msg in chunk_info]
-        last_offset = chunk_info[-1][0]
-
-        connection.executemany(
-            "INSERT OR REPLACE INTO meter_samples  VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
-            [
-                (msg.timestamp, msg.timestamp_str, msg.instant_power_1, msg.instant_power_2, msg.instant_power_3,
-                 msg.voltage_1, msg.voltage_2, msg.voltage_3)
-                for msg in chunk if msg.timestamp is not None
-            ]
-        )
-        connection.executemany(
-            "INSERT OR REPLACE INTO meter_peaks VALUES(?, ?, ?)",
-            [
-                (msg.peak_power_timestamp, msg.peak_power_timestamp_str, msg.peak_power)
-                for msg in chunk if
-                msg.peak_power_timestamp is not None
-            ]
-        )
-        connection.executemany(
-            "INSERT OR REPLACE INTO gas_samples VALUES(?, ?, ?)",
-            [
-                (msg.gas_timestamp, msg.gas_timestamp_str, msg.gas_volume)
-                for msg in chunk if
-                msg.gas_timestamp is not None
-            ]
-        )
-
-        # commit frequently in loop to give potential other processes occasional access
-        connection.commit()
-
-        count += len(chunk)
-        now = time.perf_counter()
-
-        throughput = len(chunk) / (now - prev)
-        time_left = (file_size - last_offset) / last_offset * (now - start)
-        progress = last_offset / file_size
-
-        prev = now
+    import_meter_log(database, path_log, max(args.jobs, 1), args.chunk_size)
+    if args.adc_log is not None:
+        import_adc_log(database, args.adc_log)
 
-        print(f"Inserted {count} values, {throughput} values/s, progress {progress :.2}, left {time_left:.2f}s")
+    database.close()
 
 
 if __name__ == "__main__":
@@ -1,25 +1,265 @@
-from queue import Queue as QQueue
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue as QQueue, Empty
 from threading import Thread
+from typing import Awaitable, Callable, Iterable, List, Optional, Sequence, Tuple
 
-from server.data import DataStore, Database
+from server import metrics
+from server.data import BroadcastStats, ClientOutbox, DataStore, Database, Message, MultiSeries
 from server.flask_server import flask_main
-from server.socket_server import socket_server_main
+from server.retention import RetentionPolicy
+from server.shared import SharedTrackerRing, http_process_main, socket_process_main
+from server.socket_server import socket_server_main, async_socket_server, AsyncBroadcaster
 
+# a source of messages for the single event loop runtime, gets the coroutine used to put messages in the queue
+MessageSource = Callable[[Callable[[Message], Awaitable[None]]], Awaitable[None]]
 
-def run_message_processor(store: DataStore, message_queue: QQueue):
+
+def snapshot_path(database_path: str) -> str:
+    """
+    Where the tracker snapshot for the database at `database_path` is kept.
+    """
+    return os.path.splitext(database_path)[0] + ".tracker.npz"
+
+
+def register_metrics(
+        queue_size: Callable[[], int], outboxes: Callable[[], Iterable[ClientOutbox]], stats: BroadcastStats
+):
+    """
+    Gauges for the message queue and the connected websocket clients and the broadcast counters of `stats`,
+    only evaluated when the metrics are rendered.
+    """
+    metrics.GaugeCallback(
+        "digitalmeter_message_queue_depth", "Messages waiting to be processed.", lambda: [((), queue_size())]
+    )
+
+    def per_client(value: Callable[[ClientOutbox], float]):
+        return lambda: [((outbox.name, outbox.wire_format.value), value(outbox)) for outbox in list(outboxes())]
+
+    for name, help, value in [
+        ("pending", "Updates waiting to be sent to the client.", lambda outbox: outbox.backlog()[0]),
+        ("lag_seconds", "Age of the oldest update waiting to be sent.", ClientOutbox.lag),
+        ("sent", "Payloads sent to the client.", lambda outbox: outbox.sent),
+        ("merged", "Updates merged into another one before sending.", lambda outbox: outbox.merged),
+        ("dropped", "Updates dropped because the client fell behind.", lambda outbox: outbox.dropped),
+        ("resyncs", "Times the client was resynced with a snapshot.", lambda outbox: outbox.resyncs),
+    ]:
+        metrics.GaugeCallback(f"digitalmeter_client_{name}", help, per_client(value), ("client", "format"))
+
+    def subscribers():
+        counts = {}
+        for outbox in list(outboxes()):
+            for channel in outbox.channels or ():
+                counts[channel] = counts.get(channel, 0) + 1
+        return [((channel,), count) for channel, count in counts.items()]
+
+    metrics.GaugeCallback(
+        "digitalmeter_channel_subscribers", "Websocket clients subscribed to each series.", subscribers, ("channel",)
+    )
+
+    # counted once by `stats`, which also reports the rates in the log
+    for index, (name, help) in enumerate([
+        ("encodes", "Websocket payloads encoded, each one is shared by all clients that get the same update."),
+        ("encode_bytes", "Bytes of encoded websocket payloads."),
+        ("sends", "Websocket payloads sent."),
+        ("send_bytes", "Bytes of websocket payloads sent."),
+    ]):
+        metrics.CounterCallback(f"digitalmeter_{name}", help, lambda index=index: [((), stats.totals()[index])])
+
+
+def collect_batch(message_queue: QQueue, max_batch_size: int, max_batch_delay: float) -> List[Message]:
+    """
+    Block until a message is available, then keep collecting messages until either the queue is empty and
+    `max_batch_delay` seconds have passed since the first message, or `max_batch_size` messages have been collected.
+    """
+    batch = [message_queue.get()]
+    deadline = time.perf_counter() + max_batch_delay
+
+    while len(batch) < max_batch_size:
+        try:
+            batch.append(message_queue.get(timeout=max(0.0, deadline - time.perf_counter())))
+        except Empty:
+            break
+
+    return batch
+
+
+def run_message_processor(
+        store: DataStore, message_queue: QQueue, max_batch_size: int, max_batch_delay: float,
+        ring: Optional[SharedTrackerRing] = None,
+):
+    """
+    Process batches forever, publishing the tracker state to `ring` after every batch if given.
+    """
     while True:
         q_size = message_queue.qsize()
         if q_size > 10:
             print(f"WARNING: backlog of {q_size} messages")
 
-        message = message_queue.get()
-        store.process_message(message)
+        batch = collect_batch(message_queue, max_batch_size, max_batch_delay)
+        store.process_messages(batch)
+        if ring is not None:
+            with store.lock:
+                ring.publish(store.tracker)
+        store.run_maintenance()
+
+
+def server_main(
+        database_path: str, message_queue: QQueue,
+        max_batch_size: int = 1024, max_batch_delay: float = 0.5,
+        retention: Optional[RetentionPolicy] = None,
+        socket_port: int = 8001,
+        http_ports: Sequence[int] = (8000, 80),
+):
+    store = DataStore(Database(database_path), snapshot_path=snapshot_path(database_path), retention=retention)
+    register_metrics(message_queue.qsize, lambda: store.outboxes, store.stats)
+    Thread(target=socket_server_main, args=(store,), kwargs={"port": socket_port}).start()
+
+    Thread(target=flask_main, args=(database_path, store, http_ports)).start()
+
+    try:
+        run_message_processor(store, message_queue, max_batch_size, max_batch_delay)
+    finally:
+        store.save_snapshot()
+
+
+def multiprocess_server_main(
+        database_path: str, message_queue: QQueue,
+        max_batch_size: int = 1024, max_batch_delay: float = 0.5,
+        retention: Optional[RetentionPolicy] = None,
+        socket_port: int = 8001,
+        http_ports: Sequence[int] = (8000, 80),
+):
+    """
+    Alternative to `server_main` that only keeps the database writes and the tracker in this process, next to the
+    inputs that fill `message_queue`. The websocket server and Flask each run in their own process, following the
+    tracker state through a `SharedTrackerRing` and reading the database with read-only connections, so encoding
+    payloads and large downloads never compete with reading the inputs for the GIL.
+    Custom websocket channels are not available and `/metrics` only covers the Flask process.
+    """
+    store = DataStore(Database(database_path), snapshot_path=snapshot_path(database_path), retention=retention)
+    ring = SharedTrackerRing.create()
+    ring.publish(store.tracker)
+
+    # don't fork, the input threads might already be running
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=socket_process_main, args=(ring.name, socket_port, metrics.REGISTRY.enabled),
+            name="socket", daemon=True,
+        ),
+        context.Process(
+            target=http_process_main, args=(database_path, ring.name, http_ports, metrics.REGISTRY.enabled),
+            name="http", daemon=True,
+        ),
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        run_message_processor(store, message_queue, max_batch_size, max_batch_delay, ring)
+    finally:
+        store.save_snapshot()
+        for process in processes:
+            process.terminate()
+        ring.close()
+
+
+async def collect_batch_async(
+        message_queue: asyncio.Queue,
+        max_batch_size: int,
+        max_batch_delay: float
+) -> List[Message]:
+    """
+    Asyncio version of `collect_batch`.
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await message_queue.get()]
+    deadline = loop.time() + max_batch_delay
+
+    while len(batch) < max_batch_size:
+        if not message_queue.empty():
+            batch.append(message_queue.get_nowait())
+            continue
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(message_queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+
+    return batch
+
+
+async def run_message_processor_async(
+        store: DataStore,
+        broadcaster: AsyncBroadcaster,
+        message_queue: asyncio.Queue,
+        executor: ThreadPoolExecutor,
+        max_batch_size: int,
+        max_batch_delay: float,
+):
+    loop = asyncio.get_running_loop()
+
+    def apply(batch: List[Message]) -> Tuple[MultiSeries, MultiSeries]:
+        # runs on the database thread, which is the only one that writes to the store
+        # the lock is only contended by Flask taking views of the tracker
+        with store.lock:
+            result = store.apply_messages(batch), store.tracker.get_history()
+        store.run_maintenance()
+        return result
+
+    try:
+        while True:
+            q_size = message_queue.qsize()
+            if q_size > 10:
+                print(f"WARNING: backlog of {q_size} messages")
+
+            batch = await collect_batch_async(message_queue, max_batch_size, max_batch_delay)
+            update_series, history = await loop.run_in_executor(executor, apply, batch)
+            broadcaster.publish(update_series, history)
+    finally:
+        store.save_snapshot()
+
 
+async def async_server_main(
+        database_path: str,
+        sources: List[MessageSource],
+        max_queue_size: int = 1024,
+        max_batch_size: int = 1024,
+        max_batch_delay: float = 0.5,
+        start_flask: bool = True,
+        socket_port: int = 8001,
+        retention: Optional[RetentionPolicy] = None,
+):
+    """
+    Alternative to `server_main` that runs the message sources, processing and the websocket server as tasks on the
+    current event loop, connected by a bounded queue. When the queue is full the sources wait, so they stop reading
+    their input. Database writes and tracker updates run on a single dedicated thread, Flask still runs on its own
+    threads with separate connections.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
 
-def server_main(database_path: str, message_queue: QQueue):
-    store = DataStore(Database(database_path))
-    Thread(target=socket_server_main, args=(store,)).start()
+    store = await loop.run_in_executor(
+        executor,
+        lambda: DataStore(Database(database_path), snapshot_path=snapshot_path(database_path), retention=retention)
+    )
+    broadcaster = AsyncBroadcaster(store, executor)
+    broadcaster.history = store.tracker.get_history()
+    message_queue = asyncio.Queue(max_queue_size)
+    register_metrics(message_queue.qsize, lambda: broadcaster.outboxes, broadcaster.stats)
 
-    Thread(target=flask_main, args=(database_path,)).start()
+    if start_flask:
+        Thread(target=flask_main, args=(database_path, store)).start()
 
-    run_message_processor(store, message_queue)
+    await asyncio.gather(
+        async_socket_server(broadcaster, port=socket_port),
+        run_message_processor_async(store, broadcaster, message_queue, executor, max_batch_size, max_batch_delay),
+        *(source(message_queue.put) for source in sources),
+    )
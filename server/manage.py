@@ -0,0 +1,126 @@
+import argparse
+import os
+import sys
+import time
+
+from server.data import Database
+from server.kinds import SeriesKind
+from server.retention import RETENTION_COLUMNS, RetentionPolicy
+
+
+def backfill_rollups(path_db: str):
+    database = Database(path_db)
+
+    for kind in SeriesKind:
+        print(f"Backfilling rollups for '{kind.value.name}'")
+        start = time.perf_counter()
+
+        for curr, oldest, newest in database.rollups.backfill(kind):
+            progress = (curr - oldest) / max(newest - oldest, 1)
+            print(f"  progress {progress:.2}, elapsed {time.perf_counter() - start:.2f}s")
+
+    database.close()
+    print("Done, restart the server to start using the rollups")
+
+
+def check_query_plans(path_db: str):
+    database = Database.open_read_only(path_db)
+    problems = database.check_query_plans()
+    database.close()
+
+    for problem in problems:
+        print(f"Bad query plan: {problem}")
+    if len(problems) > 0:
+        sys.exit(1)
+    print("All series queries use primary key range searches")
+
+
+def compact_meter_samples(path_db: str, vacuum: bool):
+    database = Database(path_db)
+    if database.compact:
+        print("Table 'meter_samples' is already compact")
+        database.close()
+        return
+
+    size_before = os.path.getsize(path_db)
+    start = time.perf_counter()
+    print("Rewriting 'meter_samples' without 'timestamp_str'")
+    database.migrate_compact()
+    print(f"  done in {time.perf_counter() - start:.2f}s")
+
+    if vacuum:
+        print("Vacuuming")
+        database.conn.execute("VACUUM")
+        database.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"  size {size_before / 1024 / 1024:.2f} MB -> {os.path.getsize(path_db) / 1024 / 1024:.2f} MB")
+
+    database.close()
+    print("Done, stop the server before migrating and restart it afterwards")
+
+
+def apply_retention(path_db: str, policy: RetentionPolicy, vacuum: bool):
+    database = Database(path_db)
+    start = time.perf_counter()
+
+    prev = start
+    for table, raw_since in database.retention.run(policy):
+        now = time.perf_counter()
+        if now - prev > 1:
+            prev = now
+            print(f"  '{table}' raw samples before {raw_since} removed, elapsed {now - start:.2f}s")
+
+    for table in RETENTION_COLUMNS:
+        if not database.retention.can_prune(table):
+            print(f"Skipped '{table}', run 'backfill-rollups' first")
+        else:
+            print(f"Raw '{table}' samples kept since {database.retention.raw_since(table)}")
+
+    if vacuum:
+        print("Vacuuming")
+        database.conn.execute("VACUUM")
+        database.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    database.close()
+    print(f"Done in {time.perf_counter() - start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="manage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_backfill = subparsers.add_parser("backfill-rollups", help="(re)compute all rollup tables")
+    parser_backfill.add_argument("path_db")
+
+    parser_plans = subparsers.add_parser(
+        "check-query-plans", help="check that all series queries are primary key range searches"
+    )
+    parser_plans.add_argument("path_db")
+
+    parser_compact = subparsers.add_parser(
+        "compact-meter-samples", help="migrate 'meter_samples' to the schema without 'timestamp_str'"
+    )
+    parser_compact.add_argument("path_db")
+    parser_compact.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+
+    parser_retention = subparsers.add_parser(
+        "apply-retention", help="remove all raw samples outside of the retention window at once"
+    )
+    parser_retention.add_argument("path_db")
+    parser_retention.add_argument("--raw-days", type=int, required=True, help="days of raw samples to keep")
+    parser_retention.add_argument("--archive", action="store_true", help="move them to monthly partition files")
+    parser_retention.add_argument("--vacuum", action="store_true", help="shrink the database file afterwards")
+
+    args = parser.parse_args()
+
+    if args.command == "backfill-rollups":
+        backfill_rollups(args.path_db)
+    elif args.command == "check-query-plans":
+        check_query_plans(args.path_db)
+    elif args.command == "compact-meter-samples":
+        compact_meter_samples(args.path_db, args.vacuum)
+    elif args.command == "apply-retention":
+        apply_retention(args.path_db, RetentionPolicy(args.raw_days, args.archive), args.vacuum)
+
+
+if __name__ == "__main__":
+    main()
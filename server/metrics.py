@@ -0,0 +1,233 @@
+import bisect
+import math
+import time
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# upper bounds of the latency histogram buckets in seconds, from 10 µs to 10 s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 1e-4, 2.5e-4, 1e-3, 2.5e-3, 1e-2, 2.5e-2, 0.1, 0.25, 1.0, 2.5, 10.0)
+
+# a sample is `(suffix, labels, value)`, the suffix is appended to the metric name
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class Registry:
+    """
+    The metrics of the process, rendered in the Prometheus text format by the `/metrics` route.
+    Metrics are only recorded once `enable` has been called, until then every update is a single flag check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics: List['Metric'] = []
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def enable():
+    REGISTRY.enabled = True
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    items = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append(f'{key}="{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.registry = registry
+        self.lock = Lock()
+        registry.metrics.append(self)
+
+    def _labels(self, label_values: tuple) -> Dict[str, str]:
+        return dict(zip(self.label_names, label_values))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        if not self.registry.enabled:
+            return
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in values.items():
+            yield "_total", self._labels(label_values), value
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "start")
+
+    def __init__(self, histogram: 'Histogram', label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+        return False
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # per label values: the count of each bucket (not cumulative, the last one is +Inf), the sum and the count
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        if not self.registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *label_values):
+        """
+        Context manager that observes the time spent in its body, in seconds.
+        """
+        if not self.registry.enabled:
+            return NULL_TIMER
+        return _Timer(self, label_values)
+
+    def quantiles(self, qs: Iterable[float]) -> List[float]:
+        """
+        Estimate the quantiles `qs` (between 0 and 1) over all label values, interpolating linearly within a bucket.
+        Values in the last, unbounded bucket are reported as the largest bound. NaN if nothing was observed.
+        """
+        with self.lock:
+            counts = [sum(column) for column in zip(*(state[0] for state in self.values.values()))]
+        total = sum(counts)
+
+        results = []
+        for q in qs:
+            if total == 0:
+                results.append(math.nan)
+                continue
+            rank = q * total
+            cumulative = 0
+            for i, count in enumerate(counts):
+                if cumulative + count >= rank and count > 0:
+                    if i == len(self.buckets):
+                        results.append(self.buckets[-1])
+                    else:
+                        lower = self.buckets[i - 1] if i > 0 else 0.0
+                        results.append(lower + (self.buckets[i] - lower) * (rank - cumulative) / count)
+                    break
+                cumulative += count
+        return results
+
+    def samples(self) -> Iterable[Sample]:
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+        for label_values, (counts, total, count) in values.items():
+            labels = self._labels(label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+class GaugeCallback(Metric):
+    """
+    A gauge that is only evaluated when the metrics are rendered,
+    `callback` returns pairs of label values and the current value.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback: Callable[[], Iterable[Tuple[tuple, float]]], *args, **kwargs):
+        super().__init__(name, help, *args, **kwargs)
+        self.callback = callback
+
+    def samples(self) -> Iterable[Sample]:
+        for label_values, value in self.callback():
+            yield "", self._labels(label_values), value
+
+
+class CounterCallback(GaugeCallback):
+    """
+    A counter that is kept elsewhere and only read when the metrics are rendered,
+    `callback` returns pairs of label values and the current total.
+    """
+    type = "counter"
+
+    def samples(self) -> Iterable[Sample]:
+        for label_values, value in self.callback():
+            yield "_total", self._labels(label_values), value
+
+
+# the hot path, every stage a message passes through on its way to the websocket clients
+PARSE_SECONDS = Histogram("digitalmeter_parse_seconds", "Time to parse a single telegram.")
+INSERT_SECONDS = Histogram("digitalmeter_insert_seconds", "Time to insert and commit a batch of messages.")
+INSERT_MESSAGES = Counter("digitalmeter_insert_messages", "Messages inserted into the database.")
+FETCH_SECONDS = Histogram(
+    "digitalmeter_fetch_seconds", "Time until the first row of a series query is ready.", ("kind", "bucket_size")
+)
+TRACKER_UPDATE_SECONDS = Histogram("digitalmeter_tracker_update_seconds", "Time to update the tracker for a message.")
+ENCODE_SECONDS = Histogram("digitalmeter_encode_seconds", "Time to encode a websocket payload.", ("type", "format"))
+CONNECTIONS = Counter("digitalmeter_connections", "Websocket connections, by the type of the first payload.", ("type",))
+SEND_SECONDS = Histogram("digitalmeter_send_seconds", "Time to send a payload to a websocket client.", ("format",))
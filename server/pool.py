@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import Lock
+from typing import Optional
+
+from server.data import Database
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DatabasePool:
+    """
+    Thread-safe pool of read-only database connections, shared by the request handlers of the web server.
+    """
+
+    def __init__(self, path: str, max_size: int = 4):
+        self.path = path
+        self.max_size = max_size
+
+        self.lock = Lock()
+        self.created = 0
+        self.free: LifoQueue = LifoQueue()
+
+    def acquire(self, timeout: Optional[float] = None) -> Database:
+        """
+        Get a free connection, opening a new one if none are free and the pool is not full yet,
+        otherwise block until a connection is released. Raises `PoolTimeout` if that takes longer than `timeout`.
+        """
+        with self.lock:
+            create = self.free.empty() and self.created < self.max_size
+            if create:
+                self.created += 1
+
+        if create:
+            try:
+                return Database.open_read_only(self.path)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        try:
+            database = self.free.get(timeout=timeout)
+        except Empty:
+            raise PoolTimeout(f"No free database connection within {timeout}s")
+        # a rollup backfill might have finished since the connection was opened
+        database.rollups.refresh()
+        return database
+
+    def release(self, database: Database):
+        # end any read transaction that is still open, eg. when a stream was cancelled
+        if database.conn.in_transaction:
+            database.conn.rollback()
+        self.free.put(database)
+
+    @contextmanager
+    def connection(self):
+        database = self.acquire()
+        try:
+            yield database
+        finally:
+            self.release(database)
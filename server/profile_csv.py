@@ -0,0 +1,101 @@
+import argparse
+import os
+import time
+import zlib
+from io import StringIO
+
+import numpy as np
+
+from server.data import Database
+from server.flask_server import csv_row_format, format_csv_batch
+from server.kinds import SeriesKind
+
+
+def build_database(path: str, rows: int):
+    """
+    Fill a new database with `rows` power samples at 1 s intervals.
+    """
+    database = Database(path)
+    rng = np.random.default_rng(0)
+    start = 1_700_000_000
+    chunk_size = 100_000
+
+    for chunk_start in range(0, rows, chunk_size):
+        count = min(chunk_size, rows - chunk_start)
+        timestamps = np.arange(start + chunk_start, start + chunk_start + count)
+        values = rng.random((count, 6)) * 1000
+        database.conn.executemany(
+            "INSERT INTO meter_samples VALUES(?, 'synthetic', ?, ?, ?, ?, ?, ?)",
+            ((int(t), *v) for t, v in zip(timestamps, values.tolist()))
+        )
+        database.conn.commit()
+
+    database.close()
+
+
+def format_csv_batch_reference(batch, sep: str, csv_be_mode: bool) -> str:
+    # the original per-cell implementation
+    writer = StringIO()
+    for x in batch:
+        line = sep.join(str(d) for d in x) + "\n"
+        if csv_be_mode:
+            line = line.replace(".", ",")
+        writer.write(line)
+    return writer.getvalue()
+
+
+def run(database: Database, format_batch, compress: bool) -> (int, int, float):
+    start = time.perf_counter()
+    row_count = 0
+    byte_count = 0
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    data = database.fetch_series_items(SeriesKind.POWER, None, None, None)
+    while True:
+        batch = data.fetchmany(10 * 1024)
+        if len(batch) == 0:
+            break
+        text = format_batch(batch).encode()
+        if compressor is not None:
+            text = compressor.compress(text)
+        row_count += len(batch)
+        byte_count += len(text)
+
+    if compressor is not None:
+        byte_count += len(compressor.flush())
+
+    return row_count, byte_count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_csv")
+    parser.add_argument("--path-db", default="profile_csv.db")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path_db):
+        print(f"Building database with {args.rows} rows")
+        build_database(args.path_db, args.rows)
+
+    database = Database(args.path_db)
+    column_count = len(SeriesKind.POWER.value.columns)
+
+    variants = {
+        "reference": (lambda batch: format_csv_batch_reference(batch, ",", False), False),
+        "reference-be": (lambda batch: format_csv_batch_reference(batch, "\t", True), False),
+        "bulk": (lambda batch: format_csv_batch(batch, csv_row_format(column_count, None, ","), False), False),
+        "bulk-be": (lambda batch: format_csv_batch(batch, csv_row_format(column_count, None, "\t"), True), False),
+        "bulk-precision-3": (lambda batch: format_csv_batch(batch, csv_row_format(column_count, 3, ","), False), False),
+        "bulk-precision-3-gzip": (
+            lambda batch: format_csv_batch(batch, csv_row_format(column_count, 3, ","), False), True),
+    }
+
+    for name, (format_batch, compress) in variants.items():
+        rows, size, delta = run(database, format_batch, compress)
+        print(f"{name}: {rows / delta:.0f} rows/s, {size / 1024 / 1024:.2f} MB, {delta:.2f}s")
+
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from queue import Queue as QQueue
+from threading import Thread
+
+import numpy as np
+import serial
+
+from inputs.serial_frames import run_telegram_reader
+from server.dummy_server import build_telegram
+from server.main import multiprocess_server_main, server_main
+from server.profile_load import run_downloaders
+from server.profile_startup import DAY, generate_database
+
+MODES = {"single": server_main, "processes": multiprocess_server_main}
+
+
+def send_telegrams(master: int, first_timestamp: int, count: int, rate: float, read: dict) -> np.ndarray:
+    """
+    Write `count` telegrams to the pty `master` and return how long it took until the reader parsed each of them,
+    in seconds. `read` is filled with the time each telegram was parsed by the reader thread.
+    """
+    latencies = []
+    for i in range(count):
+        timestamp = first_timestamp + i
+        telegram = build_telegram(timestamp)
+
+        # the telegram is complete when its last byte is written
+        os.write(master, telegram[:-1])
+        sent = time.monotonic()
+        os.write(master, telegram[-1:])
+
+        time.sleep(1 / rate)
+        if timestamp in read:
+            latencies.append(read[timestamp] - sent)
+    return np.array(latencies)
+
+
+def run_mode(mode: str, database_path: str, log_path: str, newest: int, args, results):
+    """
+    Start the server in `mode` with a real serial reader on a pty, then measure how long it takes the reader to parse
+    telegrams, first without any other load and then while `args.downloaders` clients keep downloading.
+    Runs in its own process, so each mode starts from a fresh interpreter.
+    """
+    # the server prints a line for every request, keep the output of this process and its children out of the way
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+
+    master, slave = os.openpty()
+    serial_port = serial.Serial(os.ttyname(slave), timeout=10)
+    message_queue = QQueue()
+    read = {}
+
+    def read_chunk():
+        data = serial_port.read(1)
+        if len(data) > 0 and serial_port.in_waiting > 0:
+            data += serial_port.read(serial_port.in_waiting)
+        return data
+
+    def on_message(msg):
+        read[msg.timestamp] = time.monotonic()
+        message_queue.put(msg)
+
+    Thread(target=run_telegram_reader, args=(read_chunk, on_message), daemon=True).start()
+    Thread(
+        target=MODES[mode], args=(database_path, message_queue),
+        kwargs={"socket_port": args.socket_port, "http_ports": [args.http_port]},
+        daemon=True,
+    ).start()
+
+    idle = send_telegrams(master, newest, args.telegrams, args.rate, read)
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    stop = context.Event()
+    downloader_results = context.Queue()
+    downloaders = context.Process(
+        target=run_downloaders,
+        args=(
+            args.http_port, args.downloaders, newest - args.history_days * DAY, newest, args.max_download_points,
+            0, ready, stop, downloader_results,
+        )
+    )
+    downloaders.start()
+    ready.wait()
+    start = time.perf_counter()
+    # let the downloads ramp up first
+    time.sleep(1)
+
+    loaded = send_telegrams(master, newest + args.telegrams, args.telegrams, args.rate, read)
+    load_delta = time.perf_counter() - start
+
+    stop.set()
+    downloads = downloader_results.get()
+    downloaders.join()
+
+    results.put((idle, loaded, downloads, load_delta))
+    results.close()
+    results.join_thread()
+    # the server threads don't stop by themselves
+    os._exit(0)
+
+
+def format_latencies(latencies: np.ndarray) -> str:
+    if len(latencies) == 0:
+        return "no telegrams read"
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+    return f"p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms, max {latencies.max() * 1000:.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_isolation")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--history-days", type=int, default=7)
+    parser.add_argument("--telegrams", type=int, default=60, help="telegrams to send with and without downloads")
+    parser.add_argument("--rate", type=float, default=4, help="telegrams per second")
+    parser.add_argument("--downloaders", type=int, default=4, help="concurrent custom range downloaders")
+    parser.add_argument("--max-download-points", type=int, default=100 * 1000)
+    parser.add_argument("--socket-port", type=int, default=8111)
+    parser.add_argument("--http-port", type=int, default=8110)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    history_path = os.path.join(folder, "history.db")
+    newest = int(time.time()) // DAY * DAY
+    generate_database(history_path, args.history_days, 1, newest)
+
+    # don't fork, every mode gets a fresh process with its own server
+    context = multiprocessing.get_context("spawn")
+    for mode in args.modes:
+        database_path = os.path.join(folder, f"{mode}.db")
+        log_path = os.path.join(folder, f"{mode}.log")
+        shutil.copyfile(history_path, database_path)
+
+        results = context.Queue()
+        process = context.Process(target=run_mode, args=(mode, database_path, log_path, newest, args, results))
+        process.start()
+        idle, loaded, downloads, load_delta = results.get()
+        process.join()
+
+        ok = [(latency, size) for _, latency, size, success in downloads if success]
+        download_bytes = sum(size for _, size in ok)
+        print(f"Mode: {mode}, server output in '{log_path}'")
+        print(f"  Serial read latency idle:    {format_latencies(idle)}")
+        print(f"  Serial read latency loaded:  {format_latencies(loaded)}")
+        print(f"  Downloads: {len(ok)} in {load_delta:.1f}s, {download_bytes / load_delta / 1024 / 1024:.2f} MB/s, "
+              f"{len(downloads) - len(ok)} failed")
+
+
+if __name__ == '__main__':
+    main()
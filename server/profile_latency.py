@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import tempfile
+import time
+from queue import Queue as QQueue
+from threading import Thread
+
+import numpy as np
+import serial
+import simplejson
+import websockets
+
+from inputs.serial_frames import run_telegram_reader, run_telegram_reader_async
+from server.data import DataStore, Database
+from server.dummy_server import build_telegram
+from server.main import async_server_main, run_message_processor
+from server.socket_server import socket_server_main
+
+
+def run_clients(port: int, client_count: int, ready, stop, results):
+    """
+    Connect `client_count` websocket clients and record when each new `minute` bucket arrives.
+    Runs in a separate process so the clients don't compete with the server for the GIL.
+    """
+
+    async def client(arrivals):
+        async with websockets.connect(f"ws://localhost:{port}/?format=json", max_size=None) as websocket:
+            async for message in websocket:
+                now = time.monotonic()
+                minute = simplejson.loads(message)["series"].get("minute")
+                if minute is not None and len(minute["timestamps"]) > 0:
+                    arrivals.append((max(minute["timestamps"]), now))
+
+    async def main():
+        # wait for the server to come up
+        while True:
+            try:
+                async with websockets.connect(f"ws://localhost:{port}/"):
+                    break
+            except OSError:
+                await asyncio.sleep(0.1)
+
+        arrivals = [[] for _ in range(client_count)]
+        tasks = [asyncio.create_task(client(a)) for a in arrivals]
+        await asyncio.sleep(1)
+        ready.set()
+
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+
+        for task in tasks:
+            task.cancel()
+        results.put(arrivals)
+
+    asyncio.run(main())
+
+
+def start_threads_runtime(database_path: str, serial_path: str, port: int, max_batch_delay: float):
+    message_queue = QQueue()
+    serial_port = serial.Serial(serial_path, timeout=10)
+
+    def read_chunk():
+        data = serial_port.read(1)
+        if len(data) > 0 and serial_port.in_waiting > 0:
+            data += serial_port.read(serial_port.in_waiting)
+        return data
+
+    def run_server():
+        # same layout as `server_main`, the database connection belongs to the processor thread
+        store = DataStore(Database(database_path))
+        Thread(target=socket_server_main, args=(store,), kwargs={"port": port}, daemon=True).start()
+        run_message_processor(store, message_queue, 1024, max_batch_delay)
+
+    Thread(target=run_telegram_reader, args=(read_chunk, message_queue.put), daemon=True).start()
+    Thread(target=run_server, daemon=True).start()
+
+
+def start_asyncio_runtime(database_path: str, serial_path: str, port: int, max_batch_delay: float):
+    async def serial_source(put):
+        await run_telegram_reader_async(serial.Serial(serial_path, timeout=0), put)
+
+    async def main():
+        await async_server_main(
+            database_path, [serial_source],
+            max_batch_delay=max_batch_delay, start_flask=False, socket_port=port
+        )
+
+    Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_latency")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="asyncio")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--telegrams", type=int, default=60)
+    parser.add_argument("--rate", type=float, default=1, help="telegrams per second")
+    parser.add_argument("--max-batch-delay", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    master, slave = os.openpty()
+
+    # the server prints a line for every message sent, hide those
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = {"threads": start_threads_runtime, "asyncio": start_asyncio_runtime}[args.runtime]
+        start(os.path.join(folder, "latency.db"), os.ttyname(slave), args.port, args.max_batch_delay)
+
+        # don't fork, the server threads are already running
+        context = multiprocessing.get_context("spawn")
+        ready = context.Event()
+        stop = context.Event()
+        results = context.Queue()
+        clients = context.Process(target=run_clients, args=(args.port, args.clients, ready, stop, results))
+        clients.start()
+        ready.wait()
+
+        # the last byte of each telegram is written at the recorded time
+        sent = {}
+        first_timestamp = int(time.time()) - args.telegrams
+        for i in range(args.telegrams):
+            timestamp = first_timestamp + i
+            telegram = build_telegram(timestamp)
+            os.write(master, telegram[:-1])
+            sent[timestamp] = time.monotonic()
+            os.write(master, telegram[-1:])
+            time.sleep(1 / args.rate)
+
+        time.sleep(1)
+        stop.set()
+        arrivals = results.get()
+        clients.join()
+
+    # the 1 s bucket of a telegram is sent as soon as the telegram is processed
+    latencies = np.array([
+        recv - sent[timestamp]
+        for client_arrivals in arrivals
+        for timestamp, recv in client_arrivals
+        if timestamp in sent
+    ])
+
+    print(f"Runtime: {args.runtime}, {args.clients} clients, {args.telegrams} telegrams at {args.rate}/s")
+    print(f"Received {len(latencies)} updates, expected {args.clients * args.telegrams}")
+    if len(latencies) > 0:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print(f"Latency: p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms, max {latencies.max() * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import contextlib
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import urllib.request
+from queue import Queue as QQueue
+from threading import Thread
+
+import numpy as np
+import simplejson
+import websockets
+
+from server import metrics
+from server.data import Database
+from server.dummy_server import ReplayConfig, run_replay
+from server.main import server_main
+from server.profile_startup import DAY, generate_database
+
+# bucket sizes the downloaders pick from, like the custom page does
+DOWNLOAD_BUCKET_SIZES = [1, 10, 60, 300, 900, 3600, 4 * 3600, DAY]
+DOWNLOAD_TYPES = ["bin", "json", "csv"]
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def binary_newest(data: bytes, key: str):
+    """
+    The newest timestamp of series `key` in a binary websocket payload, None if it is missing or empty.
+    """
+    _, _, series_count = struct.unpack_from("<4sBxH", data, 0)
+    offset = 8
+    for _ in range(series_count):
+        header_length, count, column_count, value_bytes, step, first = struct.unpack_from("<IIHBxiq", data, offset)
+        offset += 24
+        header = simplejson.loads(data[offset:offset + header_length])
+        offset += -(-header_length // 8) * 8
+
+        timestamp_length = 0 if step != 0 else 4 * count
+        if header["key"] == key and count > 0:
+            if step != 0:
+                return first + (count - 1) * step
+            return first + int(np.frombuffer(data, "<i4", count, offset).sum())
+        offset += -(-timestamp_length // 8) * 8
+        offset += column_count * (-(-count * value_bytes // 8) * 8)
+    return None
+
+
+def run_clients(port: int, client_count: int, wire_format: str, ready, stop, results):
+    """
+    Connect `client_count` websocket clients, record the size of every payload and when each new `minute` bucket
+    arrives. Runs in a separate process so the clients don't compete with the server for the GIL.
+    """
+
+    async def client(arrivals, sizes):
+        url = f"ws://localhost:{port}/?format={wire_format}"
+        async with websockets.connect(url, max_size=None) as websocket:
+            async for message in websocket:
+                now = time.monotonic()
+                if isinstance(message, bytes):
+                    ty = {0: "initial", 1: "update"}.get(message[4], "other")
+                    newest = binary_newest(message, "minute")
+                else:
+                    data = simplejson.loads(message)
+                    ty = data["type"]
+                    minute = data["series"].get("minute")
+                    newest = max(minute["timestamps"]) if minute is not None and minute["timestamps"] else None
+                sizes.append((ty, len(message)))
+                if newest is not None:
+                    arrivals.append((newest, now))
+
+    async def main():
+        # wait for the server to come up
+        while True:
+            try:
+                async with websockets.connect(f"ws://localhost:{port}/"):
+                    break
+            except OSError:
+                await asyncio.sleep(0.1)
+
+        arrivals = [[] for _ in range(client_count)]
+        sizes = [[] for _ in range(client_count)]
+        tasks = [asyncio.create_task(client(a, s)) for a, s in zip(arrivals, sizes)]
+        await asyncio.sleep(1)
+        ready.set()
+
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+
+        for task in tasks:
+            task.cancel()
+        results.put((arrivals, sizes))
+
+    asyncio.run(main())
+
+
+def random_download_url(rng: random.Random, port: int, oldest: int, newest: int, max_points: int) -> str:
+    """
+    A custom range download like the custom page makes: a log-uniform span, the smallest bucket size that keeps it
+    under `max_points` buckets, and a random file type and aggregation.
+    """
+    span = int(math.exp(rng.uniform(math.log(3600), math.log(max(newest - oldest, 3601)))))
+    start = rng.randrange(oldest, max(oldest + 1, newest - span))
+    bucket_size = next((size for size in DOWNLOAD_BUCKET_SIZES if span / size <= max_points), DOWNLOAD_BUCKET_SIZES[-1])
+    aggregation = "mean" if bucket_size < 4 else rng.choice(["mean", "mean", "m4", "min-max"])
+    ext = rng.choice(DOWNLOAD_TYPES)
+    return (
+        f"http://localhost:{port}/download/samples_custom.{ext}?quantity=power&bucket_size={bucket_size}"
+        f"&oldest={start}&newest={start + span}&aggregation={aggregation}"
+    )
+
+
+def run_downloaders(
+        port: int, downloader_count: int, oldest: int, newest: int, max_points: int, seed: int, ready, stop, results
+):
+    """
+    Run `downloader_count` threads that each keep downloading random custom ranges until `stop` is set,
+    recording the latency and size of every download. Runs in a separate process for the same reason as the clients.
+    """
+    while True:
+        try:
+            urllib.request.urlopen(f"http://localhost:{port}/", timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    ready.set()
+
+    def downloader(index: int, records: list):
+        rng = random.Random(seed + index)
+        while not stop.is_set():
+            url = random_download_url(rng, port, oldest, newest, max_points)
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(url, timeout=60) as response:
+                    size = len(response.read())
+                ok = True
+            except OSError as e:
+                print(f"Download failed: {url}: {e}")
+                size, ok = 0, False
+            records.append((url.split("?")[0].rsplit(".", 1)[1], time.perf_counter() - start, size, ok))
+
+    records = [[] for _ in range(downloader_count)]
+    threads = [Thread(target=downloader, args=(i, r)) for i, r in enumerate(records)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put([record for thread_records in records for record in thread_records])
+
+
+def summarize(values) -> dict:
+    """
+    Count, mean, percentiles and max of `values`, in the unit they are given in.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {"count": 0}
+    percentiles = np.percentile(values, [q * 100 for q in QUANTILES])
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        **{f"p{round(q * 100)}": float(p) for q, p in zip(QUANTILES, percentiles)},
+        "max": float(values.max()),
+    }
+
+
+def stage_summary() -> dict:
+    """
+    Percentiles of every hot path stage, estimated from the metrics histograms.
+    """
+    result = {}
+    for metric in metrics.REGISTRY.metrics:
+        if not isinstance(metric, metrics.Histogram):
+            continue
+        count = sum(state[2] for state in metric.values.values())
+        total = sum(state[1] for state in metric.values.values())
+        quantiles = metric.quantiles(QUANTILES) if count > 0 else []
+        result[metric.name] = {
+            "count": count,
+            "mean": total / count if count > 0 else None,
+            **{f"p{round(q * 100)}": value for q, value in zip(QUANTILES, quantiles)},
+        }
+    return result
+
+
+def inserted_messages() -> int:
+    return int(sum(metrics.INSERT_MESSAGES.values.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_load")
+    parser.add_argument("--database", help="existing database to start from, it is copied first")
+    parser.add_argument("--history-days", type=int, default=30, help="days of history to generate without --database")
+    parser.add_argument("--history-interval", type=int, default=1, help="seconds between generated power samples")
+    parser.add_argument("--messages", type=int, default=3600, help="telegrams to replay")
+    parser.add_argument("--rate", type=float, help="telegrams per second, as fast as possible if missing")
+    parser.add_argument("--burst", type=int, default=1, help="telegrams that arrive at once")
+    parser.add_argument("--gap-probability", type=float, default=0.0)
+    parser.add_argument("--gap-length", type=int, default=60)
+    parser.add_argument("--jump-probability", type=float, default=0.0)
+    parser.add_argument("--jump", type=int, default=3600)
+    parser.add_argument("--clients", type=int, default=20, help="websocket clients")
+    parser.add_argument("--format", choices=["json", "binary"], default="json", help="wire format of the clients")
+    parser.add_argument("--downloaders", type=int, default=2, help="concurrent custom range downloaders")
+    parser.add_argument("--max-download-points", type=int, default=10000)
+    parser.add_argument("--max-batch-delay", type=float, default=0.0)
+    parser.add_argument("--socket-port", type=int, default=8101)
+    parser.add_argument("--http-port", type=int, default=8100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="load_result.json", help="where to write the results as JSON")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    database_path = os.path.join(folder, "load.db")
+    start = time.perf_counter()
+    if args.database is not None:
+        shutil.copyfile(args.database, database_path)
+        newest = Database.open_read_only(database_path).last_timestamp("meter_samples") + 1
+    else:
+        newest = int(time.time()) // DAY * DAY
+        generate_database(database_path, args.history_days, args.history_interval, newest)
+    oldest = Database.open_read_only(database_path).conn.execute(
+        "SELECT MIN(timestamp) FROM meter_samples"
+    ).fetchone()[0] or newest
+    history_delta = time.perf_counter() - start
+    print(f"Prepared '{database_path}' in {history_delta:.2f}s, {os.path.getsize(database_path) / 1024 / 1024:.2f} MB")
+
+    metrics.enable()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    message_queue = QQueue()
+    config = ReplayConfig(
+        start=newest, count=args.messages, rate=args.rate, burst=args.burst,
+        gap_probability=args.gap_probability, gap_length=args.gap_length,
+        jump_probability=args.jump_probability, jump=args.jump, seed=args.seed,
+    )
+
+    # the server prints a line for every message sent, hide those
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        server = Thread(
+            target=server_main, args=(database_path, message_queue),
+            kwargs={
+                "max_batch_delay": args.max_batch_delay,
+                "socket_port": args.socket_port, "http_ports": [args.http_port]
+            },
+            daemon=True,
+        )
+        server.start()
+
+        # don't fork, the server threads are already running
+        context = multiprocessing.get_context("spawn")
+        stop = context.Event()
+        client_ready, downloader_ready = context.Event(), context.Event()
+        client_results, downloader_results = context.Queue(), context.Queue()
+        processes = [
+            context.Process(
+                target=run_clients,
+                args=(args.socket_port, args.clients, args.format, client_ready, stop, client_results)
+            ),
+            context.Process(
+                target=run_downloaders,
+                args=(
+                    args.http_port, args.downloaders, oldest, newest + args.messages, args.max_download_points,
+                    args.seed, downloader_ready, stop, downloader_results,
+                )
+            ),
+        ]
+        for process in processes:
+            process.start()
+        client_ready.wait()
+        downloader_ready.wait()
+
+        # the first time each meter timestamp was put, later duplicates from clock jumps don't count
+        sent = {}
+        max_queue_depth = 0
+        inserted_before = inserted_messages()
+        replay_start = time.monotonic()
+        put_count = []
+        replay = Thread(target=lambda: put_count.append(
+            run_replay(message_queue.put, config, on_put=lambda t: sent.setdefault(t, time.monotonic()))
+        ))
+        replay.start()
+
+        while replay.is_alive() or inserted_messages() - inserted_before < put_count[0]:
+            if not server.is_alive():
+                print("The server stopped, see the traceback above", file=sys.stderr)
+                os._exit(1)
+            max_queue_depth = max(max_queue_depth, message_queue.qsize())
+            time.sleep(0.01)
+        ingest_delta = time.monotonic() - replay_start
+
+        time.sleep(1)
+        stop.set()
+        arrivals, sizes = client_results.get()
+        downloads = downloader_results.get()
+        for process in processes:
+            process.join()
+            process.close()
+        client_results.close()
+        downloader_results.close()
+        # `os._exit` below skips the finalizers that unlink the semaphores of the events and queues,
+        # so release them here, otherwise the resource tracker warns about leaked semaphores
+        del stop, client_ready, downloader_ready, client_results, downloader_results
+
+    # the 1 s bucket of a telegram is sent as soon as the telegram is processed
+    latencies = [
+        recv - sent[timestamp]
+        for client_arrivals in arrivals
+        for timestamp, recv in client_arrivals
+        if timestamp in sent
+    ]
+    payload_sizes = {
+        ty: summarize([size for client_sizes in sizes for t, size in client_sizes if t == ty])
+        for ty in ["initial", "update"]
+    }
+    download_summary = {
+        ext: summarize([latency for e, latency, _, ok in downloads if e == ext and ok]) for ext in DOWNLOAD_TYPES
+    }
+    database_bytes = sum(
+        os.path.getsize(path) for path in [database_path, database_path + "-wal"] if os.path.exists(path)
+    )
+
+    result = {
+        "config": vars(args),
+        "history_seconds": history_delta,
+        "ingest": {
+            "messages": put_count[0],
+            "seconds": ingest_delta,
+            "messages_per_second": put_count[0] / ingest_delta,
+            "max_queue_depth": max_queue_depth,
+        },
+        # updates that arrive while a client is still busy are merged, so there can be fewer than one per telegram
+        "update_latency_seconds": summarize(latencies),
+        "telegram_updates": args.clients * len(sent),
+        "stages_seconds": stage_summary(),
+        "payload_bytes": payload_sizes,
+        "download_seconds": download_summary,
+        "download_bytes": summarize([size for _, _, size, ok in downloads if ok]),
+        "download_errors": sum(not ok for *_, ok in downloads),
+        "memory": {
+            # kilobytes on Linux
+            "server_max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "database_bytes": database_bytes,
+        },
+    }
+    with open(args.output, "w") as f:
+        simplejson.dump(result, f, indent=2, ignore_nan=True)
+
+    ingest = result["ingest"]
+    print(f"Ingested {ingest['messages']} messages in {ingest['seconds']:.2f}s, "
+          f"{ingest['messages_per_second']:.0f}/s, max queue depth {max_queue_depth}")
+    print(f"Received {len(latencies)} updates for {result['telegram_updates']} telegrams over all clients")
+    if len(latencies) > 0:
+        latency = result["update_latency_seconds"]
+        print(f"Update latency: p50 {latency['p50'] * 1000:.2f} ms, p90 {latency['p90'] * 1000:.2f} ms, "
+              f"p99 {latency['p99'] * 1000:.2f} ms, max {latency['max'] * 1000:.2f} ms")
+    for name, stage in result["stages_seconds"].items():
+        if stage["count"] > 0:
+            print(f"  {name}: {stage['count']} times, p50 {stage['p50'] * 1000:.3f} ms, "
+                  f"p99 {stage['p99'] * 1000:.3f} ms")
+    print(f"Downloads: {len(downloads)}, {result['download_errors']} failed")
+    print(f"Max RSS: {result['memory']['server_max_rss_bytes'] / 1024 / 1024:.1f} MB")
+    print(f"Results written to '{args.output}'")
+
+    # the websocket and Flask threads don't stop by themselves
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
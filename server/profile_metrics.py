@@ -0,0 +1,100 @@
+import argparse
+import os
+import tempfile
+import time
+
+from inputs.adc import ADCMessage
+from inputs.serial_frames import TelegramReader
+from server import metrics
+from server.data import DataStore, Database, Payload, WireFormat
+from server.dummy_server import build_telegram
+
+
+def time_timers(count: int, enabled: bool) -> float:
+    """
+    Time `count` empty timed blocks, returns the time per block in seconds.
+    """
+    # a separate registry, so these don't show up in the real metrics
+    registry = metrics.Registry()
+    registry.enabled = enabled
+    histogram = metrics.Histogram("profile_seconds", "Empty timed blocks.", registry=registry)
+    start = time.perf_counter()
+    for _ in range(count):
+        with histogram.time():
+            pass
+    return (time.perf_counter() - start) / count
+
+
+def time_pipeline(timestamps: range, batch_size: int) -> (float, int):
+    """
+    Parse a telegram for every timestamp and push them through a new store in batches, like the live server does,
+    including encoding every update once in each wire format. Returns the time per message in seconds and the number
+    of messages.
+    """
+    telegrams = b"".join(build_telegram(timestamp) for timestamp in timestamps)
+    store = DataStore(Database(os.path.join(tempfile.mkdtemp(), "metrics.db")))
+
+    start = time.perf_counter()
+    messages = TelegramReader().push(telegrams)
+    messages += [ADCMessage(timestamp=timestamp, voltage_int=512) for timestamp in timestamps[::2]]
+    messages.sort(key=lambda msg: msg.timestamp)
+
+    for i in range(0, len(messages), batch_size):
+        update = store.apply_messages(messages[i:i + batch_size])
+        for wire_format in WireFormat:
+            Payload.encode("update", update, wire_format)
+    delta = time.perf_counter() - start
+
+    store.database.close()
+    return delta / len(messages), len(messages)
+
+
+def observation_count() -> int:
+    return sum(
+        count
+        for metric in metrics.REGISTRY.metrics if isinstance(metric, metrics.Histogram)
+        for _, _, count in metric.values.values()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_metrics")
+    parser.add_argument("--messages", type=int, default=4 * 3600, help="number of telegrams to process")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    timer_count = 1000 * 1000
+    disabled_timer = time_timers(timer_count, False)
+    enabled_timer = time_timers(timer_count, True)
+    print(f"Timed block: disabled {disabled_timer * 1e9:.0f} ns, enabled {enabled_timer * 1e9:.0f} ns")
+
+    # alternate the runs, so slow drift of the machine affects both the same
+    newest = int(time.time()) // 3600 * 3600
+    timestamps = range(newest - args.messages, newest)
+    results = {False: [], True: []}
+    enabled_messages = 0
+    for _ in range(args.repeats):
+        for enabled in [False, True]:
+            metrics.REGISTRY.enabled = enabled
+            delta, message_count = time_pipeline(timestamps, args.batch_size)
+            results[enabled].append(delta)
+            enabled_messages += message_count if enabled else 0
+
+    disabled, enabled = min(results[False]), min(results[True])
+    print(f"Pipeline per message: disabled {disabled * 1e6:.1f} us, enabled {enabled * 1e6:.1f} us "
+          f"({(enabled / disabled - 1) * 100:+.1f}%)")
+
+    # the end-to-end difference is often within the noise, so also estimate it from the number of timed blocks
+    blocks = observation_count() / enabled_messages
+    print(f"Timed blocks per message: {blocks:.2f}, estimated overhead {blocks * enabled_timer * 1e6:.2f} us "
+          f"({blocks * enabled_timer / disabled * 100:.2f}%) enabled, "
+          f"{blocks * disabled_timer * 1e6:.2f} us ({blocks * disabled_timer / disabled * 100:.2f}%) disabled")
+
+    start = time.perf_counter()
+    text = metrics.REGISTRY.render()
+    print(f"Rendering /metrics: {(time.perf_counter() - start) * 1000:.2f} ms, {len(text) / 1024:.1f} kB")
+
+
+if __name__ == '__main__':
+    main()
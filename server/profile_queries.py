@@ -0,0 +1,71 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from server.data import Database
+from server.kinds import SeriesKind
+from server.profile_startup import generate_database, DAY
+
+
+def time_queries(database: Database, name: str, kind: SeriesKind, bucket_size, span: int, count: int):
+    """
+    Time `count` queries for random ranges of `span` seconds, with the bounds aligned to the bucket size.
+    """
+    oldest = database.conn.execute(f"SELECT MIN(timestamp) FROM {kind.value.table}").fetchone()[0]
+    newest = database.last_timestamp(kind.value.table)
+    if newest - oldest <= span:
+        print(f"{name:<40} skipped, the database is too short")
+        return
+    align = bucket_size or 1
+    rng = random.Random(0)
+
+    rows = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        range_oldest = rng.randrange(oldest, newest - span) // align * align
+        rows += len(database.fetch_series_items(kind, bucket_size, range_oldest, range_oldest + span).fetchall())
+    delta = time.perf_counter() - start
+
+    print(f"{name:<40} {delta / count * 1000:10.3f} ms/query, {rows // count} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_queries")
+    parser.add_argument("path_db", nargs="?", help="database to use, a new synthetic one is generated if missing")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--interval", type=int, default=1, help="seconds between power samples")
+    args = parser.parse_args()
+
+    path_db = args.path_db or os.path.join(tempfile.mkdtemp(), "queries.db")
+    if not os.path.exists(path_db):
+        generate_database(path_db, args.days, args.interval, int(time.time()) // DAY * DAY)
+    print(f"Database size: {os.path.getsize(path_db) / 1024 / 1024:.2f} MB")
+
+    database = Database.open_read_only(path_db)
+    power = SeriesKind.POWER
+    print(f"Compact meter samples: {database.compact}")
+
+    time_queries(database, "raw, 10 s", power, None, 10, 10000)
+    time_queries(database, "raw, 1 h", power, None, 60 * 60, 100)
+    time_queries(database, "raw, 1 day", power, None, DAY, 10)
+
+    time_queries(database, "rollups, 1 h at 10 s", power, 10, 60 * 60, 1000)
+    time_queries(database, "rollups, 1 day at 1 min", power, 60, DAY, 100)
+    time_queries(database, "rollups, 1 week at 15 min", power, 15 * 60, 7 * DAY, 100)
+    time_queries(database, "rollups, 31 days at 15 min (water)", SeriesKind.WATER_VOLUME, 15 * 60, 31 * DAY, 20)
+
+    # the same without rollups, like a database that was never backfilled
+    for table in database.rollups.complete:
+        database.rollups.complete[table] = False
+
+    time_queries(database, "no rollups, 1 h at 10 s", power, 10, 60 * 60, 100)
+    time_queries(database, "no rollups, 1 day at 1 min", power, 60, DAY, 10)
+    time_queries(database, "no rollups, 1 week at 15 min", power, 15 * 60, 7 * DAY, 3)
+
+    database.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from inputs.adc import ADCMessage
+from inputs.parse import MeterMessage
+from server.data import DataStore, Database
+
+DAY = 24 * 60 * 60
+GAS_PERIOD = 5 * 60
+WATER_PERIOD = 2
+
+
+def generate_database(path: str, days: int, interval: int, newest: int):
+    """
+    Fill a new database with `days` of synthetic samples ending at `newest`, one power sample every `interval` seconds.
+    """
+    database = Database(path)
+    oldest = newest - days * DAY
+
+    for day_start in range(oldest, newest, DAY):
+        day_end = min(day_start + DAY, newest)
+
+        t = np.arange(day_start, day_end, interval)
+        powers = 0.5 + 0.4 * np.sin(t[None, :] / 3600 + np.arange(3)[:, None]) + np.random.rand(3, len(t)) * 0.1
+        database.conn.executemany(
+            "INSERT OR REPLACE INTO meter_samples VALUES(?, '000000000000W', ?, ?, ?, 230.0, 230.0, 230.0)",
+            zip(t.tolist(), *powers.tolist())
+        )
+
+        t_gas = np.arange(day_start, day_end, GAS_PERIOD)
+        database.conn.executemany(
+            "INSERT OR REPLACE INTO gas_samples VALUES(?, '000000000000W', ?)",
+            zip(t_gas.tolist(), ((t_gas - oldest) * 1e-5).tolist())
+        )
+
+        t_water = np.arange(day_start, day_end, WATER_PERIOD * interval)
+        voltages = np.random.randint(300, 900, len(t_water))
+        database.conn.executemany(
+            "INSERT OR REPLACE INTO water_height_samples VALUES(?, ?)",
+            zip(t_water.tolist(), voltages.tolist())
+        )
+
+        for table in ["meter_samples", "gas_samples", "water_height_samples"]:
+            database.rollups.update_many(table, [day_start, day_end - 1])
+        database.conn.commit()
+
+        done = (day_end - oldest) / (newest - oldest)
+        print(f"\rGenerating database: {done:.0%}", end="", flush=True)
+
+    print()
+    database.close()
+
+
+def messages_at(timestamp: int):
+    return [
+        MeterMessage(
+            timestamp, "000000000000W", 0.5, 0.5, 0.5, 230.0, 230.0, 230.0,
+            math.nan, None, None, 1.0, timestamp // GAS_PERIOD * GAS_PERIOD, "000000000000W"
+        ),
+        ADCMessage(timestamp=timestamp, voltage_int=512),
+    ]
+
+
+def time_first_update(path: str, timestamp: int, snapshot_path=None) -> (float, DataStore):
+    """
+    Time opening the database and processing the first messages, until the first websocket update is ready.
+    """
+    start = time.perf_counter()
+    store = DataStore(Database(path), snapshot_path=snapshot_path)
+    store.apply_messages(messages_at(timestamp))
+    return time.perf_counter() - start, store
+
+
+def same_history(a: DataStore, b: DataStore) -> bool:
+    """
+    Compare the tracked series of both stores, ignoring the buckets outside of the window that might not be dropped yet.
+    """
+    view_a, view_b = a.get_view(), b.get_view()
+
+    for key in view_a.multi_series.map:
+        oldest = max(view_a.covered_range(key)[0], view_b.covered_range(key)[0])
+        series_a, series_b = view_a.multi_series.map[key], view_b.multi_series.map[key]
+        start_a = np.searchsorted(series_a.timestamps, oldest)
+        start_b = np.searchsorted(series_b.timestamps, oldest)
+
+        if not np.array_equal(series_a.timestamps[start_a:], series_b.timestamps[start_b:]):
+            return False
+        if not np.allclose(series_a.values[:, start_a:], series_b.values[:, start_b:], equal_nan=True):
+            return False
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_startup")
+    parser.add_argument("path_db", nargs="?", help="database to use, a new synthetic one is generated if missing")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--interval", type=int, default=1, help="seconds between power samples")
+    parser.add_argument("--downtime", type=int, default=10 * 60, help="seconds between the shutdown and restart")
+    parser.add_argument(
+        "--no-rollups", action="store_true",
+        help="mark the rollups as incomplete, like a database that was never backfilled"
+    )
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    path_db = args.path_db or os.path.join(folder, "startup.db")
+    path_snapshot = os.path.join(folder, "startup.tracker.npz")
+
+    newest = int(time.time()) // DAY * DAY
+    if not os.path.exists(path_db):
+        start = time.perf_counter()
+        generate_database(path_db, args.days, args.interval, newest)
+        print(f"Generated '{path_db}' in {time.perf_counter() - start:.2f}s")
+    else:
+        newest = Database.open_read_only(path_db).last_timestamp("meter_samples") + 1
+
+    print(f"Database size: {os.path.getsize(path_db) / 1024 / 1024:.2f} MB")
+
+    database = Database(path_db)
+    database.conn.execute("UPDATE rollup_status SET complete = ?", (int(not args.no_rollups),))
+    database.conn.commit()
+    database.close()
+
+    # cold start without a snapshot yet, then shut down and save one
+    cold_delta, store = time_first_update(path_db, newest, path_snapshot)
+    start = time.perf_counter()
+    store.save_snapshot()
+    store.database.close()
+    save_delta = time.perf_counter() - start
+    print(f"Snapshot size: {os.path.getsize(path_snapshot) / 1024:.2f} kB")
+
+    # restart after some downtime, with and without the snapshot
+    restart = newest + args.downtime
+    warm_delta, warm_store = time_first_update(path_db, restart, path_snapshot)
+    check_delta, check_store = time_first_update(path_db, restart)
+
+    print(f"Cold start: {cold_delta:.3f}s, without snapshot after downtime {check_delta:.3f}s")
+    print(f"Saving snapshot: {save_delta:.3f}s")
+    print(f"Start from snapshot: {warm_delta:.3f}s")
+    print(f"Same history: {same_history(warm_store, check_store)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from server.data import MultiSeries, Series, Buckets, SeriesKind, WireFormat, Payload
+
+
+def synthetic_multi_series(now: int) -> MultiSeries:
+    """
+    Build a full history with the same series and sizes as `Tracker`, filled with random data.
+    """
+    rng = np.random.default_rng(0)
+    multi_series = MultiSeries({
+        "minute": Series.empty(SeriesKind.POWER, Buckets(60, 1)),
+        "hour": Series.empty(SeriesKind.POWER, Buckets(60 * 60, 10)),
+        "day": Series.empty(SeriesKind.POWER, Buckets(24 * 60 * 60, 60)),
+        "week": Series.empty(SeriesKind.POWER, Buckets(7 * 24 * 60 * 60, 15 * 60)),
+        "gas": Series.empty(SeriesKind.GAS, Buckets(7 * 24 * 60 * 60, None)),
+        "water": Series.empty(SeriesKind.WATER_VOLUME, Buckets(31 * 24 * 60 * 60, 15 * 60)),
+    })
+
+    for series in multi_series.map.values():
+        step = series.buckets.bucket_size or 5 * 60
+        timestamps = np.arange(now - series.buckets.window_size, now, step, dtype=np.int64)
+        values = rng.random((len(series.kind.value.columns), len(timestamps))) * 1000
+        series.extend_arrays(timestamps, values)
+
+    return multi_series
+
+
+def main():
+    multi_series = synthetic_multi_series(int(time.time()))
+    repeats = 20
+
+    results = {}
+    for wire_format in WireFormat:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            payload = Payload.encode("initial", multi_series, wire_format)
+        delta = (time.perf_counter() - start) / repeats
+
+        results[wire_format] = (len(payload.data), delta)
+        print(f"{wire_format.value}: {len(payload.data) / 1024:.2f} kB, encode {delta * 1000:.2f} ms")
+
+    json_size, json_time = results[WireFormat.JSON]
+    binary_size, binary_time = results[WireFormat.BINARY]
+    print(f"Size reduction: {json_size / binary_size:.2f}x, encode time reduction: {json_time / binary_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
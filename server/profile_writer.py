@@ -0,0 +1,67 @@
+import argparse
+import itertools
+import os
+import tempfile
+import time
+from queue import Queue as QQueue
+
+from server.data import DataStore, Database, WireFormat
+from server.log2db import iter_messages
+from server.main import collect_batch
+
+
+class CountingOutbox:
+    """
+    Stand-in for a websocket client outbox that only counts the broadcast payloads.
+    """
+
+    def __init__(self):
+        self.wire_format = WireFormat.JSON
+        self.channels = None
+        self.updates = 0
+        self.bytes = 0
+
+    def put(self, update, payload):
+        self.updates += 1
+        self.bytes += len(payload.data)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="profile_writer")
+    parser.add_argument("path_log", nargs="?", default="log.txt")
+    parser.add_argument("--limit", type=int, default=20_000, help="maximum number of messages to replay")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256, 1024])
+    args = parser.parse_args()
+
+    print(f"Parsing '{args.path_log}'")
+    messages = [msg for _, msg in itertools.islice(iter_messages(args.path_log), args.limit)]
+    print(f"Replaying {len(messages)} messages")
+
+    for max_batch_size in args.batch_sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            database = Database(os.path.join(folder, "profile.db"))
+            store = DataStore(database)
+            client = CountingOutbox()
+            store.outboxes.add(client)
+
+            message_queue = QQueue()
+            for msg in messages:
+                message_queue.put(msg)
+
+            start = time.perf_counter()
+            commits = 0
+            while not message_queue.empty():
+                store.process_messages(collect_batch(message_queue, max_batch_size, 0.0))
+                commits += 1
+            delta = time.perf_counter() - start
+
+            database.close()
+
+        print(
+            f"Batch size {max_batch_size}: {len(messages) / delta:.2f} messages/s, {commits} commits, "
+            f"{client.updates} updates with {client.bytes} bytes"
+        )
+
+
+if __name__ == '__main__':
+    main()
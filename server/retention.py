@@ -0,0 +1,230 @@
+import calendar
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from server.kinds import SeriesKind
+from server.rollup import ROLLUP_RESOLUTIONS, Rollups, rollup_table
+
+# The raw samples of these tables are subject to retention, with the columns that are kept in the partitions.
+# Peaks and gas samples arrive at most every few minutes, so they are small enough to keep forever.
+RETENTION_COLUMNS = {
+    "meter_samples": {
+        "timestamp": "INTEGER PRIMARY KEY",
+        "instant_power_1": "REAL",
+        "instant_power_2": "REAL",
+        "instant_power_3": "REAL",
+        "voltage_1": "REAL",
+        "voltage_2": "REAL",
+        "voltage_3": "REAL",
+    },
+    "water_height_samples": {
+        "timestamp": "INTEGER PRIMARY KEY",
+        "voltage_int": "INTEGER",
+    },
+}
+
+# Raw samples are moved in chunks of this many seconds, each chunk is a separate short transaction.
+RETENTION_CHUNK_SIZE = 60 * 60
+
+# Seconds between maintenance runs of the live server, and the time each run may spend moving chunks.
+RETENTION_PERIOD = 10
+RETENTION_BUDGET = 0.05
+
+
+@dataclass
+class RetentionPolicy:
+    # number of days the raw samples are kept in the main database
+    raw_days: int
+    # move older raw samples to monthly partition files instead of deleting them
+    archive: bool = False
+
+
+def month_start(timestamp: int) -> int:
+    t = time.gmtime(timestamp)
+    return calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+
+
+def next_month(timestamp: int) -> int:
+    t = time.gmtime(month_start(timestamp))
+    year, month = (t.tm_year + 1, 1) if t.tm_mon == 12 else (t.tm_year, t.tm_mon + 1)
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def partition_path(database_path: str, timestamp: int) -> str:
+    """
+    The file that holds the archived raw samples of the month containing `timestamp`.
+    """
+    return os.path.splitext(database_path)[0] + time.strftime(".raw-%Y-%m.db", time.gmtime(timestamp))
+
+
+class ChainedCursor:
+    """
+    Cursor-like concatenation of the results of several queries,
+    each query is only executed once the results of the previous ones have been consumed.
+    """
+
+    def __init__(self, queries: List[Callable[[], sqlite3.Cursor]]):
+        self.queries = list(reversed(queries))
+        self.cursor: Optional[sqlite3.Cursor] = None
+
+    def fetchmany(self, size: int) -> list:
+        rows = []
+        while len(rows) < size:
+            if self.cursor is None:
+                if len(self.queries) == 0:
+                    break
+                self.cursor = self.queries.pop()()
+
+            batch = self.cursor.fetchmany(size - len(rows))
+            if len(batch) == 0:
+                self.cursor = None
+            rows += batch
+        return rows
+
+    def fetchall(self) -> list:
+        rows = []
+        while True:
+            batch = self.fetchmany(16 * 1024)
+            if len(batch) == 0:
+                return rows
+            rows += batch
+
+    def __iter__(self):
+        while True:
+            batch = self.fetchmany(1024)
+            if len(batch) == 0:
+                return
+            yield from batch
+
+
+class Retention:
+    """
+    Keeps track of the raw samples that have been removed from the main database.
+
+    Raw samples older than the retention window are only kept in the rollup tables, which store the count, sum, min
+    and max per bucket of 10 s and up. Optionally they are first moved into monthly partition files next to the
+    database, which can be moved off the device or deleted one month at a time.
+    For every table `raw_since` is the timestamp before which the raw samples are no longer in the main database.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, path: str, rollups: Rollups, read_only: bool = False):
+        self.conn = conn
+        self.path = path
+        self.rollups = rollups
+        # read-only connections to the partition files, opened when first needed
+        self.partitions: Dict[int, sqlite3.Connection] = {}
+
+        if read_only:
+            self.has_status = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'retention_status'"
+            ).fetchone() is not None
+            return
+
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS retention_status("
+            "    name TEXT PRIMARY KEY,"
+            "    raw_since INTEGER"
+            ")"
+        )
+        self.has_status = True
+
+    def raw_since(self, table: str) -> Optional[int]:
+        if not self.has_status:
+            return None
+        row = self.conn.execute("SELECT raw_since FROM retention_status WHERE name = ?", (table,)).fetchone()
+        return row[0] if row is not None else None
+
+    def partition(self, timestamp: int, table: str) -> Optional[sqlite3.Connection]:
+        """
+        Connection to the partition of the month containing `timestamp`, or None if `table` was not archived there.
+        """
+        month = month_start(timestamp)
+        if month not in self.partitions:
+            path = partition_path(self.path, month)
+            if not os.path.exists(path):
+                return None
+            # just like the read-only database, used by different threads but never at the same time
+            self.partitions[month] = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+        conn = self.partitions[month]
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        return conn if exists is not None else None
+
+    def can_prune(self, table: str) -> bool:
+        """
+        Raw samples can only be removed once all rollups built from them are complete.
+        """
+        self.rollups.refresh()
+        return all(
+            self.rollups.complete[rollup_table(kind, resolution)]
+            for kind in SeriesKind if kind.value.table == table
+            for resolution in ROLLUP_RESOLUTIONS
+        )
+
+    def prune_chunk(self, table: str, raw_days: int, archive: bool) -> bool:
+        """
+        Remove the oldest chunk of raw samples from `table` that is outside of the retention window and commit.
+        Returns whether there was anything to remove.
+        """
+        # separate subqueries, a single MIN/MAX query scans the whole table
+        oldest, newest = self.conn.execute(
+            f"SELECT (SELECT MIN(timestamp) FROM {table}), (SELECT MAX(timestamp) FROM {table})"
+        ).fetchone()
+        if oldest is None:
+            return False
+
+        # keep whole days, so the boundary lines up with every rollup bucket
+        day = ROLLUP_RESOLUTIONS[-1]
+        target = (newest - raw_days * day) // day * day
+        if oldest >= target:
+            return False
+
+        start = oldest // RETENTION_CHUNK_SIZE * RETENTION_CHUNK_SIZE
+        end = min(start + RETENTION_CHUNK_SIZE, target)
+
+        if archive:
+            self._archive_range(table, start, end)
+
+        # the partition is committed first, if we crash before the delete the chunk is just archived again
+        self.conn.execute(f"DELETE FROM {table} WHERE ? <= timestamp AND timestamp < ?", (start, end))
+        self.conn.execute(
+            "INSERT INTO retention_status VALUES(?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET raw_since = MAX(raw_since, excluded.raw_since)",
+            (table, end)
+        )
+        self.conn.commit()
+        return True
+
+    def _archive_range(self, table: str, start: int, end: int):
+        columns = RETENTION_COLUMNS[table]
+        definitions = ", ".join(f"{column} {ty}" for column, ty in columns.items())
+
+        self.conn.execute("ATTACH DATABASE ? AS archive", (partition_path(self.path, start),))
+        try:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table}({definitions})")
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO archive.{table} "
+                f"SELECT {', '.join(columns)} FROM main.{table} WHERE ? <= timestamp AND timestamp < ?",
+                (start, end)
+            )
+            self.conn.commit()
+        finally:
+            self.conn.execute("DETACH DATABASE archive")
+
+    def run(self, policy: RetentionPolicy, budget: Optional[float] = None):
+        """
+        Prune chunks of all tables until everything outside of the retention window is removed,
+        or until `budget` seconds have passed. Yields `(table, raw_since)` after every chunk.
+        """
+        start = time.perf_counter()
+        for table in RETENTION_COLUMNS:
+            if not self.can_prune(table):
+                continue
+
+            while budget is None or time.perf_counter() - start < budget:
+                if not self.prune_chunk(table, policy.raw_days, policy.archive):
+                    break
+                yield table, self.raw_since(table)
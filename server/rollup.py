@@ -0,0 +1,184 @@
+import sqlite3
+from typing import Dict, List, Optional
+
+from server.kinds import SeriesKind
+
+# Resolutions of the pre-aggregated tables, each one must divide the next one.
+# Level 0 is computed from the raw samples, every later level from the previous level.
+ROLLUP_RESOLUTIONS = [10, 60, 15 * 60, 60 * 60, 24 * 60 * 60]
+
+# Backfilling is done in chunks of this size, so the writer is never blocked for long.
+BACKFILL_CHUNK_SIZE = 24 * 60 * 60
+
+
+def rollup_table(kind: SeriesKind, resolution: int) -> str:
+    return f"rollup_{kind.name.lower()}_{resolution}"
+
+
+def rollup_aggregates(kind: SeriesKind, from_raw: bool) -> str:
+    """
+    Build the aggregate expressions for a rollup table.
+    If `from_raw` aggregate raw samples, otherwise merge the rollup rows of a finer level.
+    """
+    items = []
+    for i, column in enumerate(kind.value.columns):
+        if from_raw:
+            items += [f"COUNT({column})", f"SUM({column})", f"MIN({column})", f"MAX({column})"]
+        else:
+            items += [f"SUM(count_{i})", f"SUM(sum_{i})", f"MIN(min_{i})", f"MAX(max_{i})"]
+    return ", ".join(items)
+
+
+class Rollups:
+    """
+    Maintains tables with per-bucket count/sum/min/max for each `SeriesKind` at the fixed `ROLLUP_RESOLUTIONS`.
+
+    The tables are updated incrementally on every insert, but for databases that already contained data
+    before the rollup tables were created they need to be backfilled once (see `server.manage`),
+    until then the rollups are marked as incomplete and not used for queries.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, read_only: bool = False):
+        self.conn = conn
+        self.complete: Dict[str, bool] = {}
+
+        if read_only:
+            self.refresh()
+            return
+
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollup_status("
+            "    name TEXT PRIMARY KEY,"
+            "    complete INTEGER"
+            ")"
+        )
+
+        status = dict(conn.execute("SELECT name, complete FROM rollup_status").fetchall())
+
+        for kind in SeriesKind:
+            source_empty = conn.execute(f"SELECT 1 FROM {kind.value.table} LIMIT 1").fetchone() is None
+
+            for resolution in ROLLUP_RESOLUTIONS:
+                table = rollup_table(kind, resolution)
+                columns = ", ".join(
+                    f"count_{i} INTEGER, sum_{i} REAL, min_{i} REAL, max_{i} REAL"
+                    for i in range(len(kind.value.columns))
+                )
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table}(bucket INTEGER PRIMARY KEY, {columns})")
+
+                if table not in status:
+                    # a new rollup table is only complete if there is nothing to backfill
+                    status[table] = int(source_empty)
+                    conn.execute("INSERT INTO rollup_status VALUES(?, ?)", (table, status[table]))
+
+                self.complete[table] = bool(status[table])
+
+    def refresh(self):
+        """
+        Reload which rollups are complete, they can be backfilled or invalidated by another process at any time.
+        Rollups that don't exist yet are treated as incomplete.
+        """
+        has_status = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_status'"
+        ).fetchone() is not None
+        status = dict(self.conn.execute("SELECT name, complete FROM rollup_status").fetchall()) if has_status else {}
+
+        for kind in SeriesKind:
+            for resolution in ROLLUP_RESOLUTIONS:
+                table = rollup_table(kind, resolution)
+                self.complete[table] = bool(status.get(table, 0))
+
+    def _update_range(self, kind: SeriesKind, oldest: int, newest: int):
+        """
+        Recompute all rollup buckets of `kind` that overlap the range `oldest` (inclusive) to `newest` (exclusive).
+        """
+        prev_table = None
+
+        for resolution in ROLLUP_RESOLUTIONS:
+            table = rollup_table(kind, resolution)
+            bucket_oldest = oldest // resolution * resolution
+            bucket_newest = -(-newest // resolution) * resolution
+
+            if prev_table is None:
+                source_table, source_column = kind.value.table, "timestamp"
+                aggregates = rollup_aggregates(kind, True)
+            else:
+                source_table, source_column = prev_table, "bucket"
+                aggregates = rollup_aggregates(kind, False)
+
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {table} "
+                f"SELECT {source_column} / {resolution} * {resolution}, {aggregates} "
+                f"FROM {source_table} "
+                f"WHERE ? <= {source_column} AND {source_column} < ? "
+                f"GROUP BY {source_column} / {resolution}",
+                (bucket_oldest, bucket_newest)
+            )
+
+            prev_table = table
+
+    def update_many(self, table: str, timestamps: List[int]):
+        """
+        Update the rollups after samples with `timestamps` were inserted into or replaced in `table`.
+        Timestamps that are close together are merged into a single range update. Does not commit.
+        Level 0 is recomputed from the raw samples, so they must not have been removed by retention.
+        """
+        timestamps = sorted(timestamps)
+        max_gap = ROLLUP_RESOLUTIONS[-1]
+
+        start = 0
+        for i in range(1, len(timestamps) + 1):
+            if i == len(timestamps) or timestamps[i] - timestamps[i - 1] > max_gap:
+                for kind in SeriesKind:
+                    if kind.value.table == table:
+                        self._update_range(kind, timestamps[start], timestamps[i - 1] + 1)
+                start = i
+
+    def backfill(self, kind: SeriesKind, chunk_size: int = BACKFILL_CHUNK_SIZE):
+        """
+        Recompute all rollups for `kind` from the raw samples, committing after every chunk.
+        Yields the progress as `(current, oldest, newest)` after each chunk.
+        """
+        oldest, newest = self.conn.execute(
+            f"SELECT MIN(timestamp), MAX(timestamp) FROM {kind.value.table}"
+        ).fetchone()
+
+        if oldest is not None:
+            start = oldest // chunk_size * chunk_size
+            for curr in range(start, newest + 1, chunk_size):
+                self._update_range(kind, curr, curr + chunk_size)
+                self.conn.commit()
+                yield min(curr + chunk_size, newest), oldest, newest
+
+        for resolution in ROLLUP_RESOLUTIONS:
+            table = rollup_table(kind, resolution)
+            self.conn.execute("UPDATE rollup_status SET complete = 1 WHERE name = ?", (table,))
+            self.complete[table] = True
+        self.conn.commit()
+
+    def select_resolution(
+            self, kind: SeriesKind, bucket_size: int,
+            oldest: Optional[int], newest: Optional[int]
+    ) -> Optional[int]:
+        """
+        Pick the coarsest complete rollup resolution that can be used to compute buckets of `bucket_size`
+        between `oldest` and `newest`, or None if the raw samples need to be used.
+        """
+        for resolution in reversed(ROLLUP_RESOLUTIONS):
+            aligned = all(x is None or x % resolution == 0 for x in [bucket_size, oldest, newest])
+            if aligned and self.complete[rollup_table(kind, resolution)]:
+                return resolution
+        return None
+
+
+def rollup_averages(kind: SeriesKind) -> str:
+    return ",\n".join(f"SUM(sum_{i}) / SUM(count_{i})" for i in range(len(kind.value.columns)))
+
+
+def rollup_counts(kind: SeriesKind) -> str:
+    return "".join(f",\nSUM(count_{i})" for i in range(len(kind.value.columns)))
+
+
+def rollup_extremes(kind: SeriesKind) -> str:
+    columns = range(len(kind.value.columns))
+    return "".join(f",\nMIN(min_{i})" for i in columns) + "".join(f",\nMAX(max_{i})" for i in columns)
@@ -0,0 +1,269 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import struct
+import zlib
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock, Thread
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import simplejson
+
+from server import metrics
+from server.data import BroadcastStats, Buckets, MultiSeries, Resume, Series, Tracker, TrackerView
+from server.flask_server import flask_main
+from server.kinds import Aggregation, SeriesKind
+from server.socket_server import AsyncBroadcaster, async_socket_server
+
+# shared memory only takes up the pages that are actually written, so the slots can be generous
+SLOT_SIZE = 16 * 1024 * 1024
+SLOT_COUNT = 4
+# how often the web processes check for a new tracker state, in seconds
+POLL_PERIOD = 0.01
+
+# magic, slot count, slot size, newest published sequence number
+RING_HEADER = struct.Struct("<4sIQQ")
+# sequence number of the state in the slot (0 while it is being written), payload length, crc32 of the payload
+SLOT_HEADER = struct.Struct("<QQI4x")
+RING_MAGIC = b"DMS1"
+PUBLISHED_OFFSET = 16
+
+
+class SharedTrackerRing:
+    """
+    Ring of `Tracker` states in shared memory, published by the writer process after every batch and read by the web
+    processes. Each state gets the next sequence number and is written to slot `sequence % slot_count`, so a reader has
+    `slot_count - 1` batches to copy the newest state before it is overwritten. Readers check the slot sequence number
+    before and after copying and verify a checksum, a torn read is simply retried on the next poll.
+
+    The payload of a slot is a u64 header length, a UTF-8 JSON header padded to 8 bytes and then for every series its
+    int64 timestamps followed by its float64 values, one column after the other.
+    """
+
+    def __init__(self, shm: SharedMemory, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        magic, self.slot_count, self.slot_size, _ = RING_HEADER.unpack_from(shm.buf, 0)
+        assert magic == RING_MAGIC, f"Shared memory '{shm.name}' is not a tracker ring"
+        # the newest sequence number published or read by this process
+        self.sequence = 0
+
+    @staticmethod
+    def create(slot_size: int = SLOT_SIZE, slot_count: int = SLOT_COUNT) -> 'SharedTrackerRing':
+        shm = SharedMemory(create=True, size=RING_HEADER.size + slot_count * slot_size)
+        RING_HEADER.pack_into(shm.buf, 0, RING_MAGIC, slot_count, slot_size, 0)
+        return SharedTrackerRing(shm, owner=True)
+
+    @staticmethod
+    def attach(name: str) -> 'SharedTrackerRing':
+        return SharedTrackerRing(SharedMemory(name=name), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def published(self) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, PUBLISHED_OFFSET)[0]
+
+    def _slot_offset(self, sequence: int) -> int:
+        return RING_HEADER.size + (sequence % self.slot_count) * self.slot_size
+
+    def publish(self, tracker: Tracker):
+        """
+        Write the series, counts and last timestamps of `tracker` to the next slot, the caller is responsible for
+        locking. Custom channels are not included, they only exist in the process that serves the websockets.
+        """
+        entries: List[Tuple[str, Series]] = list(tracker.multi_series.map.items())
+        entries += [(key, series) for key, series in tracker.count_series.map.items()]
+        header = simplejson.dumps({
+            "table_last_timestamp": tracker.table_last_timestamp,
+            "series": [
+                [
+                    key, series.kind.name, series.buckets.window_size, series.buckets.bucket_size,
+                    series.buckets.aggregation.value, len(series),
+                ]
+                for key, series in tracker.multi_series.map.items()
+            ],
+            "counts": [[key, len(series)] for key, series in tracker.count_series.map.items()],
+        }).encode()
+        header = struct.pack("<Q", len(header)) + header + bytes(-len(header) % 8)
+
+        size = len(header) + sum(series.timestamps.nbytes + series.values.nbytes for _, series in entries)
+        if SLOT_HEADER.size + size > self.slot_size:
+            print(f"ERROR: tracker state of {size} bytes does not fit in the shared memory slots of {self.slot_size} bytes")
+            return
+
+        sequence = self.sequence + 1
+        slot = self._slot_offset(sequence)
+        start = slot + SLOT_HEADER.size
+        buf = self.shm.buf
+
+        SLOT_HEADER.pack_into(buf, slot, 0, 0, 0)
+        buf[start:start + len(header)] = header
+        offset = start + len(header)
+        for _, series in entries:
+            count = len(series)
+            np.ndarray(count, dtype=np.int64, buffer=buf, offset=offset)[:] = series.timestamps
+            offset += series.timestamps.nbytes
+            np.ndarray(series.values.shape, dtype=np.float64, buffer=buf, offset=offset)[:] = series.values
+            offset += series.values.nbytes
+
+        SLOT_HEADER.pack_into(buf, slot, sequence, size, zlib.crc32(buf[start:start + size]))
+        struct.pack_into("<Q", buf, PUBLISHED_OFFSET, sequence)
+        self.sequence = sequence
+
+    def read(self) -> Optional[Tuple[TrackerView, MultiSeries]]:
+        """
+        The newest state if it is newer than the previous one read, as a view for downloads and the history that is
+        sent to the websocket clients. None if there is nothing new or the slot was overwritten while copying it.
+        """
+        sequence = self.published()
+        if sequence == self.sequence:
+            return None
+
+        buf = self.shm.buf
+        slot = self._slot_offset(sequence)
+        start = slot + SLOT_HEADER.size
+        slot_sequence, size, crc = SLOT_HEADER.unpack_from(buf, slot)
+        if slot_sequence != sequence or SLOT_HEADER.size + size > self.slot_size:
+            return None
+
+        # copy out once, the series below are views into this copy
+        data = bytes(buf[start:start + size])
+        if zlib.crc32(data) != crc or SLOT_HEADER.unpack_from(buf, slot)[0] != sequence:
+            return None
+        self.sequence = sequence
+
+        header_length = struct.unpack_from("<Q", data, 0)[0]
+        header = simplejson.loads(data[8:8 + header_length])
+        offset = 8 + header_length + (-header_length % 8)
+
+        def take_series(kind: SeriesKind, buckets: Buckets, count: int) -> Series:
+            nonlocal offset
+            columns = len(kind.value.columns)
+            timestamps = np.frombuffer(data, dtype=np.int64, count=count, offset=offset)
+            offset += timestamps.nbytes
+            values = np.frombuffer(data, dtype=np.float64, count=columns * count, offset=offset).reshape(columns, count)
+            offset += values.nbytes
+            return Series(kind, buckets, timestamps, values)
+
+        multi_series = MultiSeries({})
+        for key, kind, window_size, bucket_size, aggregation, count in header["series"]:
+            buckets = Buckets(window_size, bucket_size, Aggregation(aggregation))
+            multi_series.map[key] = take_series(SeriesKind[kind], buckets, count)
+
+        count_series = MultiSeries({})
+        for key, count in header["counts"]:
+            series = multi_series.map[key]
+            count_series.map[key] = take_series(series.kind, series.buckets, count)
+
+        view = TrackerView(multi_series, count_series, header["table_last_timestamp"])
+        history = MultiSeries(dict(multi_series.map))
+        return view, history
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedStore:
+    """
+    Stands in for `DataStore` in the web processes, following the tracker state the writer process publishes in a
+    `SharedTrackerRing`. Custom channels need the tracker itself, so only the default series can be subscribed to.
+    """
+
+    def __init__(self, ring: SharedTrackerRing):
+        self.ring = ring
+        self.lock = Lock()
+        self.stats = BroadcastStats()
+        self.view = TrackerView(MultiSeries({}), MultiSeries({}), {})
+        self.history = MultiSeries({})
+
+    def poll(self) -> Optional[MultiSeries]:
+        """
+        Switch to the newest published state, returns the buckets that are new since the previous one,
+        or None if nothing was published since.
+        """
+        with self.lock:
+            state = self.ring.read()
+            if state is None:
+                return None
+
+            previous = self.history
+            self.view, self.history = state
+
+            # the same buckets the tracker returned as updates, even if a state was skipped in between
+            since = {key: int(series.timestamps[-1]) for key, series in previous.map.items() if len(series) > 0}
+            missing = Resume(self.history.layout(), since).missing(self.history)
+            return MultiSeries({key: series for key, series in missing.map.items() if len(series) > 0})
+
+    def get_view(self) -> TrackerView:
+        self.poll()
+        with self.lock:
+            return self.view
+
+    def channel_keys(self, names: Optional[List[str]]) -> Tuple[str, ...]:
+        default_keys = list(self.history.map)
+        if names is None:
+            return tuple(default_keys)
+        for name in names:
+            if name not in default_keys:
+                raise ValueError(f"Channel '{name}' is not available when the web server runs in a separate process")
+        return tuple(dict.fromkeys(names))
+
+    def acquire_channels(self, keys) -> MultiSeries:
+        return MultiSeries({})
+
+    def release_channels(self, keys):
+        pass
+
+
+def _exit_with_parent():
+    # the ports would stay taken if the writer process was killed without stopping this one
+    multiprocessing.parent_process().join()
+    os._exit(0)
+
+
+def _init_web_process(metrics_enabled: bool):
+    # ctrl+C reaches the whole process group, leave stopping to the writer process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Thread(target=_exit_with_parent, daemon=True).start()
+    if metrics_enabled:
+        metrics.enable()
+
+
+def socket_process_main(ring_name: str, port: int = 8001, metrics_enabled: bool = False):
+    """
+    Serve the websocket clients from the tracker states published in the ring `ring_name`.
+    """
+    _init_web_process(metrics_enabled)
+    store = SharedStore(SharedTrackerRing.attach(ring_name))
+    store.poll()
+
+    async def follow(broadcaster: AsyncBroadcaster):
+        while True:
+            update_series = store.poll()
+            if update_series is None:
+                await asyncio.sleep(POLL_PERIOD)
+                continue
+            broadcaster.publish(update_series, store.history)
+
+    async def main():
+        broadcaster = AsyncBroadcaster(store)
+        broadcaster.history = store.history
+        await asyncio.gather(async_socket_server(broadcaster, port=port), follow(broadcaster))
+
+    asyncio.run(main())
+
+
+def http_process_main(
+        database_path: str, ring_name: str, ports: Sequence[int] = (8000, 80), metrics_enabled: bool = False
+):
+    """
+    Run Flask on read-only database connections, answering downloads from the tracker states in the ring `ring_name`.
+    """
+    _init_web_process(metrics_enabled)
+    flask_main(database_path, SharedStore(SharedTrackerRing.attach(ring_name)), ports)
@@ -1,43 +1,223 @@
 import asyncio
 import functools
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import urlparse, parse_qs
 
-import simplejson
 import websockets
-from janus import Queue as JQueue
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 
-from server.data import MultiSeries, DataStore
+from server import metrics
+from server.data import (
+    DataStore, Payload, WireFormat, MultiSeries, ClientOutbox, Resume, MAX_PENDING_UPDATES,
+    broadcast_update, select_channels,
+)
 
+STATS_PERIOD = 60
 
-async def handler(websocket, store: DataStore):
+
+def parse_wire_format(path: str) -> WireFormat:
+    """
+    Clients can opt in to the binary format by connecting to `/?format=binary`.
+    """
+    query = parse_qs(urlparse(path).query)
+    return WireFormat(query.get("format", ["json"])[0])
+
+
+def parse_channels(path: str) -> Optional[List[str]]:
+    """
+    Clients can subscribe to specific channels with `/?series=minute,power:60:7200`, see `DataStore.channel_keys`.
+    None if they didn't pick any.
+    """
+    query = parse_qs(urlparse(path).query)
+    if "series" not in query:
+        return None
+    return [name for name in query["series"][0].split(",") if name != ""]
+
+
+def parse_resume(path: str) -> Optional[Resume]:
+    """
+    Reconnecting clients pass what they already have as `/?layout=<layout>&since=<key>:<timestamp>,...`,
+    they get a full snapshot if that is missing or invalid.
+    """
+    query = parse_qs(urlparse(path).query)
+    if "layout" not in query:
+        return None
+
+    since = {}
+    for item in query.get("since", [""])[0].split(","):
+        if item == "":
+            continue
+        key, _, timestamp = item.rpartition(":")
+        try:
+            since[key] = int(timestamp)
+        except ValueError:
+            return None
+    return Resume(query["layout"][0], since)
+
+
+class AsyncBroadcaster:
+    """
+    The broadcast half of `DataStore` for the single event loop runtime.
+    It is only used from the event loop, so it needs no lock. Custom channels are still managed by `store`,
+    on `executor` since that takes the store lock and reads the database. It must run one call at a time, so a
+    release always runs after the acquire it belongs to, even if the client disconnected while acquiring.
+    """
+
+    def __init__(self, store: DataStore, executor: Optional[Executor] = None, max_pending: int = MAX_PENDING_UPDATES):
+        self.store = store
+        self.executor = executor
+        self.stats = store.stats
+        self.max_pending = max_pending
+
+        self.outboxes: Set[ClientOutbox] = set()
+        self.history = MultiSeries({})
+        # the encoded history per wire format and channels, only valid until the next non-empty update
+        self.initial_payloads: Dict[Tuple[WireFormat, Optional[Tuple[str, ...]]], Payload] = {}
+
+    def _encode(
+            self, ty: str, multi_series: MultiSeries, wire_format: WireFormat, extra: Optional[dict] = None
+    ) -> Payload:
+        payload = Payload.encode(ty, multi_series, wire_format, extra)
+        self.stats.on_encode(payload)
+        return payload
+
+    def publish(self, update_series: MultiSeries, history: MultiSeries):
+        """
+        Broadcast an update, `history` is the full tracker history after the update.
+        """
+        self.history = history
+        if len(update_series.map) > 0:
+            self.initial_payloads.clear()
+
+        broadcast_update(self.outboxes, update_series, self._encode)
+
+    def _initial_payload(self, wire_format: WireFormat, channels: Optional[Tuple[str, ...]]) -> Payload:
+        payload_key = (wire_format, channels)
+        if payload_key not in self.initial_payloads:
+            history = select_channels(self.history, channels)
+            self.initial_payloads[payload_key] = self._encode(
+                "initial", history, wire_format, {"layout": history.layout()}
+            )
+        return self.initial_payloads[payload_key]
+
+    def channel_keys(self, names: Optional[List[str]]) -> Tuple[str, ...]:
+        return self.store.channel_keys(names)
+
+    async def add_outbox_get_initial(self, outbox: ClientOutbox, resume: Optional[Resume] = None) -> Payload:
+        def acquire() -> MultiSeries:
+            custom_series = self.store.acquire_channels(outbox.channels or ())
+            outbox.acquired_channels = True
+            return custom_series
+
+        custom = await asyncio.get_running_loop().run_in_executor(self.executor, acquire)
+
+        # the custom series can be newer than the last published update, clients skip the buckets they already have
+        # updates might also have been published while acquiring, then the history is the newer one
+        for key, series in custom.map.items():
+            current = self.history.map.get(key)
+            if current is None or len(current) == 0 or (
+                    len(series) > 0 and series.timestamps[-1] > current.timestamps[-1]):
+                self.history.map[key] = series
+                self.initial_payloads.clear()
+        self.outboxes.add(outbox)
+
+        history = select_channels(self.history, outbox.channels)
+        missing = resume.missing(history) if resume is not None else None
+        if missing is not None:
+            return self._encode("resume", missing, outbox.wire_format)
+        return self._initial_payload(outbox.wire_format, outbox.channels)
+
+    def resync_outbox(self, outbox: ClientOutbox) -> Payload:
+        outbox.clear()
+        return self._initial_payload(outbox.wire_format, outbox.channels)
+
+    async def remove_outbox(self, outbox: ClientOutbox):
+        self.outboxes.discard(outbox)
+
+        def release():
+            if outbox.acquired_channels:
+                outbox.acquired_channels = False
+                self.store.release_channels(outbox.channels or ())
+
+        await asyncio.get_running_loop().run_in_executor(self.executor, release)
+
+
+async def handler(websocket, store: Union[DataStore, AsyncBroadcaster]):
     print(f"Accepted connection from {websocket.remote_address}")
 
-    queue = JQueue()
+    try:
+        wire_format = parse_wire_format(websocket.path)
+    except ValueError:
+        print(f"Invalid path '{websocket.path}' from {websocket.remote_address}")
+        await websocket.close(code=1008, reason="invalid format")
+        return
 
     try:
-        initial_series: MultiSeries = store.add_broadcast_queue_get_data(queue)
-        response = {"type": "initial", "series": initial_series.to_json()}
-        print(
-            f"Sending response type 'initial' with series {list(initial_series.map.keys())} to {websocket.remote_address}")
-        await websocket.send(simplejson.dumps(response, ignore_nan=True))
+        channels = store.channel_keys(parse_channels(websocket.path))
+    except ValueError as e:
+        print(f"Invalid channels in '{websocket.path}' from {websocket.remote_address}: {e}")
+        await websocket.close(code=1008, reason="invalid series")
+        return
+
+    outbox = ClientOutbox(str(websocket.remote_address), wire_format, store.stats, store.max_pending, channels)
+
+    try:
+        payload = await store.add_outbox_get_initial(outbox, parse_resume(websocket.path))
+        metrics.CONNECTIONS.inc(payload.type)
 
         while True:
-            update_series: MultiSeries = await queue.async_q.get()
-            response = {"type": "update", "series": update_series.to_json()}
-            print(
-                f"Sending response type 'update' with series {list(update_series.map.keys())} to {websocket.remote_address}")
-            await websocket.send(simplejson.dumps(response, ignore_nan=True))
+            print(f"Sending response type '{payload.type}' with series {payload.keys} to {websocket.remote_address}")
+            with metrics.SEND_SECONDS.time(wire_format.value):
+                await websocket.send(payload.data)
+            store.stats.on_send(payload)
 
+            payload = await outbox.get()
+            if payload is None:
+                print(f"Client {websocket.remote_address} fell too far behind, resyncing")
+                payload = store.resync_outbox(outbox)
     except (ConnectionClosedError, ConnectionClosedOK):
         print(f"Client disconnected {websocket.remote_address}")
     finally:
-        store.remove_broadcast_queue(queue)
+        await store.remove_outbox(outbox)
+
+
+async def report_stats(store: Union[DataStore, AsyncBroadcaster]):
+    while True:
+        await asyncio.sleep(STATS_PERIOD)
+        encodes, encode_bytes, sends, send_bytes = store.stats.take_rates()
+        print(
+            f"Broadcast stats: {encodes:.2f} encodes/s ({encode_bytes / 1024:.2f} kB/s), "
+            f"{sends:.2f} sends/s ({send_bytes / 1024:.2f} kB/s)"
+        )
+        for outbox in list(store.outboxes):
+            print(outbox.take_summary())
 
 
-def socket_server_main(store: DataStore):
+def socket_server_main(store: DataStore, compression: Optional[str] = "deflate", port: int = 8001):
+    """
+    Run the websocket server, `compression` is passed on to `websockets.serve`,
+    use None to disable per-message-deflate and save CPU time at the cost of bandwidth.
+    """
+
     async def async_main():
-        async with websockets.serve(functools.partial(handler, store=store), "", 8001):
-            await asyncio.Future()  # run forever
+        serve = websockets.serve(functools.partial(handler, store=store), "", port, compression=compression)
+        async with serve:
+            await report_stats(store)  # run forever
 
     print("Starting socket server")
     asyncio.run(async_main())
+
+
+async def async_socket_server(
+        broadcaster: AsyncBroadcaster,
+        compression: Optional[str] = "deflate",
+        port: int = 8001,
+):
+    """
+    Run the websocket server on the current event loop, for the single event loop runtime.
+    """
+    print("Starting socket server")
+    serve = websockets.serve(functools.partial(handler, store=broadcaster), "", port, compression=compression)
+    async with serve:
+        await report_stats(broadcaster)  # run forever
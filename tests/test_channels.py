@@ -0,0 +1,36 @@
+import numpy as np
+
+from server.data import Database, DataStore, Tracker, parse_custom_channel
+from server.dummy_server import ReplayConfig, run_replay
+
+START = 1792224000
+
+
+def replay(first: int, count: int) -> list:
+    messages = []
+    run_replay(messages.append, ReplayConfig(start=first, count=count, rate=None))
+    return messages
+
+
+def test_channel_filled_while_messages_arrive(tmp_path, monkeypatch):
+    store = DataStore(Database(str(tmp_path / "data.db")))
+    store.process_messages(replay(START, 3000))
+    key, kind, buckets = parse_custom_channel("water-height:300:7200")
+
+    # the writer keeps going while the channel is filled without the lock
+    fill_series = Tracker.fill_series
+
+    def fill_while_writing(*args):
+        fill = fill_series(*args)
+        store.process_messages(replay(START + 3000, 700))
+        return fill
+
+    monkeypatch.setattr(Tracker, "fill_series", staticmethod(fill_while_writing))
+    store.acquire_channels([key])
+    monkeypatch.setattr(Tracker, "fill_series", staticmethod(fill_series))
+    store.process_messages(replay(START + 3700, 700))
+
+    tracked = store.tracker.custom_series.map[key]
+    expected = Tracker.fill_series(kind, buckets, store.database, START + 4399).series
+    assert tracked.timestamps.tolist() == expected.timestamps.tolist()
+    assert np.allclose(tracked.values, expected.values, equal_nan=True)
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from inputs.fast_parse import FastParser, iter_telegrams
+from inputs.parse import MeterMessage, Parser
+from server.dummy_server import build_telegram
+
+START = 1792224000
+# characters that turn up in telegrams, so mutations hit the interesting parse paths
+MUTATION_CHARS = "()*.:-!0123456789SWkVm3 "
+
+
+def telegram_lines(count: int) -> list:
+    text = b"".join(build_telegram(timestamp) for timestamp in range(START, START + count)).decode()
+    return text.splitlines(keepends=True)
+
+
+def mutate(lines: list, rng: random.Random) -> list:
+    result = []
+    for line in lines:
+        r = rng.random()
+        if r < 0.04 and len(line) > 2:
+            i = rng.randrange(len(line) - 2)
+            line = line[:i] + rng.choice(MUTATION_CHARS) + line[i + 1:]
+        elif r < 0.06 and len(line) > 2:
+            i = rng.randrange(len(line) - 2)
+            line = line[:i] + line[i + 1:]
+        elif r < 0.07:
+            # the same key twice
+            result.append(line)
+        elif r < 0.08:
+            result.append(rng.choice(["\r\n", "  \r\n", "garbage\r\n", "1-0:21.7.0\r\n"]))
+        result.append(line)
+    return result
+
+
+def read_reference(lines):
+    parser = Parser()
+    for line in lines:
+        raw_msg = parser.push_line(line)
+        if raw_msg is not None and raw_msg.is_clean:
+            yield MeterMessage.from_raw(raw_msg)
+
+
+def read_fast(lines):
+    parser = FastParser()
+    for line in lines:
+        msg = parser.push_line(line)
+        if msg is not None:
+            yield msg
+
+
+def read_fast_buffer(lines):
+    return iter_telegrams("".join(lines))
+
+
+def parse_all(read, lines, capsys):
+    # the repr, so missing values compare equal
+    messages = [repr(msg) for msg in read(lines)]
+    return messages, capsys.readouterr().out
+
+
+@pytest.mark.parametrize("read", [read_fast, read_fast_buffer])
+def test_valid_telegrams(read, capsys):
+    lines = telegram_lines(200)
+    expected = parse_all(read_reference, lines, capsys)
+    assert len(expected[0]) == 199
+    assert parse_all(read, lines, capsys) == expected
+
+
+@pytest.mark.parametrize("read", [read_fast, read_fast_buffer])
+@pytest.mark.parametrize("seed", range(5))
+def test_mutated_telegrams(read, seed, capsys):
+    lines = mutate(telegram_lines(200), random.Random(seed))
+    expected = parse_all(read_reference, lines, capsys)
+    assert "WARNING" in expected[1]
+    assert parse_all(read, lines, capsys) == expected
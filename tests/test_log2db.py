@@ -0,0 +1,64 @@
+import sqlite3
+import sys
+
+from server import log2db
+from server.data import Database
+from server.dummy_server import build_telegram
+from server.kinds import SeriesKind
+
+START = 1792224000
+
+
+def write_telegrams(path, first: int, count: int):
+    with open(path, "ab") as f:
+        for timestamp in range(first, first + count):
+            f.write(build_telegram(timestamp))
+
+
+def run_log2db(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["log2db", *map(str, args)])
+    log2db.main()
+
+
+def meter_timestamps(path_db):
+    with sqlite3.connect(path_db) as conn:
+        return [row[0] for row in conn.execute("SELECT timestamp FROM meter_samples ORDER BY timestamp")]
+
+
+def test_resume_after_log_grew(tmp_path, monkeypatch):
+    path_log, path_db = tmp_path / "log.txt", tmp_path / "data.db"
+
+    write_telegrams(path_log, START, 300)
+    run_log2db(monkeypatch, path_log, path_db, "--jobs", 1, "--chunk-size", 4096)
+    # the last telegram is only complete once the next one starts
+    assert meter_timestamps(path_db) == list(range(START, START + 299))
+
+    write_telegrams(path_log, START + 300, 200)
+    run_log2db(monkeypatch, path_log, path_db, "--update", "--jobs", 1, "--chunk-size", 4096)
+    assert meter_timestamps(path_db) == list(range(START, START + 499))
+
+
+def test_resume_without_new_data(tmp_path, monkeypatch):
+    path_log, path_db = tmp_path / "log.txt", tmp_path / "data.db"
+
+    write_telegrams(path_log, START, 50)
+    run_log2db(monkeypatch, path_log, path_db, "--jobs", 1)
+    run_log2db(monkeypatch, path_log, path_db, "--update", "--jobs", 1)
+    write_telegrams(path_log, START + 50, 1)
+    run_log2db(monkeypatch, path_log, path_db, "--update", "--jobs", 1)
+    assert meter_timestamps(path_db) == list(range(START, START + 50))
+
+
+def test_import_keeps_rollups_complete(tmp_path, monkeypatch):
+    path_log, path_db = tmp_path / "log.txt", tmp_path / "data.db"
+
+    write_telegrams(path_log, START, 100)
+    run_log2db(monkeypatch, path_log, path_db, "--jobs", 1)
+    write_telegrams(path_log, START + 100, 100)
+    run_log2db(monkeypatch, path_log, path_db, "--update", "--jobs", 1)
+
+    database = Database(str(path_db))
+    assert all(database.rollups.complete.values())
+    imported = database.conn.execute("SELECT * FROM rollup_power_60 ORDER BY bucket").fetchall()
+    list(database.rollups.backfill(SeriesKind.POWER))
+    assert database.conn.execute("SELECT * FROM rollup_power_60 ORDER BY bucket").fetchall() == imported
@@ -0,0 +1,39 @@
+from server.data import Database
+from server.kinds import SeriesKind
+from server.retention import RetentionPolicy
+from server.rollup import ROLLUP_RESOLUTIONS, rollup_table
+
+START = 1792224000
+DAY = 24 * 60 * 60
+
+
+def meter_row(timestamp: int) -> tuple:
+    power = timestamp % 1000 / 1000
+    return timestamp, "000000000000W", power, 2 * power, 3 * power, 230.0, 230.0, 230.0
+
+
+def rollup_totals(database: Database) -> list:
+    return [
+        database.conn.execute(
+            f"SELECT SUM(count_0), SUM(sum_0), MIN(min_0), MAX(max_0) FROM {rollup_table(SeriesKind.POWER, resolution)}"
+        ).fetchone()
+        for resolution in ROLLUP_RESOLUTIONS
+    ]
+
+
+def test_insert_before_retention_window_keeps_rollups(tmp_path):
+    database = Database(str(tmp_path / "data.db"))
+    database.insert_rows("meter_samples", [meter_row(t) for t in range(START, START + 3 * DAY, 5)])
+    database.conn.commit()
+
+    list(database.retention.run(RetentionPolicy(raw_days=1)))
+    raw_since = database.retention.raw_since("meter_samples")
+    assert raw_since is not None and raw_since > START + DAY
+    totals = rollup_totals(database)
+
+    # an old telegram from a log import or a meter clock that jumped backwards
+    database.insert_rows("meter_samples", [meter_row(START + 102), meter_row(raw_since + 5)])
+    database.conn.commit()
+
+    assert database.conn.execute("SELECT COUNT(*) FROM meter_samples WHERE timestamp < ?", (raw_since,)).fetchone() == (0,)
+    assert rollup_totals(database) == totals